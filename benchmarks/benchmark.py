@@ -0,0 +1,214 @@
+"""
+Benchmark cold start and request latency for generated applications.
+
+    python benchmarks/benchmark.py --rows 100000 --tables 5 \
+        --output results.json -- --lazy
+
+Arguments after -- are passed to "datasette publish vercel". The generated
+index.py is imported in a fresh Python subprocess, which times the import
+and the first request, then runs a fixed mix of requests in-process.
+"""
+
+from click.testing import CliRunner
+import click
+import json
+import math
+import os
+import pathlib
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+CATEGORIES = ["alpha", "beta", "gamma", "delta", "epsilon"]
+
+# Runs inside the generated application directory
+CHILD_SCRIPT = """
+import asyncio, json, runpy, sys, time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+start = time.perf_counter()
+app = runpy.run_path("index.py")["app"]
+import_time = time.perf_counter() - start
+
+import httpx
+
+paths = json.loads(sys.argv[1])
+iterations = int(sys.argv[2])
+
+
+async def main():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://localhost") as client:
+        start = time.perf_counter()
+        response = await client.get("/")
+        first_request = time.perf_counter() - start
+        latencies = {name: [] for name in paths}
+        statuses = {}
+        for i in range(iterations):
+            for name, path in paths.items():
+                start = time.perf_counter()
+                response = await client.get(path)
+                latencies[name].append(time.perf_counter() - start)
+                statuses[name] = response.status_code
+    return first_request, latencies, statuses
+
+
+first_request, latencies, statuses = asyncio.run(main())
+peak_rss_kb = None
+if resource is not None:
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes on macOS
+        peak_rss_kb //= 1024
+print(json.dumps({
+    "import_time": import_time,
+    "first_request_time": first_request,
+    "latencies": latencies,
+    "statuses": statuses,
+    "peak_rss_kb": peak_rss_kb,
+}))
+"""
+
+
+def create_database(path, tables, rows):
+    conn = sqlite3.connect(path)
+    for t in range(tables):
+        conn.execute(
+            "create table t{} (id integer primary key, name text, "
+            "category text, value real)".format(t)
+        )
+        conn.executemany(
+            "insert into t{} (name, category, value) values (?, ?, ?)".format(t),
+            (
+                ("name {}".format(i), CATEGORIES[i % len(CATEGORIES)], i * 1.5)
+                for i in range(rows)
+            ),
+        )
+    conn.commit()
+    conn.close()
+
+
+def request_paths(database="bench", table="t0"):
+    return {
+        "database": "/{}".format(database),
+        "table": "/{}/{}".format(database, table),
+        "row": "/{}/{}/1".format(database, table),
+        "facet": "/{}/{}?_facet=category".format(database, table),
+        "json": "/{}/{}.json?_size=50".format(database, table),
+    }
+
+
+def percentile(values, p):
+    # Nearest-rank method
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def generate(database_path, appdir, publish_args):
+    runner = CliRunner()
+    result = runner.invoke(
+        _cli(),
+        ["publish", "vercel", str(database_path), "--project", "bench"]
+        + ["--generate-dir", str(appdir)]
+        + list(publish_args),
+        catch_exceptions=False,
+    )
+    if result.exit_code != 0:
+        raise click.ClickException("Generating app failed:\n" + result.output)
+
+
+def _cli():
+    from datasette import cli
+
+    return cli.cli
+
+
+def run_benchmark(rows=10000, tables=1, iterations=20, publish_args=()):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        database_path = tmp / "bench.db"
+        start = time.perf_counter()
+        create_database(database_path, tables, rows)
+        create_time = time.perf_counter() - start
+        appdir = tmp / "app"
+        start = time.perf_counter()
+        generate(database_path, appdir, publish_args)
+        generate_time = time.perf_counter() - start
+        paths = request_paths()
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD_SCRIPT, json.dumps(paths), str(iterations)],
+            cwd=appdir,
+            capture_output=True,
+            text=True,
+            env=dict(os.environ, PYTHONPATH=str(appdir)),
+        )
+        if output.returncode != 0:
+            raise click.ClickException("Benchmark process failed:\n" + output.stderr)
+        child = json.loads(output.stdout.strip().split("\n")[-1])
+    return {
+        "config": {
+            "rows": rows,
+            "tables": tables,
+            "iterations": iterations,
+            "publish_args": list(publish_args),
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git_commit": _git_commit(),
+        },
+        "create_database_time": create_time,
+        "generate_time": generate_time,
+        "import_time": child["import_time"],
+        "first_request_time": child["first_request_time"],
+        "peak_rss_kb": child["peak_rss_kb"],
+        "statuses": child["statuses"],
+        "requests": {
+            name: {
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "count": len(values),
+            }
+            for name, values in child["latencies"].items()
+        },
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=pathlib.Path(__file__).parent,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+@click.command()
+@click.option("--rows", type=int, default=10000, help="Rows per synthetic table")
+@click.option("--tables", type=int, default=1, help="Number of synthetic tables")
+@click.option(
+    "--iterations", type=int, default=20, help="How many times to run the request mix"
+)
+@click.option(
+    "-o", "--output", type=click.File("w"), default="-", help="Write JSON here"
+)
+@click.argument("publish_args", nargs=-1, type=click.UNPROCESSED)
+def cli(rows, tables, iterations, output, publish_args):
+    "Benchmark cold start and request latency of a generated Vercel application"
+    results = run_benchmark(rows, tables, iterations, publish_args)
+    output.write(json.dumps(results, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    cli()
@@ -3,27 +3,71 @@ from datasette.publish.common import (
     add_common_publish_arguments_and_options,
     fail_if_publish_binary_not_installed,
 )
+from datasette.inspect import inspect_hash
 from datasette.utils import (
-    temporary_docker_directory,
+    parse_metadata,
+    sqlite3,
+    tilde_encode,
     value_as_boolean,
     ValueAsBooleanError,
 )
+from .analyze import DEFAULT_SIZE_LIMIT_MB, analyze_bundle, format_analysis
+from .deploy import (
+    VercelApiError,
+    VercelClient,
+    directory_manifest,
+    previous_manifest,
+    record_manifest,
+    state_key,
+)
+from .exports import (
+    EXPORTS_DIR,
+    export_tables,
+    exportable_tables,
+    format_export_report,
+)
+from .facets import (
+    SUMMARY_TABLE,
+    build_facet_summaries,
+    format_facet_report,
+    metadata_facets,
+    parse_facet_index,
+)
+from .fts import build_fts, format_fts_report, parse_fts
+from .optimize import (
+    VALID_PAGE_SIZES,
+    format_report,
+    optimize_database,
+    warmup_plan,
+)
+from .prerender import prerender
+from .requirements import pinned_requirements
+from .runtime import RUNTIME_MODULE, SCHEMA_SNAPSHOT, WARMUP_PLAN, snapshot_schemas
+from .staging import (
+    Stager,
+    format_sync_report,
+    generated_files,
+    read_generated_manifest,
+    staged_directory,
+    sync_directory,
+    write_generated_manifest,
+)
 import click
 from click.types import CompositeParamType
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import run, CalledProcessError
+import asyncio
+import hashlib
+import httpx
 import json
 import os
 import pathlib
 import re
 import shutil
+import textwrap
+import time
 
-INDEX_PY = """
-import asyncio
-from datasette.app import Datasette
-import json
-import pathlib
-import os
-
+DATASETTE_PY = """
 static_mounts = [
     (static, str((pathlib.Path(".") / static).resolve()))
     for static in {statics}
@@ -34,13 +78,12 @@ try:
     metadata = json.load(open("metadata.json"))
 except Exception:
     pass
-
+{inspect_data}
 secret = os.environ.get("DATASETTE_SECRET")
 
 true, false = True, False
 
 ds = Datasette(
-    [],
     {database_files},
     static_mounts=static_mounts,
     metadata=metadata{extras},
@@ -48,10 +91,49 @@ ds = Datasette(
     cors=True,
     settings={settings}{crossdb}
 )
+""".strip()
+
+INDEX_PY = """
+import asyncio
+from datasette.app import Datasette
+import json
+import pathlib
+import os
+
+{datasette}
 asyncio.run(ds.invoke_startup())
 app = ds.app()
 """.strip()
 
+# Used by --lazy: nothing is constructed until the first request
+LAZY_INDEX_PY = """
+import json
+import pathlib
+import os
+
+
+def build():
+    from datasette.app import Datasette
+
+{datasette}
+    return ds
+
+
+app = LazyApp(build)
+""".strip()
+
+# Vercel defaults for serverless functions
+DEFAULT_FUNCTION_MEMORY = 1024
+DEFAULT_FUNCTION_MAX_DURATION = 10
+
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# For files not versioned by filename: only cache them for long in the edge
+# cache, which is per-deployment
+DEPLOYMENT_CACHE_CONTROL = "public, max-age=3600, s-maxage=31536000"
+
+# Used by --cdn-downloads for content-versioned copies of the databases
+DOWNLOADS_DIR = "downloads"
+
 project_name_re = re.compile(r"^[a-z0-9][a-z0-9-]{1,51}$")
 
 
@@ -94,13 +176,22 @@ class ProjectName(click.ParamType):
     name = "project"
 
     def convert(self, value, param, ctx):
-        if not project_name_re.match(value):
+        scope, _, name = value.rpartition("/")
+        if not project_name_re.match(name):
             self.fail(
                 "Project name must be lowercase, alphanumeric, max 52 chars, cannot begin with a hyphen"
             )
+        if "/" in scope:
+            self.fail("Use scope/project to deploy a project to a specific scope")
         return value
 
 
+def parse_target(value, default_scope=None):
+    "Split a --project value of project or scope/project into (project, scope)"
+    scope, _, project = value.rpartition("/")
+    return project, scope or default_scope
+
+
 def add_vercel_options(cmd):
     for decorator in reversed(
         (
@@ -108,8 +199,9 @@ def add_vercel_options(cmd):
             click.option(
                 "--project",
                 type=ProjectName(),
-                help="Vercel project name to use",
+                help="Vercel project name to use, as project or scope/project - can be used more than once",
                 required=True,
+                multiple=True,
             ),
             click.option(
                 "--scope",
@@ -120,6 +212,13 @@ def add_vercel_options(cmd):
                 is_flag=True,
                 help="Don't deploy directly to production",
             ),
+            click.option(
+                "--deploy-workers",
+                type=click.IntRange(min=1),
+                default=4,
+                help="How many projects to deploy to at once",
+                show_default=True,
+            ),
             click.option(
                 "--debug",
                 is_flag=True,
@@ -130,11 +229,33 @@ def add_vercel_options(cmd):
                 is_flag=True,
                 help="Publish source with Vercel CLI --public",
             ),
+            click.option(
+                "--api",
+                is_flag=True,
+                help="Deploy using the Vercel API instead of the Vercel CLI, only uploading changed files",
+            ),
             click.option(
                 "--generate-dir",
                 type=click.Path(dir_okay=True, file_okay=False),
                 help="Output generated application files and stop without deploying",
             ),
+            click.option(
+                "--analyze",
+                is_flag=True,
+                help="Report the size of the generated application and stop without deploying",
+            ),
+            click.option(
+                "--analyze-json",
+                is_flag=True,
+                help="Output the --analyze report as JSON",
+            ),
+            click.option(
+                "--size-limit",
+                type=click.IntRange(min=1),
+                default=DEFAULT_SIZE_LIMIT_MB,
+                help="Function size limit in MB for --analyze, which fails if it is exceeded",
+                show_default=True,
+            ),
             click.option(
                 "--generate-vercel-json",
                 is_flag=True,
@@ -145,6 +266,58 @@ def add_vercel_options(cmd):
                 type=click.File(),
                 help="Custom vercel.json file to use instead of generating one",
             ),
+            click.option(
+                "--cdn-ttl",
+                type=click.IntRange(min=0),
+                help="Cache table, row and JSON/CSV responses in the Vercel CDN for this many seconds",
+            ),
+            click.option(
+                "--cdn-swr",
+                type=click.IntRange(min=0),
+                help="Seconds for stale-while-revalidate, used with --cdn-ttl",
+            ),
+            click.option(
+                "--memory",
+                type=click.IntRange(min=128),
+                help="Memory in MB for the serverless function",
+            ),
+            click.option(
+                "--max-duration",
+                type=click.IntRange(min=1),
+                help="Maximum execution time in seconds for the serverless function",
+            ),
+            click.option(
+                "--region",
+                "regions",
+                multiple=True,
+                help="Vercel region to deploy the function to, e.g. iad1",
+            ),
+            click.option(
+                "--serverless-settings",
+                is_flag=True,
+                help="Derive Datasette thread, cache and time limit settings from the function size",
+            ),
+            click.option(
+                "--cdn-downloads",
+                is_flag=True,
+                help="Serve /<database>.db downloads as static files from the Vercel CDN",
+            ),
+            click.option(
+                "--bulk-exports",
+                is_flag=True,
+                help="Publish every table as static gzipped CSV and NDJSON files",
+            ),
+            click.option(
+                "--bulk-export",
+                "bulk_export_tables",
+                multiple=True,
+                help="Publish this database:table as static gzipped CSV and NDJSON files",
+            ),
+            click.option(
+                "--pin-requirements",
+                is_flag=True,
+                help="Pin requirements.txt to the package versions installed locally",
+            ),
             click.option(
                 "--setting",
                 "settings",
@@ -155,12 +328,628 @@ def add_vercel_options(cmd):
             click.option(
                 "--crossdb", is_flag=True, help="Enable cross-database SQL queries"
             ),
+            click.option(
+                "--immutable/--no-immutable",
+                default=True,
+                help="Open databases in immutable mode with a precomputed inspect-data.json",
+                show_default=True,
+            ),
+            click.option(
+                "--state-file",
+                type=click.Path(dir_okay=False),
+                help="Record deployed files here and skip deploys if nothing has changed",
+            ),
+            click.option(
+                "--force",
+                is_flag=True,
+                help="Deploy even if --state-file shows nothing has changed, or write to a --generate-dir not created by this tool",
+            ),
+            click.option(
+                "--lazy",
+                is_flag=True,
+                help="Construct Datasette on the first request instead of at import time",
+            ),
+            click.option(
+                "--prerender",
+                is_flag=True,
+                help="Render the index, database and table pages at publish time",
+            ),
+            click.option(
+                "--prerender-path",
+                "prerender_paths",
+                multiple=True,
+                help="Path to render at publish time, instead of the --prerender defaults",
+            ),
+            click.option(
+                "--schema-snapshot",
+                is_flag=True,
+                help="Record database schemas at publish time instead of on the first request",
+            ),
+            click.option(
+                "--instrument",
+                is_flag=True,
+                help="Add Server-Timing headers and a JSON log line for every request",
+            ),
+            click.option(
+                "--query-cache",
+                type=click.IntRange(min=1),
+                help="Cache SQL query results in memory, up to this many MB per instance",
+            ),
+            click.option(
+                "--mmap-size",
+                type=click.IntRange(min=0),
+                help="Set PRAGMA mmap_size to this many MB on every database connection",
+            ),
+            click.option(
+                "--cache-size",
+                type=click.IntRange(min=1),
+                help="SQLite page cache for each database connection, in MB",
+            ),
+            click.option(
+                "--prewarm",
+                "prewarm",
+                multiple=True,
+                help="Read this database or database:table into the page cache on startup",
+            ),
+            click.option(
+                "--etag",
+                is_flag=True,
+                help="Send ETag headers and answer If-None-Match with 304 Not Modified",
+            ),
+            click.option(
+                "--compress",
+                is_flag=True,
+                help="Compress responses with gzip, or brotli if it is installed",
+            ),
+            click.option(
+                "--compress-min-size",
+                type=click.IntRange(min=0),
+                help="Only compress responses of at least this many bytes, default 500",
+            ),
+            click.option(
+                "--compress-type",
+                "compress_types",
+                multiple=True,
+                help="Content type to compress, instead of the default text types",
+            ),
+            click.option(
+                "--split-functions",
+                is_flag=True,
+                help="Deploy each database as a separate serverless function",
+            ),
+            click.option(
+                "--fts",
+                "fts",
+                multiple=True,
+                help="Build a full-text search index for database:table:column1,column2",
+            ),
+            click.option(
+                "--facet-summaries",
+                is_flag=True,
+                help="Precompute the column facets configured in metadata",
+            ),
+            click.option(
+                "--facet-index",
+                "facet_indexes",
+                multiple=True,
+                help="Index and precompute facet counts for database:table:column",
+            ),
+            click.option(
+                "--optimize",
+                is_flag=True,
+                help="Run VACUUM, ANALYZE and PRAGMA optimize against copies of the databases",
+            ),
+            click.option(
+                "--page-size",
+                type=int,
+                help="Rebuild optimized databases with this SQLite page_size",
+            ),
         )
     ):
         cmd = decorator(cmd)
     return cmd
 
 
+def generate_index_py(datasette_py, lazy=False, wrappers=(), setup=()):
+    """
+    Returns the source code for an entry point.
+
+    wrappers is a list of (class name, keyword arguments) pairs for runtime
+    middleware to wrap around the ASGI app, innermost first. setup is a list
+    of (function name, keyword arguments) for runtime functions to call with
+    the Datasette instance once it has been constructed.
+    """
+
+    def call(name, first_arg, kwargs):
+        return "{}({})".format(
+            name,
+            ", ".join(
+                [first_arg]
+                + ["{}={!r}".format(key, value) for key, value in kwargs.items()]
+            ),
+        )
+
+    for name, kwargs in setup:
+        datasette_py += "\n" + call(name, "ds", kwargs)
+    if lazy:
+        index_py = LAZY_INDEX_PY.format(datasette=textwrap.indent(datasette_py, "    "))
+    else:
+        index_py = INDEX_PY.format(datasette=datasette_py)
+    runtime_imports = sorted(
+        {name for name, _ in list(wrappers) + list(setup)}
+        | ({"LazyApp"} if lazy else set())
+    )
+    if runtime_imports:
+        index_py = "from {} import {}\n{}".format(
+            RUNTIME_MODULE, ", ".join(runtime_imports), index_py
+        )
+    for name, kwargs in wrappers:
+        index_py += "\napp = " + call(name, "app", kwargs)
+    return index_py
+
+
+def build_datasette(datasette_py):
+    # Build the app from the staged files exactly as index.py would
+    namespace = {}
+    exec(INDEX_PY.format(datasette=datasette_py), namespace)
+    return namespace["ds"]
+
+
+def parse_fts_options(values, database_files):
+    """
+    Turn --fts database:table:columns values into a dictionary of
+    {database file: [(table, columns), ...]}
+    """
+    stems = {pathlib.Path(f).stem: f for f in database_files}
+    tables = {}
+    for value in values:
+        try:
+            database, table, columns = parse_fts(value)
+        except ValueError as ex:
+            raise click.ClickException("{}, got {}".format(ex, value))
+        if database not in stems:
+            raise click.ClickException(
+                "--fts database {} is not being published".format(database)
+            )
+        existing = tables.setdefault(stems[database], [])
+        if table in [t for t, _ in existing]:
+            raise click.ClickException(
+                "--fts can only be used once for {}:{}".format(database, table)
+            )
+        existing.append((table, columns))
+    return tables
+
+
+def record_table_metadata(values, metadata_path="metadata.json"):
+    """
+    Add {(database, table): {key: value}} to the staged metadata, keeping
+    any values the metadata already sets
+    """
+    metadata = {}
+    if os.path.exists(metadata_path):
+        metadata = json.load(open(metadata_path))
+    for (database, table), table_values in values.items():
+        table_metadata = (
+            metadata.setdefault("databases", {})
+            .setdefault(database, {})
+            .setdefault("tables", {})
+            .setdefault(table, {})
+        )
+        for key, value in table_values.items():
+            table_metadata.setdefault(key, value)
+    with open(metadata_path, "w") as fp:
+        fp.write(json.dumps(metadata, indent=2))
+    return metadata
+
+
+def run_fts(fts_tables):
+    """
+    Build the full-text indexes in the staged databases and record them as
+    fts_table in the staged metadata, unless the metadata already sets one
+    """
+    recorded = {}
+    for database_file, tables in fts_tables.items():
+        try:
+            result = build_fts(database_file, tables)
+        except (ValueError, sqlite3.DatabaseError) as ex:
+            raise click.ClickException(
+                "Could not build --fts index in {}: {}".format(database_file, ex)
+            )
+        click.echo(format_fts_report(result), err=True)
+        for index in result["indexes"]:
+            recorded[(pathlib.Path(database_file).stem, index["table"])] = {
+                "fts_table": index["fts_table"]
+            }
+    record_table_metadata(recorded)
+
+
+def parse_facet_indexes(values, database_files):
+    "Turn --facet-index values into {database file: [(table, column), ...]}"
+    stems = {pathlib.Path(f).stem: f for f in database_files}
+    facets = {}
+    for value in values:
+        try:
+            database, table, column = parse_facet_index(value)
+        except ValueError as ex:
+            raise click.ClickException("{}, got {}".format(ex, value))
+        if database not in stems:
+            raise click.ClickException(
+                "--facet-index database {} is not being published".format(database)
+            )
+        facets.setdefault(stems[database], []).append((table, column))
+    return facets
+
+
+def run_facet_summaries(facets, limit):
+    """
+    Index and summarise the faceted columns in the staged databases, hiding
+    the summary tables. Returns the names of the databases summarised.
+    """
+    summarised = []
+    for database_file, columns in facets.items():
+        try:
+            result = build_facet_summaries(database_file, columns, limit)
+        except (ValueError, sqlite3.DatabaseError) as ex:
+            raise click.ClickException(
+                "Could not summarise facets in {}: {}".format(database_file, ex)
+            )
+        click.echo(format_facet_report(result), err=True)
+        summarised.append(pathlib.Path(database_file).stem)
+    record_table_metadata(
+        {(database, SUMMARY_TABLE): {"hidden": True} for database in summarised}
+    )
+    return summarised
+
+
+def facet_summary_limit(settings):
+    # Datasette never shows more than max_returned_rows facet values, and
+    # asks for one more to tell if the list was truncated
+    return int(dict(settings).get("max_returned_rows", 1000)) + 1
+
+
+def parse_prewarm(values, database_files):
+    """
+    Turn --prewarm database and database:table values into a dictionary of
+    {database file: list of tables, or None for the whole file}
+    """
+    stems = {pathlib.Path(f).stem: f for f in database_files}
+    tables = {}
+    for value in values:
+        database, _, table = value.partition(":")
+        if database not in stems:
+            raise click.ClickException(
+                "--prewarm database {} is not being published".format(database)
+            )
+        database_file = stems[database]
+        if not table:
+            tables[database_file] = None
+        elif database_file not in tables or tables[database_file] is not None:
+            tables.setdefault(database_file, []).append(table)
+    return tables
+
+
+def write_warmup_plan(prewarm_tables, filename=WARMUP_PLAN):
+    plan = {}
+    for database_file, tables in prewarm_tables.items():
+        try:
+            plan[database_file] = warmup_plan(database_file, tables)
+        except ValueError as ex:
+            raise click.ClickException("--prewarm {}: {}".format(database_file, ex))
+    with open(filename, "w") as fp:
+        json.dump(plan, fp)
+    return plan
+
+
+def write_schema_snapshot(datasette_py, filename=SCHEMA_SNAPSHOT):
+    start = time.perf_counter()
+    snapshot = asyncio.run(snapshot_schemas(build_datasette(datasette_py)))
+    with open(filename, "w") as fp:
+        fp.write(json.dumps(snapshot))
+    click.echo(
+        "Snapshotted schemas of {} database{} in {:.2f}s".format(
+            len(snapshot["databases"]),
+            "" if len(snapshot["databases"]) == 1 else "s",
+            time.perf_counter() - start,
+        ),
+        err=True,
+    )
+
+
+def run_prerender(datasette_py, paths=None, extra_paths=()):
+    start = time.perf_counter()
+    results = asyncio.run(
+        prerender(build_datasette(datasette_py), paths, extra_paths=extra_paths)
+    )
+    duration = time.perf_counter() - start
+    for path, status, _ in results:
+        if status != 200:
+            click.echo(
+                "Could not prerender {}: HTTP status {}".format(path, status), err=True
+            )
+    rendered = [result for result in results if result[1] == 200]
+    message = "Prerendered {} page{} in {:.2f}s".format(
+        len(rendered), "" if len(rendered) == 1 else "s", duration
+    )
+    if rendered:
+        slowest = max(rendered, key=lambda result: result[2])
+        message += ", slowest was {} ({:.2f}s)".format(slowest[0], slowest[2])
+    click.echo(message, err=True)
+
+
+# With --split-functions the shared index.py has no databases attached, so
+# these pages are rendered at publish time from an app that has them all
+SHARED_FUNCTION_PAGES = ["/", "/.json", "/-/databases.json"]
+
+
+def entry_points(database_files, split_functions=False):
+    """
+    Returns a list of (entry point filename, database files) pairs.
+
+    With split_functions each database gets its own entry point, and index.py
+    serves everything else (/, /-/ and static assets) without any databases.
+    """
+    if not split_functions:
+        return [("index.py", database_files)]
+    pairs = [("index.py", [])]
+    for database_file in database_files:
+        name = pathlib.Path(database_file).stem
+        pairs.append(
+            ("index_{}.py".format(re.sub(r"[^a-zA-Z0-9_]", "_", name)), [database_file])
+        )
+    return pairs
+
+
+def cache_control_routes(statics=(), cdn_ttl=None, cdn_swr=None):
+    # Routes with "continue": true add headers, then routing carries on
+    routes = [
+        {
+            "src": "^/-/(static|static-plugins)/(.*)$",
+            "headers": {"cache-control": STATIC_CACHE_CONTROL},
+            "continue": True,
+        }
+    ]
+    for mount in statics:
+        routes.append(
+            {
+                "src": "^/{}/(.*)$".format(re.escape(mount)),
+                "headers": {"cache-control": DEPLOYMENT_CACHE_CONTROL},
+                "continue": True,
+            }
+        )
+    if cdn_ttl is not None:
+        cache_control = "public, max-age=0, s-maxage={}".format(cdn_ttl)
+        if cdn_swr is not None:
+            cache_control += ", stale-while-revalidate={}".format(cdn_swr)
+        # Everything except the /-/ pages, which can vary by actor - and
+        # nothing requested by a signed-in actor, which may be restricted
+        routes.append(
+            {
+                "src": "^/(?!-/).*$",
+                "methods": ["GET", "HEAD"],
+                "missing": [
+                    {"type": "cookie", "key": "ds_actor"},
+                    {"type": "header", "key": "authorization"},
+                ],
+                "headers": {"cache-control": cache_control},
+                "continue": True,
+            }
+        )
+    return routes
+
+
+def download_filename(database_file, content_hash):
+    path = pathlib.Path(database_file)
+    return "{}-{}{}".format(path.stem, content_hash[:16], path.suffix)
+
+
+def is_restricted(metadata, database, table=None):
+    "Does metadata include an allow block covering this database or table?"
+    database_metadata = (metadata.get("databases") or {}).get(database) or {}
+    table_metadata = (database_metadata.get("tables") or {}).get(table) or {}
+    return any("allow" in m for m in (metadata, database_metadata, table_metadata))
+
+
+def cdn_downloads_for(database_files, hashes, metadata):
+    """
+    Returns a {database file: download filename} dictionary for the databases
+    that can be served from the CDN - the CDN cannot check permissions, so
+    databases with an "allow" block in metadata are skipped.
+    """
+    downloads = {}
+    for database_file in database_files:
+        name = pathlib.Path(database_file).stem
+        if is_restricted(metadata, name):
+            click.echo(
+                "Not serving {} from the CDN as access to it is restricted".format(
+                    database_file
+                ),
+                err=True,
+            )
+            continue
+        downloads[database_file] = download_filename(
+            database_file, hashes[database_file]
+        )
+    return downloads
+
+
+def build_vercel_json(
+    project,
+    database_files,
+    split_functions=False,
+    statics=(),
+    cdn_ttl=None,
+    cdn_swr=None,
+    memory=None,
+    max_duration=None,
+    regions=(),
+    downloads=None,
+    exports=False,
+):
+    builds = []
+    routes = cache_control_routes(statics, cdn_ttl, cdn_swr)
+    for database_file, filename in (downloads or {}).items():
+        path = "/{}/{}".format(DOWNLOADS_DIR, filename)
+        # Redirect rather than rewrite, so the versioned URL can be cached
+        # by browsers for as long as the CDN caches it
+        routes.append(
+            {
+                "src": "^/{}\\.db$".format(
+                    re.escape(tilde_encode(pathlib.Path(database_file).stem))
+                ),
+                "status": 302,
+                "headers": {"Location": path},
+            }
+        )
+        routes.append(
+            {
+                "src": "^{}$".format(re.escape(path)),
+                "dest": path,
+                "headers": {
+                    "cache-control": STATIC_CACHE_CONTROL,
+                    "content-disposition": 'attachment; filename="{}"'.format(
+                        database_file
+                    ),
+                    "access-control-allow-origin": "*",
+                },
+            }
+        )
+    # The top-level "functions" key cannot be combined with "builds", so
+    # function sizing goes in the config for each build instead - under
+    # "functions", keyed by entry point, which is where @vercel/python looks
+    # for it (getLambdaOptionsFromFunction in @vercel/build-utils)
+    function_config = {}
+    if memory:
+        function_config["memory"] = memory
+    if max_duration:
+        function_config["maxDuration"] = max_duration
+    for entry_point, entry_point_files in entry_points(database_files, split_functions):
+        build = {"src": entry_point, "use": "@vercel/python@3.0.7"}
+        config = {}
+        if function_config:
+            config["functions"] = {entry_point: function_config}
+        excluded = []
+        if split_functions:
+            # Keep every other database out of this function's bundle
+            excluded = [f for f in database_files if f not in entry_point_files]
+        if downloads:
+            excluded.append("{}/**".format(DOWNLOADS_DIR))
+        if exports:
+            excluded.append("{}/**".format(EXPORTS_DIR))
+        if excluded:
+            config["excludeFiles"] = "{%s}" % ",".join(excluded)
+        if config:
+            build["config"] = config
+        builds.append(build)
+        if not split_functions:
+            continue
+        for database_file in entry_point_files:
+            route = tilde_encode(pathlib.Path(database_file).stem)
+            routes.append(
+                {"src": "^/{}([/.].*)?$".format(re.escape(route)), "dest": entry_point}
+            )
+    if downloads:
+        builds.append({"src": "{}/*".format(DOWNLOADS_DIR), "use": "@vercel/static"})
+    if exports:
+        builds.append({"src": "{}/**".format(EXPORTS_DIR), "use": "@vercel/static"})
+        routes.append(
+            {
+                "src": "^/{}/(.*)$".format(EXPORTS_DIR),
+                "dest": "/{}/$1".format(EXPORTS_DIR),
+                "headers": {"cache-control": DEPLOYMENT_CACHE_CONTROL},
+            }
+        )
+    routes.append({"src": "(.*)", "dest": "index.py"})
+    vercel_json = {
+        "name": project,
+        "version": 2,
+        "builds": builds,
+        "routes": routes,
+    }
+    if regions:
+        vercel_json["regions"] = list(regions)
+    return vercel_json
+
+
+def derive_serverless_settings(database_files, memory=None, max_duration=None):
+    """
+    Datasette settings suited to a function that serves one request at a
+    time, with the given memory (MB) and maximum duration (seconds)
+    """
+    memory = memory or DEFAULT_FUNCTION_MEMORY
+    max_duration = max_duration or DEFAULT_FUNCTION_MAX_DURATION
+    return {
+        "num_sql_threads": 1,
+        # An eighth of the function's memory, split between the databases
+        "cache_size_kb": memory * 1024 // 8 // max(1, len(database_files)),
+        # A page can run several queries, so leave plenty of headroom for
+        # Datasette to time them out before the platform kills the function
+        "sql_time_limit_ms": max_duration * 1000 // 4,
+    }
+
+
+def content_hash(manifest, *extra):
+    """
+    A hash of everything the responses of a deployment depend on: the
+    manifest of staged files plus any extra JSON-serializable values
+    """
+    return hashlib.sha256(
+        json.dumps([manifest] + list(extra), sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def run_bulk_exports(database_files, selected=None, metadata=None):
+    """
+    Export the tables listed in selected (database:table strings), or every
+    table if that is None, skipping any with access restricted in metadata
+    """
+    metadata = metadata or {}
+    paths = {pathlib.Path(f).stem: f for f in database_files}
+    available = {database: exportable_tables(path) for database, path in paths.items()}
+    if selected is None:
+        selected = [
+            "{}:{}".format(database, table)
+            for database, tables in available.items()
+            for table in tables
+            # Created by --facet-summaries, not part of the data
+            if table != SUMMARY_TABLE
+        ]
+    jobs = []
+    for item in selected:
+        database, table = item.split(":")
+        if table not in available.get(database, []):
+            raise click.ClickException("--bulk-export table not found: {}".format(item))
+        if is_restricted(metadata, database, table):
+            click.echo(
+                "Not exporting {} as access to it is restricted".format(item), err=True
+            )
+            continue
+        jobs.append((paths[database], table))
+    start = time.perf_counter()
+    results = export_tables(jobs)
+    for result in results:
+        click.echo(format_export_report(result), err=True)
+    click.echo(
+        "Exported {} table{} in {:.2f}s".format(
+            len(results), "" if len(results) == 1 else "s", time.perf_counter() - start
+        ),
+        err=True,
+    )
+
+
+def write_inspect_data(database_files, filename="inspect-data.json"):
+    # Equivalent of "datasette inspect", run against the staged copies so that
+    # the "file" keys are relative to the deployed application directory
+    from datasette.cli import inspect_
+
+    try:
+        inspect_data = asyncio.run(inspect_(database_files, None))
+    except sqlite3.DatabaseError as ex:
+        raise click.ClickException("Could not inspect databases: {}".format(ex))
+    with open(filename, "w") as fp:
+        fp.write(json.dumps(inspect_data, indent=2))
+    return inspect_data
+
+
 def _publish_vercel(
     files,
     metadata,
@@ -184,21 +973,74 @@ def _publish_vercel(
     project,
     scope,
     no_prod,
+    deploy_workers,
     debug,
     public,
+    api,
     generate_dir,
+    analyze,
+    analyze_json,
+    size_limit,
     generate_vercel_json,
     vercel_json,
+    cdn_ttl,
+    cdn_swr,
+    memory,
+    max_duration,
+    regions,
+    serverless_settings,
+    cdn_downloads,
+    bulk_exports,
+    bulk_export_tables,
+    pin_requirements,
     settings,
     crossdb,
+    immutable,
+    state_file,
+    force,
+    lazy,
+    prerender,
+    prerender_paths,
+    schema_snapshot,
+    instrument,
+    query_cache,
+    mmap_size,
+    cache_size,
+    prewarm,
+    etag,
+    compress,
+    compress_min_size,
+    compress_types,
+    split_functions,
+    fts,
+    facet_summaries,
+    facet_indexes,
+    optimize,
+    page_size,
 ):
+    targets = [parse_target(value, scope) for value in project]
+    if len(set(targets)) != len(targets):
+        raise click.ClickException("Each --project can only be used once")
+    if len(targets) > 1 and (generate_dir or generate_vercel_json):
+        raise click.ClickException(
+            "--generate-dir and --generate-vercel-json need a single --project"
+        )
+    # The first target is used for the generated vercel.json
+    project, scope = targets[0]
     if vercel_json and generate_vercel_json:
         raise click.ClickException(
             "Cannot use both --vercel-json and --generate-vercel-json"
         )
-    fail_if_publish_binary_not_installed(
-        "vercel", "Vercel", "https://vercel.com/download"
-    )
+    if analyze_json:
+        analyze = True
+    if api:
+        if not token and not (generate_dir or generate_vercel_json or analyze):
+            raise click.ClickException("--api requires --token")
+    elif not (analyze or generate_dir or generate_vercel_json):
+        # Generating the application files does not need the Vercel CLI
+        fail_if_publish_binary_not_installed(
+            "vercel", "Vercel", "https://vercel.com/download"
+        )
     extra_metadata = {
         "title": title,
         "license": license,
@@ -209,22 +1051,105 @@ def _publish_vercel(
         "about_url": about_url,
     }
 
+    if page_size is not None:
+        if not optimize:
+            raise click.ClickException("--page-size requires --optimize")
+        if page_size not in VALID_PAGE_SIZES:
+            raise click.ClickException(
+                "--page-size must be a power of two between 512 and 65536"
+            )
+
     if generate_dir:
         generate_dir = str(pathlib.Path(generate_dir).resolve())
+    if state_file:
+        state_file = str(pathlib.Path(state_file).resolve())
+
+    if cdn_swr is not None and cdn_ttl is None:
+        raise click.ClickException("--cdn-swr requires --cdn-ttl")
+    for path in prerender_paths:
+        if not path.startswith("/") or "?" in path:
+            raise click.ClickException(
+                "--prerender-path must start with / and cannot include a query string"
+            )
+    if split_functions and crossdb:
+        raise click.ClickException("Cannot use --crossdb with --split-functions")
+    for item in bulk_export_tables:
+        if len(item.split(":")) != 2 or not all(item.split(":")):
+            raise click.ClickException(
+                "--bulk-export must be database:table, got {}".format(item)
+            )
+    exports = bool(bulk_exports or bulk_export_tables)
+    if (compress_min_size is not None or compress_types) and not compress:
+        raise click.ClickException(
+            "--compress-min-size and --compress-type require --compress"
+        )
+    if (facet_summaries or facet_indexes) and not immutable:
+        raise click.ClickException(
+            "Cannot use --facet-summaries or --facet-index with --no-immutable"
+        )
+    if query_cache and not immutable:
+        raise click.ClickException("Cannot use --query-cache with --no-immutable")
+    if schema_snapshot and not immutable:
+        raise click.ClickException("Cannot use --schema-snapshot with --no-immutable")
+    if cdn_downloads:
+        if not immutable:
+            raise click.ClickException("Cannot use --cdn-downloads with --no-immutable")
+        if dict(settings).get("allow_download") is False:
+            raise click.ClickException(
+                "Cannot use --cdn-downloads with allow_download turned off"
+            )
+        # These options rewrite the staged database files, changing their hashes
+        if generate_vercel_json and (
+            optimize or fts or facet_summaries or facet_indexes
+        ):
+            raise click.ClickException(
+                "--generate-vercel-json cannot predict --cdn-downloads filenames "
+                "for --optimize, --fts, --facet-summaries or --facet-index databases"
+            )
+
+    database_files = [os.path.split(f)[-1] for f in files]
+    fts_tables = parse_fts_options(fts, database_files)
+    facet_columns = parse_facet_indexes(facet_indexes, database_files)
+    prewarm_tables = parse_prewarm(prewarm, database_files)
+    if serverless_settings or cache_size:
+        # Explicit --setting values take precedence
+        derived = {}
+        if serverless_settings:
+            derived = derive_serverless_settings(database_files, memory, max_duration)
+        if cache_size:
+            derived["cache_size_kb"] = cache_size * 1024
+        settings = dict(derived, **dict(settings))
+
+    def vercel_json_for(downloads=None):
+        return json.dumps(
+            build_vercel_json(
+                project,
+                database_files,
+                split_functions,
+                statics=[item[0] for item in static],
+                cdn_ttl=cdn_ttl,
+                cdn_swr=cdn_swr,
+                memory=memory,
+                max_duration=max_duration,
+                regions=regions,
+                downloads=downloads,
+                exports=exports,
+            ),
+            indent=4,
+        )
 
-    vercel_json_content = json.dumps(
-        {
-            "name": project,
-            "version": 2,
-            "builds": [{"src": "index.py", "use": "@vercel/python@3.0.7"}],
-            "routes": [{"src": "(.*)", "dest": "index.py"}],
-        },
-        indent=4,
-    )
     if generate_vercel_json:
-        click.echo(vercel_json_content)
+        downloads = None
+        if cdn_downloads:
+            downloads = cdn_downloads_for(
+                database_files,
+                {os.path.split(f)[-1]: inspect_hash(pathlib.Path(f)) for f in files},
+                parse_metadata(metadata.read()) if metadata else {},
+            )
+        click.echo(vercel_json_for(downloads))
         return
 
+    vercel_json_content = None
     if vercel_json:
         vercel_json_content = vercel_json.read()
         try:
@@ -232,25 +1157,31 @@ def _publish_vercel(
         except ValueError:
             raise click.ClickException("--vercel-json contents must be valid JSON")
 
-    with temporary_docker_directory(
+    if generate_dir and os.path.exists(generate_dir):
+        if not os.path.isdir(generate_dir):
+            raise click.ClickException("{} is not a directory".format(generate_dir))
+        previous_files = read_generated_manifest(generate_dir)
+        if previous_files is None and os.listdir(generate_dir) and not force:
+            raise click.ClickException(
+                "{} is not empty and was not created by --generate-dir - "
+                "use --force to write to it anyway".format(generate_dir)
+            )
+        # Staged alongside, then only the changes are copied across
+        sync_to = generate_dir
+    else:
+        previous_files = None
+        sync_to = None
+
+    with staged_directory(
         files,
-        "datasette-now-v2",
         metadata,
-        extra_options,
-        branch,
         template_dir,
         plugins_dir,
         static,
-        install,
-        False,
-        version_note,
-        secret,
         extra_metadata,
-        port=8080,
-    ):
-        # We don't actually want the Dockerfile
-        os.remove("Dockerfile")
-        open("vercel.json", "w").write(vercel_json_content)
+        target=generate_dir,
+    ) as stager:
+        click.echo(stager.summary(), err=True)
         extras = []
         if template_dir:
             extras.append('template_dir="templates"')
@@ -259,26 +1190,199 @@ def _publish_vercel(
 
         statics = [item[0] for item in static]
 
-        open("index.py", "w").write(
-            INDEX_PY.format(
-                database_files=json.dumps([os.path.split(f)[-1] for f in files]),
-                extras=", {}".format(", ".join(extras)) if extras else "",
-                statics=json.dumps(statics),
-                settings=json.dumps(dict(settings) or {}),
-                crossdb=",\n    crossdb=True" if crossdb else "",
+        if fts_tables:
+            run_fts(fts_tables)
+        summarised_databases = []
+        if facet_summaries or facet_columns:
+            if facet_summaries and os.path.exists("metadata.json"):
+                configured = json.load(open("metadata.json"))
+                for database_file in database_files:
+                    for facet in metadata_facets(
+                        configured, pathlib.Path(database_file).stem
+                    ):
+                        if facet not in facet_columns.get(database_file, []):
+                            facet_columns.setdefault(database_file, []).append(facet)
+            if facet_columns:
+                summarised_databases = run_facet_summaries(
+                    facet_columns, facet_summary_limit(settings)
+                )
+            else:
+                click.echo("No column facets are configured in metadata", err=True)
+        if optimize:
+            for database_file in database_files:
+                try:
+                    result = optimize_database(database_file, page_size)
+                except sqlite3.DatabaseError as ex:
+                    raise click.ClickException(
+                        "Could not optimize {}: {}".format(database_file, ex)
+                    )
+                click.echo(format_report(result), err=True)
+        inspect_data = ""
+        if immutable:
+            inspect_results = write_inspect_data(database_files)
+            extras.append("inspect_data=inspect_data")
+            inspect_data = '\ninspect_data = json.load(open("inspect-data.json"))\n'
+        staged_metadata = {}
+        if os.path.exists("metadata.json"):
+            staged_metadata = json.load(open("metadata.json"))
+        if exports:
+            run_bulk_exports(
+                database_files, bulk_export_tables or None, staged_metadata
             )
-        )
+        if vercel_json_content is None:
+            downloads = None
+            if cdn_downloads:
+                downloads = cdn_downloads_for(
+                    database_files,
+                    {info["file"]: info["hash"] for info in inspect_results.values()},
+                    staged_metadata,
+                )
+                os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+                for database_file, filename in downloads.items():
+                    # A link to the staged file, so this costs no disk space
+                    stager.stage_file(
+                        database_file, os.path.join(DOWNLOADS_DIR, filename)
+                    )
+            vercel_json_content = vercel_json_for(downloads)
+        open("vercel.json", "w").write(vercel_json_content)
+
+        def datasette_py(entry_point_files):
+            remove_memory = ""
+            if split_functions and not entry_point_files:
+                # Datasette adds an empty _memory database if it has no others
+                remove_memory = '\nds.remove_database("_memory")'
+            return (
+                DATASETTE_PY.format(
+                    database_files=(
+                        "[],\n    immutables={}" if immutable else "{}"
+                    ).format(json.dumps(entry_point_files)),
+                    inspect_data=inspect_data,
+                    extras=", {}".format(", ".join(extras)) if extras else "",
+                    statics=json.dumps(statics),
+                    settings=json.dumps(dict(settings) or {}),
+                    crossdb=",\n    crossdb=True" if crossdb else "",
+                )
+                + remove_memory
+            )
+
+        # Runtime middleware to wrap around the app, innermost first
+        wrappers = []
+        # Runtime functions to call with the Datasette instance
+        setup = []
+        if query_cache:
+            setup.append(
+                ("install_query_cache", {"max_bytes": query_cache * 1024 * 1024})
+            )
+        if schema_snapshot:
+            write_schema_snapshot(datasette_py(database_files))
+            setup.append(("load_schema_snapshot", {}))
+        if summarised_databases:
+            setup.append(
+                (
+                    "install_facet_summaries",
+                    {
+                        "databases": summarised_databases,
+                        "limit": facet_summary_limit(settings),
+                    },
+                )
+            )
+        if mmap_size is not None:
+            setup.append(
+                ("set_connection_pragmas", {"mmap_size": mmap_size * 1024 * 1024})
+            )
+        if prewarm_tables:
+            write_warmup_plan(prewarm_tables)
+            setup.append(("start_warmup", {}))
+        if prerender or prerender_paths or split_functions:
+            run_prerender(
+                datasette_py(database_files),
+                prerender_paths or (None if prerender else []),
+                extra_paths=SHARED_FUNCTION_PAGES if split_functions else (),
+            )
+            wrappers.append(("PrerenderedApp", {}))
         datasette_install = "datasette"
         if branch:
             datasette_install = (
                 "https://github.com/simonw/datasette/archive/{}.zip".format(branch)
             )
-        open("requirements.txt", "w").write(
-            "\n".join([datasette_install, "pysqlite3-binary"] + list(install))
-        )
+        requirements = [datasette_install, "pysqlite3-binary"] + list(install)
+        if pin_requirements:
+            pinned, unresolved = pinned_requirements(requirements)
+            for requirement in unresolved:
+                click.echo(
+                    "Could not pin {} to a locally installed version".format(
+                        requirement
+                    ),
+                    err=True,
+                )
+            requirements = unresolved + pinned
+        if etag:
+            # Outside PrerenderedApp so prerendered pages get ETags too
+            wrappers.append(
+                (
+                    "ETagApp",
+                    {
+                        "content_hash": content_hash(
+                            directory_manifest("."),
+                            datasette_py(database_files),
+                            requirements,
+                            setup,
+                        )
+                    },
+                )
+            )
+        if compress:
+            compress_options = {}
+            if compress_min_size is not None:
+                compress_options["minimum_size"] = compress_min_size
+            if compress_types:
+                compress_options["content_types"] = list(compress_types)
+            wrappers.append(("CompressedApp", compress_options))
+        if instrument:
+            # Outermost, so timings cover every other wrapper
+            wrappers.append(("InstrumentedApp", {}))
+
+        for entry_point, entry_point_files in entry_points(
+            database_files, split_functions
+        ):
+            open(entry_point, "w").write(
+                generate_index_py(
+                    datasette_py(entry_point_files), lazy, wrappers, setup
+                )
+            )
+        if lazy or wrappers or setup:
+            shutil.copyfile(
+                pathlib.Path(__file__).parent / "runtime.py",
+                RUNTIME_MODULE + ".py",
+            )
+        open("requirements.txt", "w").write("\n".join(requirements))
+        if sync_to:
+            click.echo(
+                format_sync_report(sync_directory(".", sync_to, previous_files or ())),
+                err=True,
+            )
+        if generate_dir:
+            write_generated_manifest(generate_dir, generated_files("."))
+        if analyze:
+            report = analyze_bundle(
+                ".",
+                json.loads(vercel_json_content),
+                requirements,
+                statics,
+                limit=size_limit * 1024 * 1024,
+            )
+            if analyze_json:
+                click.echo(json.dumps(report, indent=2))
+            else:
+                click.echo(format_analysis(report))
+            if report["over_limit"]:
+                raise click.ClickException(
+                    "Over the {} MB size limit: {}".format(
+                        size_limit, ", ".join(report["over_limit"])
+                    )
+                )
+            return
         if generate_dir:
-            # Copy these to the specified directory
-            shutil.copytree(".", generate_dir)
             click.echo(
                 "Your generated application files have been written to:", err=True
             )
@@ -286,25 +1390,196 @@ def _publish_vercel(
             click.echo("To deploy using Vercel, run the following:")
             click.echo("    cd {}".format(generate_dir), err=True)
             click.echo("    vercel --prod".format(generate_dir), err=True)
+            return
+        deploy_options = dict(
+            token=token,
+            no_prod=no_prod,
+            public=public,
+            debug=debug,
+            api=api,
+            secret=secret,
+            state_file=state_file,
+            force=force,
+        )
+        if len(targets) == 1:
+            result = deploy_target(".", project, scope, **deploy_options)
+            if state_file and result["status"] == "deployed":
+                record_manifest(state_file, result["key"], result["manifest"])
         else:
-            # Run the deploy with Vercel
-            cmd = ["vercel", "--confirm"]
-            if debug:
-                cmd.append("--debug")
-            if not no_prod:
-                cmd.append("--prod")
-            if public:
-                cmd.append("--public")
-            if token:
-                cmd.extend(["--token", token])
-            if scope:
-                cmd.extend(["--scope", scope])
-            # Add the secret
-            cmd.extend(["--env", "DATASETTE_SECRET={}".format(secret)])
-            try:
+            deploy_targets(
+                targets, vercel_json_content, deploy_workers, **deploy_options
+            )
+
+
+def deploy_target(
+    directory,
+    project,
+    scope,
+    token,
+    no_prod,
+    public,
+    debug,
+    api,
+    secret,
+    state_file,
+    force,
+    capture=False,
+):
+    """
+    Deploy the application in directory to a single project.
+
+    With capture=True nothing is written to the terminal, so that several of
+    these can run at once. Returns a dictionary describing the outcome.
+    """
+    start = time.perf_counter()
+    result = {"project": project, "scope": scope, "url": None, "manifest": None}
+    if state_file:
+        result["manifest"] = directory_manifest(directory)
+        result["key"] = state_key(project, scope, not no_prod)
+        if (
+            not force
+            and previous_manifest(state_file, result["key"]) == result["manifest"]
+        ):
+            if not capture:
+                click.echo(
+                    "No changes since the last deploy of {} recorded in {}, "
+                    "skipping deploy - use --force to deploy anyway".format(
+                        project, state_file
+                    ),
+                    err=True,
+                )
+            return dict(result, status="skipped", duration=0)
+    if api:
+        client = VercelClient(token, scope=scope)
+        try:
+            deployment, uploaded = client.deploy(
+                directory,
+                project,
+                production=not no_prod,
+                public=public,
+                env={"DATASETTE_SECRET": secret},
+                files=result["manifest"],
+            )
+        except (VercelApiError, httpx.HTTPError) as ex:
+            raise click.ClickException(str(ex))
+        result["url"] = "https://{}".format(deployment["url"])
+        if not capture:
+            click.echo(
+                "Uploaded {} changed file{} ({} bytes) in {:.2f}s".format(
+                    len(uploaded),
+                    "" if len(uploaded) == 1 else "s",
+                    sum(item["size"] for item in uploaded),
+                    time.perf_counter() - start,
+                ),
+                err=True,
+            )
+            click.echo(result["url"])
+    else:
+        # Run the deploy with Vercel
+        cmd = ["vercel", "--confirm"]
+        if debug:
+            cmd.append("--debug")
+        if not no_prod:
+            cmd.append("--prod")
+        if public:
+            cmd.append("--public")
+        if token:
+            cmd.extend(["--token", token])
+        if scope:
+            cmd.extend(["--scope", scope])
+        # Add the secret
+        cmd.extend(["--env", "DATASETTE_SECRET={}".format(secret)])
+        try:
+            if capture:
+                output = run(
+                    cmd, check=True, cwd=directory, capture_output=True, text=True
+                )
+                # The Vercel CLI prints the deployment URL last
+                lines = (output.stdout or "").strip().split("\n")
+                result["url"] = lines[-1] or None
+            else:
                 run(cmd, check=True)
-            except CalledProcessError as ex:
-                raise click.ClickException(str(ex))
+        except CalledProcessError as ex:
+            if capture and ex.stderr:
+                raise click.ClickException(ex.stderr.strip().split("\n")[-1])
+            raise click.ClickException(str(ex))
+    return dict(result, status="deployed", duration=time.perf_counter() - start)
+
+
+def deploy_targets(targets, vercel_json_content, workers, **deploy_options):
+    """
+    Deploy the application in the current directory to several (project,
+    scope) targets at once, each from its own linked copy of the directory
+    with the project name in vercel.json. Reports the result of each.
+    """
+    staged = os.getcwd()
+    parent = os.path.join(os.path.dirname(staged), "targets")
+    directories = []
+    for project, scope in targets:
+        directory = os.path.join(parent, scope or "_", project)
+        Stager().stage_directory(staged, directory)
+        target_vercel_json = json.loads(vercel_json_content)
+        if "name" in target_vercel_json:
+            target_vercel_json["name"] = project
+        # Replace rather than write to the file, which is a link
+        os.remove(os.path.join(directory, "vercel.json"))
+        with open(os.path.join(directory, "vercel.json"), "w") as fp:
+            fp.write(json.dumps(target_vercel_json, indent=4))
+        directories.append(directory)
+
+    def deploy(args):
+        directory, (project, scope) = args
+        start = time.perf_counter()
+        try:
+            return deploy_target(
+                directory, project, scope, capture=True, **deploy_options
+            )
+        except click.ClickException as ex:
+            return {
+                "project": project,
+                "scope": scope,
+                "status": "failed",
+                "error": ex.message,
+                "duration": time.perf_counter() - start,
+            }
+
+    workers = min(workers, len(targets))
+    click.echo(
+        "Deploying to {} projects, {} at a time".format(len(targets), workers),
+        err=True,
+    )
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(deploy, zip(directories, targets)))
+    failed = []
+    for result in results:
+        name = result["project"]
+        if result["scope"]:
+            name = "{}/{}".format(result["scope"], name)
+        if result["status"] == "deployed":
+            message = "deployed in {:.2f}s".format(result["duration"])
+            if result["url"]:
+                message += ": {}".format(result["url"])
+            if deploy_options["state_file"]:
+                record_manifest(
+                    deploy_options["state_file"], result["key"], result["manifest"]
+                )
+        elif result["status"] == "skipped":
+            message = "skipped, no changes since the last deploy"
+        else:
+            message = "FAILED after {:.2f}s: {}".format(
+                result["duration"], result["error"]
+            )
+            failed.append(name)
+        click.echo("{}: {}".format(name, message), err=True)
+    click.echo(
+        "Finished {} deploys in {:.2f}s".format(
+            len(results), time.perf_counter() - start
+        ),
+        err=True,
+    )
+    if failed:
+        raise click.ClickException("Deploys failed for: {}".format(", ".join(failed)))
 
 
 @hookimpl
@@ -0,0 +1,176 @@
+from .requirements import dependency_closure, requirement_name
+import fnmatch
+import os
+import re
+
+# Vercel's limit for the uncompressed size of a serverless function
+DEFAULT_SIZE_LIMIT_MB = 250
+
+
+def format_size(size):
+    for unit in ("bytes", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            break
+        size /= 1024
+    if unit == "bytes":
+        return "{:,} bytes".format(size)
+    return "{:,.1f} {}".format(size, unit)
+
+
+def installed_size(dist):
+    total = 0
+    for file in dist.files or []:
+        if file.size is not None:
+            total += file.size
+        else:
+            try:
+                total += os.path.getsize(file.locate())
+            except OSError:
+                pass
+    return total
+
+
+def package_sizes(requirements):
+    """
+    Estimated installed size of each package needed by requirements, from
+    the copies installed in the local environment.
+
+    Returns a list of {"name", "version", "size"} dictionaries, with version
+    and size set to None for packages that are not installed locally.
+    """
+    names = [requirement_name(r) for r in requirements]
+    closure = dependency_closure([name for name in names if name])
+    return [
+        {
+            "name": name,
+            "version": dist.version if dist else None,
+            "size": installed_size(dist) if dist else None,
+        }
+        for name, dist in sorted(closure.items())
+    ]
+
+
+def category_for(path, statics=()):
+    top = path.split("/")[0]
+    if top == "templates":
+        return "templates"
+    if top == "plugins":
+        return "plugins"
+    if top in statics:
+        return "static"
+    if top in ("downloads", "exports"):
+        # Served by @vercel/static builds, not the function
+        return "static outputs"
+    if top == "prerendered":
+        return "prerendered"
+    if path.endswith((".db", ".sqlite", ".sqlite3")) and "/" not in path:
+        return "databases"
+    return "application"
+
+
+def _excluded(path, exclude_files):
+    if not exclude_files:
+        return False
+    # excludeFiles is a glob, with {a,b} alternatives
+    patterns = [exclude_files]
+    match = re.match(r"^\{(.*)\}$", exclude_files)
+    if match:
+        patterns = match.group(1).split(",")
+    for pattern in patterns:
+        if fnmatch.fnmatch(path, pattern.replace("/**", "/*")):
+            return True
+    return False
+
+
+def analyze_bundle(directory, vercel_json, requirements, statics=(), limit=None):
+    """
+    Size report for a staged bundle: every file by category, and the total
+    for each serverless function in vercel_json - the files it bundles plus
+    the estimated installed size of requirements.
+    """
+    files = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            full_path = os.path.join(root, filename)
+            path = os.path.relpath(full_path, directory).replace(os.sep, "/")
+            files.append(
+                {
+                    "path": path,
+                    "size": os.path.getsize(full_path),
+                    "category": category_for(path, statics),
+                }
+            )
+    files.sort(key=lambda f: (-f["size"], f["path"]))
+    packages = package_sizes(requirements)
+    packages_size = sum(p["size"] or 0 for p in packages)
+    categories = {}
+    for file in files:
+        categories[file["category"]] = (
+            categories.get(file["category"], 0) + file["size"]
+        )
+    categories["packages"] = packages_size
+    functions = {}
+    for build in vercel_json.get("builds") or []:
+        if not build.get("use", "").startswith("@vercel/python"):
+            continue
+        exclude_files = (build.get("config") or {}).get("excludeFiles")
+        included = [f for f in files if not _excluded(f["path"], exclude_files)]
+        functions[build["src"]] = {
+            "files": sum(f["size"] for f in included),
+            "packages": packages_size,
+            "total": sum(f["size"] for f in included) + packages_size,
+            "largest": [{"name": f["path"], "size": f["size"]} for f in included[:5]],
+        }
+    largest = sorted(
+        [{"name": f["path"], "size": f["size"]} for f in files]
+        + [
+            {"name": "package: " + p["name"], "size": p["size"]}
+            for p in packages
+            if p["size"]
+        ],
+        key=lambda item: -item["size"],
+    )[:10]
+    return {
+        "files": files,
+        "packages": packages,
+        "categories": categories,
+        "functions": functions,
+        "largest": largest,
+        "limit": limit,
+        "over_limit": sorted(
+            name
+            for name, function in functions.items()
+            if limit is not None and function["total"] > limit
+        ),
+    }
+
+
+def format_analysis(report):
+    lines = ["Size by category:"]
+    for category, size in sorted(report["categories"].items()):
+        lines.append("  {:<18} {:>12}".format(category, format_size(size)))
+    missing = [p["name"] for p in report["packages"] if p["size"] is None]
+    if missing:
+        lines.append(
+            "  (not installed locally, so not counted: {})".format(", ".join(missing))
+        )
+    lines.append("")
+    lines.append("Largest contributors:")
+    for item in report["largest"]:
+        lines.append("  {:>12}  {}".format(format_size(item["size"]), item["name"]))
+    lines.append("")
+    for name, function in sorted(report["functions"].items()):
+        line = "Function {}: {} ({} of files, {} of packages)".format(
+            name,
+            format_size(function["total"]),
+            format_size(function["files"]),
+            format_size(function["packages"]),
+        )
+        if report["limit"] is not None:
+            line += " - {:.0%} of the {} limit".format(
+                function["total"] / report["limit"], format_size(report["limit"])
+            )
+            if name in report["over_limit"]:
+                line += ", OVER LIMIT"
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,226 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import hashlib
+import httpx
+import json
+import os
+import pathlib
+
+DEFAULT_API_URL = "https://api.vercel.com"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class VercelApiError(Exception):
+    pass
+
+
+# (path, inode, size, mtime) -> sha1, so unchanged files are only read once
+_sha1_cache = {}
+
+
+def file_sha1(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if key in _sha1_cache:
+        return _sha1_cache[key]
+    m = hashlib.sha1()
+    with open(path, "rb") as fp:
+        while True:
+            data = fp.read(HASH_BLOCK_SIZE)
+            if not data:
+                break
+            m.update(data)
+    _sha1_cache[key] = m.hexdigest()
+    return _sha1_cache[key]
+
+
+def directory_manifest(directory):
+    "Return a sorted list of {file, sha, size} dictionaries for every file in directory"
+    directory = pathlib.Path(directory)
+    manifest = []
+    for root, dirs, filenames in os.walk(directory, followlinks=True):
+        dirs.sort()
+        for filename in sorted(filenames):
+            path = pathlib.Path(root) / filename
+            manifest.append(
+                {
+                    "file": path.relative_to(directory).as_posix(),
+                    "sha": file_sha1(path),
+                    "size": path.stat().st_size,
+                }
+            )
+    return manifest
+
+
+class VercelClient:
+    """
+    Minimal client for the Vercel deployments API.
+
+    Files are identified by their SHA1 digest: a deployment is created from a
+    manifest of digests, and only the files the server reports as missing are
+    uploaded.
+    """
+
+    def __init__(self, token, base_url=DEFAULT_API_URL, scope=None, max_workers=8):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.scope = scope
+        self.max_workers = max_workers
+
+    def _params(self):
+        return {"slug": self.scope} if self.scope else {}
+
+    def _headers(self, extra=None):
+        headers = {"Authorization": "Bearer {}".format(self.token)}
+        headers.update(extra or {})
+        return headers
+
+    def upload_file(self, path, sha, size):
+        def read_chunks():
+            with open(path, "rb") as fp:
+                while True:
+                    data = fp.read(HASH_BLOCK_SIZE)
+                    if not data:
+                        break
+                    yield data
+
+        response = httpx.post(
+            self.base_url + "/v2/files",
+            params=self._params(),
+            headers=self._headers(
+                {
+                    "Content-Type": "application/octet-stream",
+                    "Content-Length": str(size),
+                    "x-vercel-digest": sha,
+                }
+            ),
+            content=read_chunks(),
+            timeout=None,
+        )
+        if response.status_code >= 400:
+            raise VercelApiError(
+                "Upload of {} failed: {} {}".format(
+                    path, response.status_code, response.text
+                )
+            )
+
+    def upload_files(self, directory, files):
+        "Upload files (manifest entries) from directory using a bounded thread pool"
+        directory = pathlib.Path(directory)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(
+                    self.upload_file,
+                    directory / item["file"],
+                    item["sha"],
+                    item["size"],
+                )
+                for item in files
+            ]
+            for future in futures:
+                # Re-raises the first upload error, if any
+                future.result()
+
+    def create_deployment(self, name, files, production=True, public=False, env=None):
+        """
+        Create a deployment from a file manifest.
+
+        Returns (deployment, missing) - if the server does not yet have some
+        of the files, deployment is None and missing is a list of their SHAs.
+        """
+        body = {
+            "name": name,
+            "files": files,
+            "public": public,
+            "projectSettings": {"framework": None},
+        }
+        if production:
+            body["target"] = "production"
+        if env:
+            body["env"] = env
+        response = httpx.post(
+            self.base_url + "/v13/deployments",
+            params=self._params(),
+            headers=self._headers(),
+            json=body,
+            timeout=60,
+        )
+        if response.status_code >= 400:
+            try:
+                error = response.json().get("error") or {}
+            except (ValueError, AttributeError):
+                # Not a JSON error object, e.g. an HTML page from a gateway
+                error = {}
+            if error.get("code") == "missing_files":
+                return None, error.get("missing") or []
+            raise VercelApiError(
+                "Deployment failed: {}".format(error.get("message") or response.text)
+            )
+        try:
+            return response.json(), []
+        except ValueError:
+            raise VercelApiError("Deployment failed: {}".format(response.text))
+
+    def deploy(
+        self, directory, name, production=True, public=False, env=None, files=None
+    ):
+        """
+        Deploy every file in directory, uploading only the ones the server
+        does not already have. files can be a directory_manifest() that has
+        already been calculated for that directory.
+
+        Returns (deployment, uploaded) where uploaded is the list of manifest
+        entries that had to be sent.
+        """
+        if files is None:
+            files = directory_manifest(directory)
+        deployment, missing = self.create_deployment(
+            name, files, production=production, public=public, env=env
+        )
+        uploaded = []
+        if missing:
+            missing = set(missing)
+            # Identical files (e.g. a hard-linked copy) only need uploading once
+            seen = set()
+            for item in files:
+                if item["sha"] in missing and item["sha"] not in seen:
+                    seen.add(item["sha"])
+                    uploaded.append(item)
+            self.upload_files(directory, uploaded)
+            deployment, missing = self.create_deployment(
+                name, files, production=production, public=public, env=env
+            )
+            if missing:
+                raise VercelApiError(
+                    "Server still reports {} missing files after upload".format(
+                        len(missing)
+                    )
+                )
+        return deployment, uploaded
+
+
+def state_key(project, scope=None, production=True):
+    return "{}/{}{}".format(scope or "", project, "" if production else ":preview")
+
+
+def read_state(state_file):
+    try:
+        with open(state_file) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+def previous_manifest(state_file, key):
+    "The manifest recorded for key by the last successful deploy, or None"
+    return read_state(state_file).get(key, {}).get("manifest")
+
+
+def record_manifest(state_file, key, manifest):
+    state = read_state(state_file)
+    state[key] = {
+        "manifest": manifest,
+        "deployed": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    with open(state_file, "w") as fp:
+        fp.write(json.dumps(state, indent=2))
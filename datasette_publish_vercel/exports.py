@@ -0,0 +1,189 @@
+from concurrent.futures import ThreadPoolExecutor
+from datasette.utils import sqlite3, tilde_encode
+import base64
+import csv
+import gzip
+import io
+import json
+import os
+import pathlib
+import time
+
+EXPORTS_DIR = "exports"
+BATCH_SIZE = 1000
+
+# Shadow tables created by the FTS3/4, FTS5 and R*Tree virtual table modules,
+# for SQLite versions without pragma table_list
+SHADOW_TABLE_SUFFIXES = (
+    "content",
+    "segments",
+    "segdir",
+    "docsize",
+    "stat",
+    "data",
+    "idx",
+    "config",
+    "node",
+    "parent",
+    "rowid",
+)
+
+
+def _shadow_tables(conn, rows):
+    try:
+        # SQLite 3.37 and later know exactly which tables are shadow tables
+        return {
+            row[1]
+            for row in conn.execute("pragma table_list")
+            if row[0] == "main" and row[2] == "shadow"
+        }
+    except sqlite3.OperationalError:
+        pass
+    virtual = [
+        name for name, sql in rows if (sql or "").lower().startswith("create virtual")
+    ]
+    return {
+        "{}_{}".format(name, suffix)
+        for name in virtual
+        for suffix in SHADOW_TABLE_SUFFIXES
+    }
+
+
+def exportable_tables(path):
+    "Table names in the database, excluding SQLite and virtual table internals"
+    conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        rows = conn.execute(
+            "select name, sql from sqlite_master where type = 'table' "
+            "and name not like 'sqlite_%' order by name"
+        ).fetchall()
+        shadow = _shadow_tables(conn, rows)
+    finally:
+        conn.close()
+    return [
+        name
+        for name, sql in rows
+        if name not in shadow and not (sql or "").lower().startswith("create virtual")
+    ]
+
+
+def export_paths(database, table, directory=EXPORTS_DIR):
+    base = pathlib.Path(directory) / tilde_encode(database) / tilde_encode(table)
+    return {
+        "csv": str(base) + ".csv.gz",
+        "ndjson": str(base) + ".ndjson.gz",
+    }
+
+
+def _json_value(value):
+    if isinstance(value, bytes):
+        # The same representation Datasette's JSON API uses for binary data
+        return {"$base64": True, "encoded": base64.b64encode(value).decode("latin-1")}
+    return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("latin-1")
+    return value
+
+
+def _gzip_text(path):
+    # mtime=0 so unchanged data produces byte-identical files
+    return io.TextIOWrapper(
+        gzip.GzipFile(path, "wb", mtime=0), encoding="utf-8", newline=""
+    )
+
+
+def export_table(path, table, directory=EXPORTS_DIR):
+    """
+    Write table from the database at path to gzipped CSV and newline-delimited
+    JSON files in directory, in a single pass over the rows that only holds
+    BATCH_SIZE rows in memory at a time.
+
+    Returns a dictionary describing the files written.
+    """
+    start = time.perf_counter()
+    database = pathlib.Path(path).stem
+    paths = export_paths(database, table, directory)
+    os.makedirs(os.path.dirname(paths["csv"]), exist_ok=True)
+    conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    rows = 0
+    try:
+        cursor = conn.execute("select * from [{}]".format(table.replace("]", "]]")))
+        columns = [d[0] for d in cursor.description]
+        with _gzip_text(paths["csv"]) as csv_fp, _gzip_text(
+            paths["ndjson"]
+        ) as ndjson_fp:
+            writer = csv.writer(csv_fp)
+            writer.writerow(columns)
+            while True:
+                batch = cursor.fetchmany(BATCH_SIZE)
+                if not batch:
+                    break
+                rows += len(batch)
+                writer.writerows([_csv_value(v) for v in row] for row in batch)
+                ndjson_fp.write(
+                    "".join(
+                        json.dumps(
+                            dict(zip(columns, map(_json_value, row))), default=repr
+                        )
+                        + "\n"
+                        for row in batch
+                    )
+                )
+    finally:
+        conn.close()
+    return {
+        "database": database,
+        "table": table,
+        "rows": rows,
+        "files": {
+            format: {"path": p, "size": os.path.getsize(p)}
+            for format, p in paths.items()
+        },
+        "duration": time.perf_counter() - start,
+    }
+
+
+def export_tables(jobs, directory=EXPORTS_DIR, max_workers=None):
+    """
+    Export a list of (database path, table) pairs in parallel - SQLite and
+    zlib both release the GIL, so threads are enough.
+
+    Also writes an index.json to directory listing every export. Returns the
+    list of results from export_table(), in the order of jobs.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(
+            executor.map(lambda job: export_table(job[0], job[1], directory), jobs)
+        )
+    index = {}
+    for result in results:
+        index.setdefault(result["database"], {})[result["table"]] = {
+            "rows": result["rows"],
+            **{
+                format: {
+                    "url": "/" + pathlib.Path(info["path"]).as_posix(),
+                    "size": info["size"],
+                }
+                for format, info in result["files"].items()
+            },
+        }
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "index.json"), "w") as fp:
+        fp.write(json.dumps(index, indent=2, sort_keys=True))
+    return results
+
+
+def format_export_report(result):
+    return "Exported {}/{}: {:,} rows, {:,} bytes CSV, {:,} bytes NDJSON in {:.2f}s".format(
+        result["database"],
+        result["table"],
+        result["rows"],
+        result["files"]["csv"]["size"],
+        result["files"]["ndjson"]["size"],
+        result["duration"],
+    )
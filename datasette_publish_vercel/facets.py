@@ -0,0 +1,139 @@
+from .staging import unshare_file
+from datasette.utils import escape_sqlite, sqlite3
+import time
+
+SUMMARY_TABLE = "_facet_summaries"
+
+
+def parse_facet_index(value):
+    "Parse a --facet-index database:table:column value"
+    parts = value.split(":")
+    if len(parts) != 3 or not all(parts):
+        raise ValueError("--facet-index must be database:table:column")
+    return tuple(parts)
+
+
+def metadata_facets(metadata, database):
+    """
+    (table, column) pairs for the column facets configured for tables in
+    database in metadata - other facet types cannot be summarised
+    """
+    tables = ((metadata.get("databases") or {}).get(database) or {}).get("tables")
+    facets = []
+    for table, table_metadata in (tables or {}).items():
+        for facet in (table_metadata or {}).get("facets") or []:
+            if isinstance(facet, dict):
+                facet = facet.get("column")
+            if isinstance(facet, str) and (table, facet) not in facets:
+                facets.append((table, facet))
+    return facets
+
+
+def _indexed_columns(conn, table):
+    """
+    Columns that are the first column of an existing index on table, or a
+    single column primary key - which is either indexed or the rowid
+    """
+    columns = set()
+    primary_keys = [
+        row[1]
+        for row in conn.execute("pragma table_info({})".format(escape_sqlite(table)))
+        if row[5]
+    ]
+    if len(primary_keys) == 1:
+        columns.add(primary_keys[0])
+    for index in conn.execute("pragma index_list({})".format(escape_sqlite(table))):
+        info = conn.execute(
+            "pragma index_info({})".format(escape_sqlite(index[1]))
+        ).fetchall()
+        if info:
+            columns.add(info[0][2])
+    return columns
+
+
+def build_facet_summaries(path, facets, limit):
+    """
+    Add an index on each faceted column to a staged database file, and store
+    the counts of the top limit values of each column in SUMMARY_TABLE - in
+    the order Datasette lists facet values.
+
+    facets is a list of (table, column) pairs. The file is modified in
+    place, after unshare_file().
+
+    Returns a dictionary describing the indexes and summaries created.
+    """
+    start = time.perf_counter()
+    unshare_file(path)
+    indexes = []
+    summaries = []
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("pragma journal_mode = delete")
+        conn.execute("drop table if exists {}".format(SUMMARY_TABLE))
+        conn.execute(
+            "create table {} (table_name text, column_name text, "
+            "position integer, value, count integer, "
+            "primary key (table_name, column_name, position))".format(SUMMARY_TABLE)
+        )
+        for table, column in facets:
+            columns = [
+                row[1]
+                for row in conn.execute(
+                    "pragma table_info({})".format(escape_sqlite(table))
+                )
+            ]
+            if not columns:
+                raise ValueError("Table not found: {}".format(table))
+            if column not in columns:
+                raise ValueError("Table {} has no column: {}".format(table, column))
+            if column not in _indexed_columns(conn, table):
+                index = "idx_{}_{}".format(table, column)
+                conn.execute(
+                    "create index if not exists {} on {} ({})".format(
+                        escape_sqlite(index),
+                        escape_sqlite(table),
+                        escape_sqlite(column),
+                    )
+                )
+                indexes.append(index)
+            # The same query Datasette runs for an unfiltered column facet
+            rows = conn.execute(
+                "select {column} as value, count(*) as count from {table} "
+                "where {column} is not null group by {column} "
+                "order by count desc, value limit {limit}".format(
+                    column=escape_sqlite(column),
+                    table=escape_sqlite(table),
+                    limit=int(limit),
+                )
+            ).fetchall()
+            conn.executemany(
+                "insert into {} values (?, ?, ?, ?, ?)".format(SUMMARY_TABLE),
+                [
+                    (table, column, position, value, count)
+                    for position, (value, count) in enumerate(rows)
+                ],
+            )
+            summaries.append({"table": table, "column": column, "values": len(rows)})
+        conn.commit()
+    finally:
+        conn.close()
+    return {
+        "path": path,
+        "indexes": indexes,
+        "summaries": summaries,
+        "duration": time.perf_counter() - start,
+    }
+
+
+def format_facet_report(result):
+    return (
+        "{}: summarised {} facet{} ({:,} values), created {} index{} in {:.2f}s".format(
+            result["path"],
+            len(result["summaries"]),
+            "" if len(result["summaries"]) == 1 else "s",
+            sum(summary["values"] for summary in result["summaries"]),
+            len(result["indexes"]),
+            "" if len(result["indexes"]) == 1 else "es",
+            result["duration"],
+        )
+    )
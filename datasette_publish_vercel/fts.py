@@ -0,0 +1,123 @@
+from .staging import unshare_file
+from datasette.utils import escape_sqlite, sqlite3
+import time
+
+BATCH_SIZE = 10000
+
+
+def parse_fts(value):
+    "Parse a --fts database:table:col1,col2 value into (database, table, columns)"
+    parts = value.split(":")
+    if len(parts) != 3 or not all(parts):
+        raise ValueError("--fts must be database:table:column1,column2")
+    database, table, columns = parts
+    columns = [column.strip() for column in columns.split(",") if column.strip()]
+    if not columns:
+        raise ValueError("--fts must be database:table:column1,column2")
+    return database, table, columns
+
+
+def fts_table_name(table):
+    # The naming convention used by sqlite-utils, which Datasette users expect
+    return "{}_fts".format(table)
+
+
+def _add_fts(conn, table, columns):
+    start = time.perf_counter()
+    table_columns = [
+        row[1]
+        for row in conn.execute("pragma table_info({})".format(escape_sqlite(table)))
+    ]
+    if not table_columns:
+        raise ValueError("Table not found: {}".format(table))
+    missing = [column for column in columns if column not in table_columns]
+    if missing:
+        raise ValueError("Table {} has no column: {}".format(table, ", ".join(missing)))
+    try:
+        conn.execute("select rowid from {} limit 0".format(escape_sqlite(table)))
+    except sqlite3.OperationalError:
+        raise ValueError("Table {} is a WITHOUT ROWID table".format(table))
+    fts_table = fts_table_name(table)
+    if conn.execute(
+        "select 1 from sqlite_master where name = ?", [fts_table]
+    ).fetchone():
+        raise ValueError("Table {} already exists".format(fts_table))
+    column_list = ", ".join(escape_sqlite(column) for column in columns)
+    # External content: the index refers to the rows in table instead of
+    # storing a second copy of the text
+    conn.execute(
+        "create virtual table {} using fts5 ({}, content={})".format(
+            escape_sqlite(fts_table), column_list, escape_sqlite(table)
+        )
+    )
+    # Rows are copied in batches of rowids, so memory use does not grow with
+    # the size of the table
+    boundary_sql = (
+        "select max(rowid), count(*) from (select rowid from {table} "
+        "where rowid > ? order by rowid limit {limit})"
+    ).format(table=escape_sqlite(table), limit=BATCH_SIZE)
+    insert_sql = (
+        "insert into {fts} (rowid, {columns}) select rowid, {columns} from {table} "
+        "where rowid > ? and rowid <= ?"
+    ).format(
+        fts=escape_sqlite(fts_table), columns=column_list, table=escape_sqlite(table)
+    )
+    rows = 0
+    first_rowid = conn.execute(
+        "select min(rowid) from {}".format(escape_sqlite(table))
+    ).fetchone()[0]
+    last_rowid = None if first_rowid is None else first_rowid - 1
+    while last_rowid is not None:
+        boundary, count = conn.execute(boundary_sql, [last_rowid]).fetchone()
+        if not count:
+            break
+        conn.execute(insert_sql, [last_rowid, boundary])
+        conn.commit()
+        rows += count
+        last_rowid = boundary
+    conn.execute(
+        "insert into {fts} ({fts}) values ('optimize')".format(
+            fts=escape_sqlite(fts_table)
+        )
+    )
+    conn.commit()
+    return {
+        "table": table,
+        "fts_table": fts_table,
+        "columns": columns,
+        "rows": rows,
+        "duration": time.perf_counter() - start,
+    }
+
+
+def build_fts(path, tables):
+    """
+    Add external-content FTS5 full-text indexes to a staged database file.
+
+    tables is a list of (table, columns) pairs. The file is modified in
+    place, after unshare_file().
+
+    Returns a dictionary describing the indexes built and the time taken.
+    """
+    unshare_file(path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("pragma journal_mode = delete")
+        indexes = [_add_fts(conn, table, columns) for table, columns in tables]
+    finally:
+        conn.close()
+    return {"path": path, "indexes": indexes}
+
+
+def format_fts_report(result):
+    return "\n".join(
+        "{}: indexed {:,} rows of {} ({}) in {} in {:.2f}s".format(
+            result["path"],
+            index["rows"],
+            index["table"],
+            ", ".join(index["columns"]),
+            index["fts_table"],
+            index["duration"],
+        )
+        for index in result["indexes"]
+    )
@@ -0,0 +1,120 @@
+from datasette.utils import sqlite3
+import os
+import time
+
+VALID_PAGE_SIZES = [2**i for i in range(9, 17)]
+
+
+def optimize_database(path, page_size=None):
+    """
+    Optimize a staged database file for read-only serving.
+
+    The database is written to a fresh file with VACUUM INTO, optionally
+    rebuilt with a different page_size, then ANALYZE and PRAGMA optimize are
+    run against it. The new file then replaces path, so a staged link to the
+    user's original is never written through.
+
+    Returns a dictionary describing the sizes and time taken.
+    """
+    start = time.perf_counter()
+    size_before = os.path.getsize(path)
+    tmp_path = path + ".optimize-tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    source = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        source.execute("vacuum into ?", [tmp_path])
+    finally:
+        source.close()
+    conn = sqlite3.connect(tmp_path, isolation_level=None)
+    try:
+        conn.execute("pragma journal_mode = delete")
+        if page_size and page_size != conn.execute("pragma page_size").fetchone()[0]:
+            conn.execute("pragma page_size = {}".format(int(page_size)))
+            conn.execute("vacuum")
+        conn.execute("analyze")
+        conn.execute("pragma optimize")
+        final_page_size = conn.execute("pragma page_size").fetchone()[0]
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    return {
+        "path": path,
+        "size_before": size_before,
+        "size_after": os.path.getsize(path),
+        "page_size": final_page_size,
+        "duration": time.perf_counter() - start,
+    }
+
+
+def format_report(result):
+    change = 0
+    if result["size_before"]:
+        change = (result["size_after"] - result["size_before"]) / result["size_before"]
+    return "{}: {:,} bytes -> {:,} bytes ({:+.1%}, page_size={}) in {:.2f}s".format(
+        result["path"],
+        result["size_before"],
+        result["size_after"],
+        change,
+        result["page_size"],
+        result["duration"],
+    )
+
+
+def _page_ranges(pages):
+    ranges = []
+    for page in sorted(pages):
+        if ranges and page == ranges[-1][1] + 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ranges
+
+
+def warmup_plan(path, tables=None):
+    """
+    Pages to pre-read for a database: every page if tables is None,
+    otherwise the pages of those tables and their indexes, found using the
+    dbstat virtual table. Falls back to every page if SQLite was compiled
+    without dbstat.
+
+    Returns {"page_size": ..., "objects": {name: [[first, last], ...]}} with
+    1-based page numbers.
+    """
+    conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        page_size = conn.execute("pragma page_size").fetchone()[0]
+        whole_file = {
+            "page_size": page_size,
+            "objects": {"*": [[1, conn.execute("pragma page_count").fetchone()[0]]]},
+        }
+        if tables is None:
+            return whole_file
+        names = []
+        for table in tables:
+            rows = conn.execute(
+                "select name from sqlite_master where tbl_name = ? "
+                "and type in ('table', 'index')",
+                [table],
+            ).fetchall()
+            if not rows:
+                raise ValueError("Table not found: {}".format(table))
+            names.extend(row[0] for row in rows)
+        try:
+            rows = conn.execute(
+                "select name, pageno from dbstat where name in ({})".format(
+                    ", ".join("?" for _ in names)
+                ),
+                names,
+            ).fetchall()
+        except sqlite3.OperationalError:
+            return whole_file
+    finally:
+        conn.close()
+    pages = {}
+    for name, pageno in rows:
+        pages.setdefault(name, []).append(pageno)
+    return {
+        "page_size": page_size,
+        "objects": {name: _page_ranges(numbers) for name, numbers in pages.items()},
+    }
@@ -0,0 +1,113 @@
+import asyncio
+import httpx
+import json
+import os
+import pathlib
+import re
+import time
+
+PRERENDER_DIR = "prerendered"
+# Headers that should not be replayed when serving a prerendered page - link
+# headers hold absolute URLs
+SKIP_HEADERS = {
+    "content-length",
+    "cache-control",
+    "date",
+    "server",
+    "set-cookie",
+    "link",
+}
+# Pages are rendered against this reserved host name, so the absolute URLs
+# Datasette generates can be found and made relative to the deployment
+RENDER_HOST = "datasette-prerender.invalid"
+ABSOLUTE_URL_RE = re.compile(rb"https?://" + re.escape(RENDER_HOST.encode()))
+# Query timings would make every publish produce different files
+QUERY_MS_JSON_RE = re.compile(rb'"query_ms": [0-9.eE+-]+')
+QUERY_MS_HTML_RE = re.compile(rb"\s*&middot; Queries took [0-9.]+ms")
+
+
+async def default_paths(ds):
+    "The index page, each database page and the first page of each table"
+    paths = [ds.urls.instance(), ds.urls.instance(format="json")]
+    for name, db in ds.databases.items():
+        if name == "_internal" or db.is_memory:
+            continue
+        paths.extend([ds.urls.database(name), ds.urls.database(name, format="json")])
+        hidden = set(await db.hidden_table_names())
+        for table in await db.table_names():
+            if table in hidden:
+                continue
+            paths.extend(
+                [
+                    ds.urls.table(name, table),
+                    ds.urls.table(name, table, format="json"),
+                ]
+            )
+    # Pages that need a query string cannot be served as files
+    return [str(path) for path in paths if "?" not in path]
+
+
+def normalize_page(body):
+    "Make absolute URLs relative and remove query timings from a rendered page"
+    body = ABSOLUTE_URL_RE.sub(b"", body)
+    body = QUERY_MS_JSON_RE.sub(b'"query_ms": 0', body)
+    return QUERY_MS_HTML_RE.sub(b"", body)
+
+
+def filename_for_path(path):
+    path = path.strip("/")
+    if not path:
+        return "index.html"
+    if "." in path.split("/")[-1]:
+        return path
+    return path + "/index.html"
+
+
+async def prerender(
+    ds, paths=None, directory=PRERENDER_DIR, concurrency=8, extra_paths=()
+):
+    """
+    Render pages through the Datasette instance and write them to directory,
+    along with a manifest.json mapping paths to files and content types.
+    extra_paths are rendered as well as paths, or the defaults.
+
+    Returns a list of (path, status, duration) tuples for each page.
+    """
+    if paths is None:
+        paths = await default_paths(ds)
+    paths = list(paths) + [path for path in extra_paths if path not in paths]
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+    manifest = {}
+    client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=ds.app()),
+        base_url="http://{}".format(RENDER_HOST),
+    )
+
+    async def render(path):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.get(path)
+            duration = time.perf_counter() - start
+        results.append((path, response.status_code, duration))
+        if response.status_code != 200:
+            return
+        filename = filename_for_path(path)
+        filepath = pathlib.Path(directory) / filename
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        filepath.write_bytes(normalize_page(response.content))
+        manifest[path] = {
+            "file": filename,
+            "headers": [
+                [name, value]
+                for name, value in response.headers.items()
+                if name not in SKIP_HEADERS
+            ],
+        }
+
+    async with client:
+        await asyncio.gather(*[render(path) for path in paths])
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "manifest.json"), "w") as fp:
+        fp.write(json.dumps(manifest, indent=2, sort_keys=True))
+    return sorted(results)
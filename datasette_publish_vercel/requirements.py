@@ -0,0 +1,118 @@
+import re
+
+requirement_name_re = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)")
+
+# Provided by the build image, and not needed by the function at runtime
+BUILD_TOOLS = {"pip", "setuptools", "wheel"}
+
+
+def requirement_name(requirement):
+    "Package name from a requirements.txt line, or None for URLs and options"
+    if "://" in requirement:
+        # e.g. a Datasette branch archive URL
+        match = re.search(r"github\.com/[^/]+/([^/]+)/", requirement)
+        return match.group(1) if match else None
+    match = requirement_name_re.match(requirement)
+    return match.group(1) if match else None
+
+
+def _distribution(name):
+    from importlib.metadata import PackageNotFoundError, distribution
+
+    try:
+        return distribution(name)
+    except PackageNotFoundError:
+        return None
+
+
+def dependency_closure(names):
+    """
+    Returns {name: distribution or None} for the named packages and
+    everything they depend on, as installed in the current environment.
+    Packages that are not installed locally map to None.
+    """
+    seen = {}
+    queue = list(names)
+    while queue:
+        name = queue.pop(0)
+        key = canonical_name(name)
+        if key in seen:
+            continue
+        dist = _distribution(name)
+        seen[key] = dist
+        if dist is None:
+            continue
+        queue.extend(dependencies(dist))
+    return seen
+
+
+def dependencies(dist):
+    "Names of the packages dist requires, skipping optional extras"
+    try:
+        from packaging.requirements import Requirement
+    except ImportError:
+        Requirement = None
+    for requirement in dist.requires or []:
+        if Requirement is not None:
+            parsed = Requirement(requirement)
+            # Markers are evaluated against the local Python
+            if parsed.marker is None or parsed.marker.evaluate({"extra": ""}):
+                yield parsed.name
+        elif "extra" not in requirement.partition(";")[2]:
+            # Without packaging, include everything except extras
+            name = requirement_name(requirement)
+            if name:
+                yield name
+
+
+def canonical_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _satisfied_by(requirement, dist):
+    try:
+        from packaging.requirements import InvalidRequirement, Requirement
+    except ImportError:
+        # Cannot check, so assume the installed version is the one wanted
+        return True
+    try:
+        specifier = Requirement(requirement).specifier
+    except InvalidRequirement:
+        return False
+    return specifier.contains(dist.version, prereleases=True)
+
+
+def pinned_requirements(requirements, exclude=BUILD_TOOLS):
+    """
+    Returns a sorted list of name==version requirements for requirements and
+    all of their dependencies, using the versions installed locally.
+
+    Requirements that cannot be pinned - packages that are not installed
+    locally, or not in a version that satisfies the requirement, and URLs -
+    are returned unchanged, as a second list.
+    """
+    exclude = set(exclude)
+    unresolved = []
+    names = []
+    for requirement in requirements:
+        name = requirement_name(requirement)
+        dist = _distribution(name) if name else None
+        if dist is None:
+            unresolved.append(requirement)
+        elif "://" in requirement:
+            # Installed from the URL, but its dependencies can still be pinned
+            unresolved.append(requirement)
+            exclude.add(canonical_name(name))
+            names.append(name)
+        elif not _satisfied_by(requirement, dist):
+            # Leave it to the builder, even if something else depends on it
+            unresolved.append(requirement)
+            exclude.add(canonical_name(name))
+        else:
+            names.append(name)
+    pinned = []
+    for key, dist in sorted(dependency_closure(names).items()):
+        if dist is None or key in exclude:
+            continue
+        pinned.append("{}=={}".format(key, dist.version))
+    return pinned, unresolved
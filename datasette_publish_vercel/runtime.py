@@ -0,0 +1,1046 @@
+"""
+Runtime helpers for generated Vercel applications.
+
+This file is copied into the deployed bundle as datasette_vercel_runtime.py
+when a publish option needs it, so it must only depend on the standard
+library and on Datasette itself - and it should only import Datasette lazily.
+"""
+
+import asyncio
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+RUNTIME_MODULE = "datasette_vercel_runtime"
+
+
+async def send_json(send, data, status=200, headers=None):
+    body = json.dumps(data).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                [b"content-type", b"application/json; charset=utf-8"],
+                [b"content-length", str(len(body)).encode("latin-1")],
+            ]
+            + list(headers or []),
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def add_header(send, name, value):
+    "Wrap an ASGI send() to add a header to the response"
+
+    async def wrapped_send(event):
+        if event["type"] == "http.response.start":
+            event = dict(
+                event,
+                headers=list(event.get("headers") or [])
+                + [[name.encode("latin-1"), value.encode("latin-1")]],
+            )
+        await send(event)
+
+    return wrapped_send
+
+
+class LazyApp:
+    """
+    ASGI application that constructs the Datasette instance on the first
+    request rather than at import time.
+
+    build() should return a Datasette instance. Requests to health_path are
+    answered without building anything. Startup phase timings are reported
+    in a Server-Timing header on the request that triggered the build, and
+    written to stderr as a JSON log line.
+    """
+
+    def __init__(self, build, health_path="/-/health"):
+        self.build = build
+        self.health_path = health_path
+        self.timings = None
+        self.ds = None
+        self._app = None
+        # A threading lock, not an asyncio one: the Vercel runtime may serve
+        # requests from different threads and event loops
+        self._lock = threading.Lock()
+
+    def _build(self):
+        with self._lock:
+            if self._app is not None:
+                return False
+            timings = {}
+            start = time.perf_counter()
+            ds = self.build()
+            timings["construct"] = time.perf_counter() - start
+            start = time.perf_counter()
+            asyncio.run(ds.invoke_startup())
+            timings["startup"] = time.perf_counter() - start
+            start = time.perf_counter()
+            app = ds.app()
+            timings["app"] = time.perf_counter() - start
+            self.timings = timings
+            self.ds = ds
+            self._app = app
+            sys.stderr.write(
+                json.dumps(
+                    {
+                        "event": "datasette-startup",
+                        "timings_ms": {
+                            name: round(duration * 1000, 2)
+                            for name, duration in timings.items()
+                        },
+                    }
+                )
+                + "\n"
+            )
+            return True
+
+    def server_timing(self):
+        return ", ".join(
+            "startup-{};dur={:.2f}".format(name, duration * 1000)
+            for name, duration in self.timings.items()
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] == "http" and scope["path"] == self.health_path:
+            await send_json(send, {"ok": True, "started": self._app is not None})
+            return
+        built = False
+        if self._app is None:
+            # Run the build in a thread so concurrent first requests on this
+            # event loop wait for it without blocking the loop
+            built = await asyncio.get_running_loop().run_in_executor(None, self._build)
+        if built and scope["type"] == "http":
+            send = add_header(send, "server-timing", self.server_timing())
+        await self._app(scope, receive, send)
+
+
+class PrerenderedApp:
+    """
+    Serves pages that were rendered at publish time, from the manifest.json
+    written to directory, for GET and HEAD requests without a query string.
+
+    Anything else - including requests from signed-in actors, or with an
+    Authorization header - is passed through to app. The files can never
+    change for the life of a deployment, so they can be cached in the Vercel
+    edge cache indefinitely.
+    """
+
+    cache_control = b"public, max-age=0, s-maxage=31536000"
+
+    def __init__(self, app, directory="prerendered"):
+        self.app = app
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json")) as fp:
+            self.manifest = json.load(fp)
+
+    def _should_serve(self, scope):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            return None
+        if scope.get("query_string"):
+            return None
+        for name, value in scope.get("headers") or []:
+            if name == b"cookie" and b"ds_actor=" in value:
+                return None
+            if name == b"authorization":
+                return None
+        return self.manifest.get(scope["path"])
+
+    async def __call__(self, scope, receive, send):
+        page = self._should_serve(scope)
+        if page is None:
+            await self.app(scope, receive, send)
+            return
+        with open(os.path.join(self.directory, page["file"]), "rb") as fp:
+            body = fp.read()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    [name.encode("latin-1"), value.encode("latin-1")]
+                    for name, value in page["headers"]
+                ]
+                + [
+                    [b"content-length", str(len(body)).encode("latin-1")],
+                    [b"cache-control", self.cache_control],
+                    [b"x-datasette-prerendered", b"1"],
+                ],
+            }
+        )
+        await send(
+            {
+                "type": "http.response.body",
+                "body": b"" if scope["method"] == "HEAD" else body,
+            }
+        )
+
+
+class _TraceList(list):
+    "Collects traces, also passing them on to a tracer that was already active"
+
+    def __init__(self, chained=None):
+        super().__init__()
+        self.chained = chained
+
+    def append(self, item):
+        super().append(item)
+        if self.chained is not None:
+            self.chained.append(item)
+
+
+@contextlib.contextmanager
+def capture_sql_traces(traces):
+    """
+    Like datasette.tracer.capture_traces(), but chains into a tracer that is
+    already capturing for this task and restores it afterwards, so the two
+    can be nested.
+    """
+    from datasette.tracer import get_task_id, tracers
+
+    task_id = get_task_id()
+    if task_id is None:
+        yield
+        return
+    previous = tracers.get(task_id)
+    traces.chained = previous
+    tracers[task_id] = traces
+    try:
+        yield
+    finally:
+        if previous is None:
+            tracers.pop(task_id, None)
+        else:
+            tracers[task_id] = previous
+
+
+class InstrumentedApp:
+    """
+    Adds a Server-Timing header to every response covering total handler
+    time, time spent executing SQL, the number of SQL queries and whether
+    this was the first request since a cold start, then writes a JSON log
+    line for the request to stdout.
+
+    Requests with ?_trace=1 are traced by Datasette itself, which replaces
+    any other tracer for the request, so SQL timings are left out for them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.cold = True
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        cold, self.cold = self.cold, False
+        start = time.perf_counter()
+        traces = _TraceList()
+        info = {"status": None}
+        datasette_trace = b"_trace=1" in scope.get("query_string", b"").split(b"&")
+
+        def sql_stats():
+            if datasette_trace:
+                return None, None
+            durations = [t["duration_ms"] for t in traces if t["type"] == "sql"]
+            return sum(durations), len(durations)
+
+        async def wrapped_send(event):
+            if event["type"] == "http.response.start":
+                info["status"] = event["status"]
+                sql_ms, sql_count = sql_stats()
+                timing = "total;dur={:.2f}".format((time.perf_counter() - start) * 1000)
+                if sql_ms is not None:
+                    timing += ', sql;dur={:.2f};desc="{} quer{}"'.format(
+                        sql_ms, sql_count, "y" if sql_count == 1 else "ies"
+                    )
+                if cold:
+                    timing += ', cold;desc="cold start"'
+                event = dict(
+                    event,
+                    headers=list(event.get("headers") or [])
+                    + [[b"server-timing", timing.encode("latin-1")]],
+                )
+            await send(event)
+
+        try:
+            if datasette_trace:
+                await self.app(scope, receive, wrapped_send)
+            else:
+                with capture_sql_traces(traces):
+                    await self.app(scope, receive, wrapped_send)
+        finally:
+            sql_ms, sql_count = sql_stats()
+            sys.stdout.write(
+                json.dumps(
+                    {
+                        "event": "datasette-request",
+                        "method": scope["method"],
+                        "path": scope["path"],
+                        "status": info["status"],
+                        "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+                        "sql_ms": None if sql_ms is None else round(sql_ms, 2),
+                        "sql_queries": sql_count,
+                        "cold_start": cold,
+                    }
+                )
+                + "\n"
+            )
+            sys.stdout.flush()
+
+
+def register_plugin(name, plugin):
+    "Register a Datasette plugin object, replacing any previous one of that name"
+    from datasette.plugins import pm
+
+    if pm.get_plugin(name) is not None:
+        pm.unregister(name=name)
+    pm.register(plugin, name=name)
+
+
+# Built-in SQL functions that can return something different each time - the
+# date and time functions only for 'now', but any call to them is skipped
+NON_DETERMINISTIC_FUNCTIONS = {
+    "random",
+    "randomblob",
+    "changes",
+    "total_changes",
+    "last_insert_rowid",
+    "date",
+    "time",
+    "datetime",
+    "julianday",
+    "unixepoch",
+    "strftime",
+    "timediff",
+}
+SQL_FUNCTION_CALL_RE = re.compile(r"\b([a-z_][a-z0-9_]*)\s*\(", re.I)
+SQL_CURRENT_TIME_RE = re.compile(r"\bcurrent_(date|time|timestamp)\b", re.I)
+# From sqlite3.h
+SQLITE_DETERMINISTIC = 0x800
+
+
+def registered_non_deterministic_functions(conn):
+    """
+    Names of the functions registered on conn - e.g. by plugins, using
+    prepare_connection - without the deterministic flag. Empty if the SQLite
+    version does not support pragma function_list.
+    """
+    try:
+        rows = conn.execute(
+            "select name, builtin, flags from pragma_function_list"
+        ).fetchall()
+    except Exception:
+        return set()
+    return {
+        name.lower()
+        for name, builtin, flags in rows
+        if not builtin and not flags & SQLITE_DETERMINISTIC
+    }
+
+
+def is_deterministic_sql(sql, non_deterministic=()):
+    "Does sql avoid calling any of the functions that can change between calls?"
+    if SQL_CURRENT_TIME_RE.search(sql):
+        return False
+    called = {name.lower() for name in SQL_FUNCTION_CALL_RE.findall(sql)}
+    return not called & (NON_DETERMINISTIC_FUNCTIONS | set(non_deterministic))
+
+
+class QueryCache:
+    """
+    Bounded in-memory LRU cache of SQL query results.
+
+    Size is estimated from the length of the values in each row. Entries are
+    evicted, least recently used first, once max_bytes is exceeded.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.skipped = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_size(results):
+        size = 64
+        for row in results.rows:
+            size += 64
+            for value in row:
+                if isinstance(value, (str, bytes)):
+                    size += len(value) + 48
+                else:
+                    size += 24
+        return size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, results):
+        size = self.estimate_size(results)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (results, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def skip(self):
+        "Record a query that could not be cached"
+        with self._lock:
+            self.skipped += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "skipped": self.skipped,
+            }
+
+
+def install_query_cache(ds, max_bytes):
+    """
+    Cache the results of read queries against the immutable databases
+    attached to ds, keyed by database content hash, SQL and parameters, and
+    add a /-/cache JSON endpoint showing cache statistics.
+
+    Queries calling functions that can return different results each time -
+    random(), the date and time functions, or functions registered without
+    the deterministic flag - are not cached.
+    """
+    from datasette import hookimpl
+    from datasette.database import Results
+    from datasette.utils.asgi import Response
+
+    cache = QueryCache(max_bytes)
+
+    def cached_execute(db, execute):
+        registered = []
+
+        async def execute_with_cache(
+            sql, params=None, truncate=False, custom_time_limit=None, **kwargs
+        ):
+            if not registered:
+                registered.append(
+                    await db.execute_fn(registered_non_deterministic_functions)
+                )
+            if not is_deterministic_sql(sql, registered[0]):
+                cache.skip()
+                return await execute(
+                    sql,
+                    params=params,
+                    truncate=truncate,
+                    custom_time_limit=custom_time_limit,
+                    **kwargs,
+                )
+            key = (
+                db.hash,
+                sql,
+                json.dumps(params, sort_keys=True, default=repr),
+                truncate,
+                kwargs.get("page_size"),
+            )
+            results = cache.get(key)
+            if results is None:
+                results = await execute(
+                    sql,
+                    params=params,
+                    truncate=truncate,
+                    custom_time_limit=custom_time_limit,
+                    **kwargs,
+                )
+                cache.set(key, results)
+            # A fresh Results each time, in case the caller modifies it
+            return Results(list(results.rows), results.truncated, results.description)
+
+        return execute_with_cache
+
+    for db in ds.databases.values():
+        if db.is_mutable or db.is_memory:
+            continue
+        db.execute = cached_execute(db, db.execute)
+
+    class QueryCachePlugin:
+        # Datasette expects plugins to have a __name__, like modules do
+        __name__ = "datasette_vercel_query_cache"
+
+        @hookimpl
+        def register_routes(self):
+            async def cache_stats(request):
+                return Response.json(cache.stats())
+
+            return [(r"^/-/cache(\.json)?$", cache_stats)]
+
+    register_plugin(QueryCachePlugin.__name__, QueryCachePlugin())
+    ds.query_cache = cache
+    return cache
+
+
+class ETagApp:
+    """
+    Adds a strong ETag to successful GET and HEAD responses and answers
+    matching If-None-Match requests with 304 Not Modified, without calling
+    app at all.
+
+    content_hash identifies everything the responses depend on in this
+    deployment; the installed Datasette version is mixed in too. Requests
+    from signed-in actors (a ds_actor cookie or an Authorization header) are
+    passed through untouched, as are /-/ pages such as /-/cache, /-/warmup
+    and /-/health that report on the running instance - apart from static
+    assets. If-None-Match: * is not supported, as answering it would mean
+    knowing whether the resource exists.
+    """
+
+    static_prefixes = ("/-/static/", "/-/static-plugins/")
+
+    def __init__(self, app, content_hash):
+        self.app = app
+        self.content_hash = content_hash
+        self._etag = None
+
+    @property
+    def etag(self):
+        if self._etag is None:
+            from importlib.metadata import PackageNotFoundError, version
+
+            try:
+                datasette_version = version("datasette")
+            except PackageNotFoundError:
+                datasette_version = ""
+            key = "{}:{}".format(self.content_hash, datasette_version)
+            self._etag = '"{}"'.format(
+                hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+            )
+        return self._etag
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+        path = scope.get("path") or ""
+        if path.startswith("/-/") and not path.startswith(self.static_prefixes):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        if b"ds_actor=" in headers.get(b"cookie", b"") or b"authorization" in headers:
+            await self.app(scope, receive, send)
+            return
+        etag = self.etag.encode("latin-1")
+        if_none_match = headers.get(b"if-none-match", b"")
+        # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+        if etag in [
+            value.strip().replace(b"W/", b"", 1) for value in if_none_match.split(b",")
+        ]:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 304,
+                    "headers": [[b"etag", etag]],
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def wrapped_send(event):
+            if event["type"] == "http.response.start" and event["status"] == 200:
+                response_headers = list(event.get("headers") or [])
+                names = {name.lower() for name, _ in response_headers}
+                if b"etag" not in names and b"set-cookie" not in names:
+                    event = dict(event, headers=response_headers + [[b"etag", etag]])
+            await send(event)
+
+        await self.app(scope, receive, wrapped_send)
+
+
+COMPRESSIBLE_TYPES = (
+    "text/html",
+    "text/plain",
+    "text/csv",
+    "text/css",
+    "text/javascript",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+
+def accepted_encodings(accept_encoding):
+    "Set of encodings listed in an Accept-Encoding header, ignoring any with q=0"
+    encodings = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if name.strip():
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+class _GzipCompressor:
+    encoding = "gzip"
+
+    def __init__(self):
+        import zlib
+
+        self._zlib = zlib
+        # wbits=31 writes a gzip header and trailer
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data, final):
+        if final:
+            return self._compressor.compress(data) + self._compressor.flush()
+        # Sync flush so each chunk of a streamed response is sent right away
+        return self._compressor.compress(data) + self._compressor.flush(
+            self._zlib.Z_SYNC_FLUSH
+        )
+
+
+class _BrotliCompressor:
+    encoding = "br"
+
+    def __init__(self):
+        import brotli
+
+        self._compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data, final):
+        output = self._compressor.process(data)
+        if final:
+            return output + self._compressor.finish()
+        return output + self._compressor.flush()
+
+
+class CompressedApp:
+    """
+    Compresses responses with brotli (if the brotli package can be imported)
+    or gzip, for clients that accept them.
+
+    Only responses with one of content_types, and at least minimum_size
+    bytes, are compressed. Streamed responses are compressed one chunk at a
+    time as they are sent, rather than being buffered in memory.
+    """
+
+    def __init__(self, app, minimum_size=500, content_types=COMPRESSIBLE_TYPES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.content_types = tuple(content_types)
+        try:
+            import brotli  # noqa: F401
+
+            self.compressors = [_BrotliCompressor, _GzipCompressor]
+        except ImportError:
+            self.compressors = [_GzipCompressor]
+
+    def _compressor_for(self, scope):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            return None
+        for name, value in scope.get("headers") or []:
+            if name == b"accept-encoding":
+                accepted = accepted_encodings(value.decode("latin-1"))
+                for compressor in self.compressors:
+                    if compressor.encoding in accepted:
+                        return compressor
+        return None
+
+    def _should_compress(self, start):
+        if start["status"] < 200 or start["status"] in (204, 304):
+            return False
+        headers = {name.lower(): value for name, value in start.get("headers") or []}
+        if b"content-encoding" in headers:
+            return False
+        content_type = headers.get(b"content-type", b"").decode("latin-1")
+        if (
+            not content_type.split(";")[0]
+            .strip()
+            .lower()
+            .startswith(self.content_types)
+        ):
+            return False
+        content_length = headers.get(b"content-length")
+        if content_length is not None and int(content_length) < self.minimum_size:
+            return False
+        return True
+
+    async def __call__(self, scope, receive, send):
+        compressor_class = self._compressor_for(scope)
+        if compressor_class is None:
+            await self.app(scope, receive, send)
+            return
+        state = {"start": None, "compressor": None, "passthrough": False}
+
+        def compressed_start(start):
+            headers = []
+            vary = []
+            for name, value in start.get("headers") or []:
+                lower = name.lower()
+                if lower == b"content-length":
+                    continue
+                elif lower == b"vary":
+                    vary.append(value)
+                    continue
+                elif lower == b"etag" and not value.startswith(b"W/"):
+                    # The compressed bytes differ, so the ETag can only be weak
+                    value = b"W/" + value
+                headers.append([name, value])
+            headers.append([b"content-encoding", compressor_class.encoding.encode()])
+            headers.append([b"vary", b", ".join(vary + [b"Accept-Encoding"])])
+            return dict(start, headers=headers)
+
+        async def wrapped_send(event):
+            if event["type"] == "http.response.start":
+                if self._should_compress(event):
+                    # Wait for the first chunk of the body before deciding
+                    state["start"] = event
+                else:
+                    state["passthrough"] = True
+                    await send(event)
+                return
+            if event["type"] != "http.response.body" or state["passthrough"]:
+                await send(event)
+                return
+            body = event.get("body", b"")
+            more_body = event.get("more_body", False)
+            if state["start"] is not None:
+                start, state["start"] = state["start"], None
+                if not more_body and len(body) < self.minimum_size:
+                    state["passthrough"] = True
+                    await send(start)
+                    await send(event)
+                    return
+                state["compressor"] = compressor_class()
+                await send(compressed_start(start))
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": state["compressor"].compress(body, final=not more_body),
+                    "more_body": more_body,
+                }
+            )
+
+        await self.app(scope, receive, wrapped_send)
+
+
+SCHEMA_SNAPSHOT = "schema-snapshot.json"
+SCHEMA_TABLES = ("tables", "columns", "indexes", "foreign_keys")
+
+
+async def snapshot_schemas(ds):
+    """
+    Returns the rows Datasette keeps about each database's schema in its
+    _internal database, along with the content hash of each database
+    """
+    from datasette.version import __version__
+
+    await ds.refresh_schemas()
+    internal_db = ds.databases["_internal"]
+    schema_versions = {
+        row["database_name"]: row["schema_version"]
+        for row in await internal_db.execute(
+            "select database_name, schema_version from databases"
+        )
+    }
+    databases = {}
+    for name, db in ds.databases.items():
+        if name == "_internal" or db.is_memory:
+            continue
+        info = {"hash": db.hash, "schema_version": schema_versions[name]}
+        for table in SCHEMA_TABLES:
+            results = await internal_db.execute(
+                "select * from [{}] where database_name = ?".format(table), [name]
+            )
+            info[table] = {
+                "columns": results.columns,
+                "rows": [list(row) for row in results.rows],
+            }
+        databases[name] = info
+    return {"datasette_version": __version__, "databases": databases}
+
+
+def load_schema_snapshot(ds, path=SCHEMA_SNAPSHOT):
+    """
+    Populate Datasette's _internal schema tables from a snapshot taken at
+    publish time, so they don't need to be built on the first request.
+
+    Databases whose content hash from the inspect data does not match the
+    snapshot are left out, and are introspected as usual. Returns the names
+    of the databases that were loaded.
+    """
+    from datasette.utils.internal_db import init_internal_db
+    from datasette.version import __version__
+
+    try:
+        with open(path) as fp:
+            snapshot = json.load(fp)
+    except (OSError, ValueError):
+        return []
+    if snapshot.get("datasette_version") != __version__:
+        # The _internal tables may differ between versions
+        return []
+    inspect_data = ds.inspect_data or {}
+    loaded = [
+        name
+        for name, info in snapshot["databases"].items()
+        if name in ds.databases
+        and (inspect_data.get(name) or {}).get("hash") == info["hash"]
+    ]
+    if not loaded:
+        return []
+    internal_db = ds.databases["_internal"]
+
+    def write(conn):
+        with conn:
+            for name in loaded:
+                info = snapshot["databases"][name]
+                db = ds.databases[name]
+                conn.execute(
+                    "insert or replace into databases (database_name, path, is_memory, "
+                    "schema_version) values (?, ?, ?, ?)",
+                    [name, str(db.path), db.is_memory, info["schema_version"]],
+                )
+                for table in SCHEMA_TABLES:
+                    columns = info[table]["columns"]
+                    conn.executemany(
+                        "insert or replace into [{}] ({}) values ({})".format(
+                            table,
+                            ", ".join('"{}"'.format(column) for column in columns),
+                            ", ".join("?" for _ in columns),
+                        ),
+                        info[table]["rows"],
+                    )
+
+    async def load():
+        await init_internal_db(internal_db)
+        await internal_db.execute_write_fn(write)
+
+    asyncio.run(load())
+    ds.internal_db_created = True
+    return loaded
+
+
+def set_connection_pragmas(ds, mmap_size=None):
+    "Set PRAGMA mmap_size on every connection to a database file"
+    from datasette import hookimpl
+
+    class ConnectionPragmasPlugin:
+        __name__ = "datasette_vercel_connection_pragmas"
+
+        @hookimpl
+        def prepare_connection(self, conn, database):
+            if database == "_internal" or mmap_size is None:
+                return
+            conn.execute("PRAGMA mmap_size = {}".format(int(mmap_size)))
+
+    register_plugin(ConnectionPragmasPlugin.__name__, ConnectionPragmasPlugin())
+
+
+WARMUP_PLAN = "warmup.json"
+
+
+class Warmup:
+    """
+    Reads the pages listed in a warm-up plan into the operating system's
+    page cache, in a background thread, and tracks progress.
+
+    plan is {database file: {"page_size": ..., "objects": {name: ranges}}}
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.status = "pending"
+        self.error = None
+        self.bytes_total = sum(
+            (last - first + 1) * info["page_size"]
+            for info in plan.values()
+            for ranges in info["objects"].values()
+            for first, last in ranges
+        )
+        self.bytes_read = 0
+        self.objects_done = 0
+        self.duration = None
+        self._start = None
+
+    def run(self):
+        self.status = "running"
+        self._start = time.perf_counter()
+        try:
+            for database_file, info in self.plan.items():
+                page_size = info["page_size"]
+                with open(database_file, "rb") as fp:
+                    for ranges in info["objects"].values():
+                        for first, last in ranges:
+                            fp.seek((first - 1) * page_size)
+                            remaining = (last - first + 1) * page_size
+                            while remaining > 0:
+                                data = fp.read(min(self.chunk_size, remaining))
+                                if not data:
+                                    break
+                                remaining -= len(data)
+                                self.bytes_read += len(data)
+                        self.objects_done += 1
+            self.status = "done"
+        except OSError as ex:
+            self.status = "error"
+            self.error = str(ex)
+        self.duration = time.perf_counter() - self._start
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        duration = self.duration
+        if duration is None and self._start is not None:
+            duration = time.perf_counter() - self._start
+        return {
+            "status": self.status,
+            "error": self.error,
+            "objects": sum(len(info["objects"]) for info in self.plan.values()),
+            "objects_done": self.objects_done,
+            "bytes_total": self.bytes_total,
+            "bytes_read": self.bytes_read,
+            "duration_ms": round(duration * 1000, 2) if duration is not None else None,
+        }
+
+
+def start_warmup(ds, path=WARMUP_PLAN):
+    """
+    Start pre-reading the pages listed in the plan at path in a background
+    thread, and add a /-/warmup JSON endpoint reporting on its progress
+    """
+    from datasette import hookimpl
+    from datasette.utils.asgi import Response
+
+    with open(path) as fp:
+        plan = json.load(fp)
+    # Each function in a --split-functions deployment only warms its own files
+    attached = {os.path.basename(db.path) for db in ds.databases.values() if db.path}
+    warmup = Warmup({file: info for file, info in plan.items() if file in attached})
+
+    class WarmupPlugin:
+        __name__ = "datasette_vercel_warmup"
+
+        @hookimpl
+        def register_routes(self):
+            async def warmup_stats(request):
+                return Response.json(warmup.stats())
+
+            return [(r"^/-/warmup(\.json)?$", warmup_stats)]
+
+    register_plugin(WarmupPlugin.__name__, WarmupPlugin())
+    warmup.start()
+    ds.warmup = warmup
+    return warmup
+
+
+FACET_SUMMARY_TABLE = "_facet_summaries"
+
+# The SQL Datasette runs for a column facet - an unfiltered one has nothing
+# between the table name and the closing parenthesis
+FACET_SQL_RE = re.compile(
+    r"^\s*select (?P<column>.+?) as value, count\(\*\) as count from \(\s*"
+    r"select .+? from (?P<table>.+?)\s*\)\s*"
+    r"where (?P=column) is not null\s*"
+    r"group by (?P=column) order by count desc, value limit (?P<limit>\d+)\s*$",
+    re.DOTALL,
+)
+
+
+def install_facet_summaries(ds, databases, limit, table=FACET_SUMMARY_TABLE):
+    """
+    Answer column facet queries against whole tables in databases from the
+    value counts precomputed at publish time, instead of running a GROUP BY
+    over every row.
+
+    limit is the number of values stored for each column: facet queries that
+    ask for more than that fall through to SQLite, unless every value fitted.
+    """
+    from datasette.utils import escape_sqlite
+
+    def summarised_execute(db, execute):
+        # {(escaped column, escaped table): (table, column, values stored)}
+        summaries = None
+
+        async def execute_with_summaries(sql, params=None, **kwargs):
+            nonlocal summaries
+            match = None if params else FACET_SQL_RE.match(sql)
+            if match:
+                if summaries is None:
+                    results = await execute(
+                        "select table_name, column_name, count(*) from {} "
+                        "group by table_name, column_name".format(escape_sqlite(table))
+                    )
+                    summaries = {
+                        (escape_sqlite(column), escape_sqlite(table_name)): (
+                            table_name,
+                            column,
+                            count,
+                        )
+                        for table_name, column, count in results.rows
+                    }
+                summary = summaries.get((match.group("column"), match.group("table")))
+                requested = int(match.group("limit"))
+                if summary is not None and (
+                    requested <= summary[2] or summary[2] < limit
+                ):
+                    return await execute(
+                        "select value, count from {} where table_name = ? "
+                        "and column_name = ? order by position limit ?".format(
+                            escape_sqlite(table)
+                        ),
+                        [summary[0], summary[1], requested],
+                    )
+            return await execute(sql, params=params, **kwargs)
+
+        return execute_with_summaries
+
+    for name in databases:
+        db = ds.databases.get(name)
+        if db is None or db.is_mutable:
+            continue
+        db.execute = summarised_execute(db, db.execute)
@@ -0,0 +1,336 @@
+from contextlib import contextmanager
+from .deploy import file_sha1
+from datasette.utils import parse_metadata
+import collections
+import json
+import mergedeep
+import os
+import shutil
+import tempfile
+
+# Lists the files written by --generate-dir, so only those are ever deleted
+GENERATED_MANIFEST = ".datasette-vercel-manifest.json"
+
+# From linux/fs.h - clone a file's extents (a "reflink") on btrfs, XFS etc
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl
+
+    with open(src, "rb") as src_fp, open(dst, "wb") as dst_fp:
+        try:
+            fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        except OSError:
+            dst_fp.close()
+            os.remove(dst)
+            raise
+
+
+class Stager:
+    """
+    Places files in a build directory without copying their contents where
+    possible: hard link, then reflink, then (if allowed) symlink, and only
+    copies as a last resort - e.g. across devices on filesystems without
+    reflink support.
+
+    Counts of each strategy used are kept in .strategies
+    """
+
+    def __init__(self, allow_symlinks=False):
+        self.allow_symlinks = allow_symlinks
+        self.strategies = collections.Counter()
+
+    def stage_file(self, src, dst):
+        src = os.path.abspath(src)
+        strategies = [("hardlink", os.link), ("reflink", _reflink)]
+        if self.allow_symlinks:
+            strategies.append(("symlink", os.symlink))
+        for name, fn in strategies:
+            try:
+                fn(src, dst)
+            except (OSError, ImportError):
+                # ImportError: fcntl is not available on Windows
+                continue
+            self.strategies[name] += 1
+            return name
+        shutil.copyfile(src, dst)
+        self.strategies["copy"] += 1
+        return "copy"
+
+    def stage_directory(self, src, dst):
+        for root, dirs, filenames in os.walk(src):
+            target = os.path.join(dst, os.path.relpath(root, src))
+            os.makedirs(target, exist_ok=True)
+            for filename in filenames:
+                self.stage_file(
+                    os.path.join(root, filename), os.path.join(target, filename)
+                )
+
+    def summary(self):
+        total = sum(self.strategies.values())
+        return "Staged {} file{} ({})".format(
+            total,
+            "" if total == 1 else "s",
+            ", ".join(
+                "{}: {}".format(name, count)
+                for name, count in sorted(self.strategies.items())
+            )
+            or "nothing to stage",
+        )
+
+
+def unshare_file(path):
+    """
+    Make a staged file safe to modify in place.
+
+    Staged files may be hard links or symlinks to the user's originals, and
+    writing to those would change the originals too - so a shared file is
+    replaced with a private copy first. Files that are already private,
+    including reflinks, are left alone, so no data is copied.
+
+    Returns True if a copy was made.
+    """
+    if not os.path.islink(path) and os.stat(path).st_nlink == 1:
+        return False
+    tmp_path = path + ".unshare-tmp"
+    shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, path)
+    return True
+
+
+def _unchanged(src, dst):
+    "Does dst already match src? Checks size and mtime before contents"
+    if os.path.islink(src) or os.path.islink(dst):
+        return (
+            os.path.islink(src)
+            and os.path.islink(dst)
+            and os.readlink(src) == os.readlink(dst)
+        )
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+        return True
+    if file_sha1(src) != file_sha1(dst):
+        return False
+    if dst_stat.st_nlink == 1:
+        # So the next sync can skip it without reading it again - unless it is
+        # linked to another file, which might be the user's original
+        os.utime(dst, ns=(dst_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return True
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def generated_files(directory):
+    "Relative paths of the files in directory, as recorded in GENERATED_MANIFEST"
+    files = []
+    for root, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(root, filename), directory)
+            files.append(path.replace(os.sep, "/"))
+    return sorted(f for f in files if f != GENERATED_MANIFEST)
+
+
+def read_generated_manifest(directory):
+    "The files a previous --generate-dir wrote to directory, or None"
+    try:
+        with open(os.path.join(directory, GENERATED_MANIFEST)) as fp:
+            return json.load(fp)["files"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_generated_manifest(directory, files):
+    with open(os.path.join(directory, GENERATED_MANIFEST), "w") as fp:
+        fp.write(json.dumps({"files": files}, indent=2))
+
+
+def sync_directory(src, dst, previous=()):
+    """
+    Update the existing directory dst to match src, only replacing files
+    that have changed.
+
+    Only files listed in previous - the files generated into dst last time,
+    as relative paths - are deleted if they are no longer in src. Anything
+    else in dst is left alone. Files are replaced, never written to, as they
+    may be links to other files.
+
+    Returns a dictionary listing the files updated and deleted.
+    """
+    stager = Stager()
+    updated = []
+    deleted = []
+    unchanged = 0
+    updated_bytes = 0
+    wanted_dirs = {"."}
+    wanted_files = set()
+    for root, dirs, filenames in os.walk(src):
+        dirs.sort()
+        relative_root = os.path.relpath(root, src)
+        wanted_dirs.add(os.path.normpath(relative_root))
+        target = os.path.join(dst, relative_root)
+        if os.path.islink(target) or (
+            os.path.lexists(target) and not os.path.isdir(target)
+        ):
+            _remove(target)
+        os.makedirs(target, exist_ok=True)
+        for filename in sorted(filenames):
+            relative = os.path.normpath(os.path.join(relative_root, filename))
+            wanted_files.add(relative)
+            src_path = os.path.join(root, filename)
+            dst_path = os.path.join(dst, relative)
+            if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+                _remove(dst_path)
+            elif os.path.lexists(dst_path) and _unchanged(src_path, dst_path):
+                unchanged += 1
+                continue
+            tmp_path = dst_path + ".sync-tmp"
+            _remove(tmp_path)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), tmp_path)
+                stager.strategies["symlink"] += 1
+            else:
+                stager.stage_file(src_path, tmp_path)
+                if not os.path.samefile(src_path, tmp_path):
+                    src_stat = os.stat(src_path)
+                    os.utime(tmp_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            os.replace(tmp_path, dst_path)
+            updated.append(relative)
+            updated_bytes += os.lstat(dst_path).st_size
+
+    for relative in sorted(set(previous)):
+        relative = os.path.normpath(relative)
+        path = os.path.join(dst, relative)
+        if (
+            relative in wanted_files
+            or relative.startswith(os.pardir)
+            or os.path.isabs(relative)
+            or not os.path.lexists(path)
+            or (os.path.isdir(path) and not os.path.islink(path))
+        ):
+            continue
+        os.remove(path)
+        deleted.append(relative)
+        # Remove directories left empty, if they are not part of src
+        parent = os.path.dirname(relative)
+        while parent and parent not in wanted_dirs:
+            parent_path = os.path.join(dst, parent)
+            if not os.path.isdir(parent_path) or os.listdir(parent_path):
+                break
+            os.rmdir(parent_path)
+            parent = os.path.dirname(parent)
+    return {
+        "directory": dst,
+        "updated": updated,
+        "updated_bytes": updated_bytes,
+        "unchanged": unchanged,
+        "deleted": sorted(deleted),
+        "strategies": stager.strategies,
+    }
+
+
+def format_sync_report(result):
+    def files(count):
+        return "{} file{}".format(count, "" if count == 1 else "s")
+
+    return "Synced {}: updated {} ({:,} bytes), {} unchanged, deleted {}".format(
+        result["directory"],
+        files(len(result["updated"])),
+        result["updated_bytes"],
+        files(result["unchanged"]),
+        files(len(result["deleted"])),
+    )
+
+
+def _staging_parent(files):
+    # Hard links and reflinks only work within a single filesystem, so if the
+    # databases live on a different device from the system temp directory
+    # stage next to the first database instead
+    if not files:
+        return None
+    tmp_device = os.stat(tempfile.gettempdir()).st_dev
+    parent = os.path.dirname(os.path.abspath(files[0]))
+    if os.stat(parent).st_dev != tmp_device and os.access(parent, os.W_OK):
+        return parent
+    return None
+
+
+@contextmanager
+def staged_directory(
+    files,
+    metadata,
+    template_dir,
+    plugins_dir,
+    static,
+    extra_metadata=None,
+    target=None,
+):
+    """
+    Stage the files for a deployment and chdir into the directory.
+
+    Stages into target if provided (symlinks are allowed as a fallback
+    there), otherwise into a temporary directory that is removed afterwards.
+    If target already exists the files are staged into a temporary directory
+    alongside it, ready to be copied across with sync_directory(). A target
+    created here is removed again if the deployment fails, so a later run
+    does not find a half-written directory.
+    Yields the Stager, which records the strategies used.
+    """
+    extra_metadata = extra_metadata or {}
+    saved_cwd = os.getcwd()
+    file_paths = [os.path.join(saved_cwd, file_path) for file_path in files]
+    if metadata:
+        metadata_content = parse_metadata(metadata.read())
+    else:
+        metadata_content = {}
+    # Merge in the non-null values in extra_metadata
+    mergedeep.merge(
+        metadata_content,
+        {key: value for key, value in extra_metadata.items() if value is not None},
+    )
+    tmp = None
+    created = False
+    if target and not os.path.exists(target):
+        directory = target
+        os.makedirs(directory)
+        created = True
+    else:
+        # Next to an existing target, so files can be linked across to it
+        parent = os.path.dirname(target) if target else _staging_parent(files)
+        tmp = tempfile.TemporaryDirectory(dir=parent)
+        # Sub-directory gives the Vercel CLI a nicer default deployment name
+        directory = os.path.join(tmp.name, "datasette-now-v2")
+        os.mkdir(directory)
+    stager = Stager(allow_symlinks=bool(target))
+    try:
+        os.chdir(directory)
+        if metadata_content:
+            with open("metadata.json", "w") as fp:
+                fp.write(json.dumps(metadata_content, indent=2))
+        for path in file_paths:
+            stager.stage_file(path, os.path.split(path)[-1])
+        if template_dir:
+            stager.stage_directory(os.path.join(saved_cwd, template_dir), "templates")
+        if plugins_dir:
+            stager.stage_directory(os.path.join(saved_cwd, plugins_dir), "plugins")
+        for mount_point, path in static:
+            stager.stage_directory(os.path.join(saved_cwd, path), mount_point)
+        yield stager
+    except BaseException:
+        os.chdir(saved_cwd)
+        if created:
+            shutil.rmtree(directory)
+        raise
+    finally:
+        os.chdir(saved_cwd)
+        if tmp is not None:
+            tmp.cleanup()
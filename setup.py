@@ -28,7 +28,8 @@ setup(
     version=VERSION,
     packages=["datasette_publish_vercel"],
     entry_points={"datasette": ["publish_vercel = datasette_publish_vercel"]},
-    install_requires=["datasette>=0.59"],
+    python_requires=">=3.8",
+    install_requires=["datasette>=0.61"],
     extras_require={"test": ["pytest"]},
     tests_require=["datasette-publish-vercel[test]"],
 )
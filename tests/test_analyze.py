@@ -0,0 +1,51 @@
+from datasette_publish_vercel.analyze import (
+    analyze_bundle,
+    format_analysis,
+    format_size,
+)
+import pytest
+
+
+@pytest.mark.parametrize(
+    "size,expected",
+    ((100, "100 bytes"), (2048, "2.0 KB"), (5 * 1024 * 1024, "5.0 MB")),
+)
+def test_format_size(size, expected):
+    assert format_size(size) == expected
+
+
+def test_analyze_bundle(tmp_path):
+    (tmp_path / "one.db").write_bytes(b"x" * 5000)
+    (tmp_path / "two.db").write_bytes(b"x" * 3000)
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "index.html").write_bytes(b"x" * 100)
+    (tmp_path / "exports").mkdir()
+    (tmp_path / "exports" / "index.json").write_bytes(b"x" * 10)
+    vercel_json = {
+        "builds": [
+            {
+                "src": "index.py",
+                "use": "@vercel/python@3.0.7",
+                "config": {"excludeFiles": "{two.db,exports/**}"},
+            },
+            {"src": "index_two.py", "use": "@vercel/python@3.0.7"},
+            {"src": "exports/**", "use": "@vercel/static"},
+        ]
+    }
+    report = analyze_bundle(
+        str(tmp_path), vercel_json, ["click", "not-a-real-package"], limit=8000
+    )
+    assert report["categories"]["databases"] == 8000
+    assert report["categories"]["templates"] == 100
+    assert report["categories"]["static outputs"] == 10
+    packages = {p["name"]: p for p in report["packages"]}
+    assert packages["click"]["size"] > 0
+    assert packages["not-a-real-package"]["size"] is None
+    packages_size = report["categories"]["packages"]
+    assert report["functions"]["index.py"]["files"] == 5100
+    assert report["functions"]["index_two.py"]["files"] == 8110
+    assert report["functions"]["index_two.py"]["total"] == 8110 + packages_size
+    assert report["over_limit"] == ["index.py", "index_two.py"]
+    text = format_analysis(report)
+    assert "not installed locally, so not counted: not-a-real-package" in text
+    assert "OVER LIMIT" in text
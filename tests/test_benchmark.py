@@ -0,0 +1,38 @@
+import pathlib
+import runpy
+
+# The benchmark harness is a script in the repository, not part of the package
+benchmark = runpy.run_path(
+    str(pathlib.Path(__file__).parent.parent / "benchmarks" / "benchmark.py")
+)
+percentile = benchmark["percentile"]
+run_benchmark = benchmark["run_benchmark"]
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile([3.0], 95) == 3.0
+
+
+def test_run_benchmark():
+    results = run_benchmark(rows=20, tables=2, iterations=2, publish_args=["--lazy"])
+    assert results["config"] == {
+        "rows": 20,
+        "tables": 2,
+        "iterations": 2,
+        "publish_args": ["--lazy"],
+    }
+    assert set(results["statuses"].values()) == {200}
+    assert set(results["requests"].keys()) == {
+        "database",
+        "table",
+        "row",
+        "facet",
+        "json",
+    }
+    assert results["requests"]["facet"]["count"] == 2
+    assert results["import_time"] > 0
+    assert results["first_request_time"] > 0
+    assert results["peak_rss_kb"] > 0
@@ -0,0 +1,150 @@
+from click.testing import CliRunner
+from datasette import cli
+from datasette_publish_vercel.deploy import (
+    VercelApiError,
+    VercelClient,
+    directory_manifest,
+    file_sha1,
+)
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import json
+import pytest
+import threading
+
+
+class FakeVercel:
+    "Stand-in for the Vercel API that remembers uploaded files by SHA1"
+
+    def __init__(self):
+        self.files = {}
+        self.uploads = []
+        self.deployments = []
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                assert self.headers["authorization"] == "Bearer xyz"
+                body = self.rfile.read(int(self.headers["content-length"]))
+                if self.path.startswith("/v2/files"):
+                    sha = self.headers["x-vercel-digest"]
+                    fake.files[sha] = body
+                    fake.uploads.append(sha)
+                    return self.send_json(200, {})
+                data = json.loads(body)
+                fake.deployments.append((self.path, data))
+                missing = [
+                    f["sha"] for f in data["files"] if f["sha"] not in fake.files
+                ]
+                if missing:
+                    return self.send_json(
+                        400,
+                        {
+                            "error": {
+                                "code": "missing_files",
+                                "message": "Missing files",
+                                "missing": missing,
+                            }
+                        },
+                    )
+                return self.send_json(200, {"id": "dpl_1", "url": "foo-abc.vercel.app"})
+
+        return Handler
+
+
+@pytest.fixture
+def fake_vercel():
+    fake = FakeVercel()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), fake.handler())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    fake.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    yield fake
+    server.shutdown()
+
+
+def test_directory_manifest(tmp_path):
+    (tmp_path / "index.py").write_text("app = None")
+    (tmp_path / "static").mkdir()
+    (tmp_path / "static" / "my.css").write_text("body { color: red }")
+    assert directory_manifest(tmp_path) == [
+        {
+            "file": "index.py",
+            "sha": file_sha1(tmp_path / "index.py"),
+            "size": 10,
+        },
+        {
+            "file": "static/my.css",
+            "sha": file_sha1(tmp_path / "static" / "my.css"),
+            "size": 19,
+        },
+    ]
+
+
+def test_deploy_only_uploads_missing_files(tmp_path, fake_vercel):
+    (tmp_path / "index.py").write_text("app = None")
+    (tmp_path / "big.db").write_bytes(b"x" * 100000)
+    (tmp_path / "copy.db").write_bytes(b"x" * 100000)
+    client = VercelClient("xyz", base_url=fake_vercel.url, scope="myteam")
+    deployment, uploaded = client.deploy(tmp_path, "foo", env={"DATASETTE_SECRET": "S"})
+    assert deployment["url"] == "foo-abc.vercel.app"
+    # Identical files are only uploaded once
+    assert [item["file"] for item in uploaded] == ["big.db", "index.py"]
+    path, body = fake_vercel.deployments[-1]
+    assert path.startswith("/v13/deployments?slug=myteam")
+    assert body["target"] == "production"
+    assert body["env"] == {"DATASETTE_SECRET": "S"}
+    assert len(body["files"]) == 3
+    # Second deploy with only index.py changed uploads only that file
+    (tmp_path / "index.py").write_text("app = 1")
+    fake_vercel.uploads.clear()
+    deployment, uploaded = client.deploy(tmp_path, "foo", production=False)
+    assert [item["file"] for item in uploaded] == ["index.py"]
+    assert fake_vercel.uploads == [file_sha1(tmp_path / "index.py")]
+    assert "target" not in fake_vercel.deployments[-1][1]
+
+
+def test_deploy_error(tmp_path):
+    (tmp_path / "index.py").write_text("app = None")
+    client = VercelClient("xyz", base_url="http://example.com")
+    response = mock.Mock(status_code=403)
+    response.json.return_value = {"error": {"code": "forbidden", "message": "Nope"}}
+    with mock.patch("httpx.post", return_value=response):
+        with pytest.raises(VercelApiError) as ex:
+            client.deploy(tmp_path, "foo")
+    assert str(ex.value) == "Deployment failed: Nope"
+
+
+@pytest.mark.parametrize("status_code", (200, 502))
+def test_deploy_error_not_json(tmp_path, status_code):
+    (tmp_path / "index.py").write_text("app = None")
+    client = VercelClient("xyz", base_url="http://example.com")
+    response = mock.Mock(status_code=status_code, text="<html>Bad Gateway</html>")
+    response.json.side_effect = json.JSONDecodeError("Expecting value", "<", 0)
+    with mock.patch("httpx.post", return_value=response):
+        with pytest.raises(VercelApiError) as ex:
+            client.deploy(tmp_path, "foo")
+    assert str(ex.value) == "Deployment failed: <html>Bad Gateway</html>"
+
+
+def test_publish_vercel_api_requires_token():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(
+            cli.cli, ["publish", "vercel", "--project", "foo", "--api"]
+        )
+        assert result.exit_code == 1
+        assert result.output == "Error: --api requires --token\n"
@@ -0,0 +1,59 @@
+from datasette_publish_vercel import exports
+import csv
+import gzip
+import io
+import json
+import sqlite3
+
+
+def test_export_table(tmp_path, monkeypatch):
+    # Smaller batches than rows, to exercise the batching
+    monkeypatch.setattr(exports, "BATCH_SIZE", 3)
+    db_path = str(tmp_path / "data.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("create table [my table] (id integer primary key, name, data)")
+    conn.executemany(
+        "insert into [my table] (name, data) values (?, ?)",
+        [("row {}".format(i), b"\x00\x01" if i == 0 else None) for i in range(10)],
+    )
+    conn.execute("create virtual table docs using fts5(body)")
+    # Not a shadow table, despite the name
+    conn.execute("create table docs_archive (body)")
+    conn.commit()
+    conn.close()
+    assert exports.exportable_tables(db_path) == ["docs_archive", "my table"]
+    directory = str(tmp_path / "exports")
+    result = exports.export_table(db_path, "my table", directory)
+    assert result["rows"] == 10
+    with gzip.open(result["files"]["csv"]["path"], "rt") as fp:
+        rows = list(csv.reader(fp))
+    assert rows[0] == ["id", "name", "data"]
+    assert rows[1] == ["1", "row 0", "AAE="]
+    assert rows[10] == ["10", "row 9", ""]
+    with gzip.open(result["files"]["ndjson"]["path"], "rt") as fp:
+        lines = [json.loads(line) for line in fp]
+    assert len(lines) == 10
+    assert lines[0] == {
+        "id": 1,
+        "name": "row 0",
+        "data": {"$base64": True, "encoded": "AAE="},
+    }
+    assert result["files"]["csv"]["path"].endswith("/data/my+table.csv.gz")
+    # Exports are byte-for-byte reproducible
+    first = open(result["files"]["csv"]["path"], "rb").read()
+    exports.export_table(db_path, "my table", directory)
+    assert open(result["files"]["csv"]["path"], "rb").read() == first
+
+
+def test_shadow_tables_without_table_list():
+    class OldSQLite:
+        def execute(self, sql):
+            raise exports.sqlite3.OperationalError("unknown pragma")
+
+    rows = [
+        ("docs", "CREATE VIRTUAL TABLE docs USING fts5(body)"),
+        ("docs_archive", "CREATE TABLE docs_archive (body)"),
+    ]
+    shadow = exports._shadow_tables(OldSQLite(), rows)
+    assert {"docs_data", "docs_idx", "docs_config"} <= shadow
+    assert "docs_archive" not in shadow
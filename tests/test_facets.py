@@ -0,0 +1,86 @@
+from datasette_publish_vercel import facets
+import os
+import pytest
+import sqlite3
+
+
+def create_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("create table dogs (id integer primary key, breed, age)")
+    conn.execute("create index dogs_age on dogs (age)")
+    conn.executemany(
+        "insert into dogs (breed, age) values (?, ?)",
+        [("Corgi", 3), ("Corgi", 4), ("Poodle", 3), (None, 5), ("Beagle", 3)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_build_facet_summaries(tmp_path):
+    original = str(tmp_path / "original.db")
+    create_db(original)
+    # Staged databases can be hard links to the originals
+    staged = str(tmp_path / "staged.db")
+    os.link(original, staged)
+    result = facets.build_facet_summaries(
+        staged, [("dogs", "breed"), ("dogs", "age")], limit=2
+    )
+    # age already has an index
+    assert result["indexes"] == ["idx_dogs_breed"]
+    assert result["summaries"] == [
+        {"table": "dogs", "column": "breed", "values": 2},
+        {"table": "dogs", "column": "age", "values": 2},
+    ]
+    conn = sqlite3.connect(staged)
+    assert conn.execute(
+        "select * from _facet_summaries order by column_name, position"
+    ).fetchall() == [
+        ("dogs", "age", 0, 3, 3),
+        ("dogs", "age", 1, 4, 1),
+        ("dogs", "breed", 0, "Corgi", 2),
+        ("dogs", "breed", 1, "Beagle", 1),
+    ]
+    # The original file was not modified
+    assert sqlite3.connect(original).execute(
+        "select count(*) from sqlite_master where name = '_facet_summaries'"
+    ).fetchone() == (0,)
+    assert facets.format_facet_report(result).startswith(
+        "{}: summarised 2 facets (4 values), created 1 index in ".format(staged)
+    )
+
+
+@pytest.mark.parametrize(
+    "columns,error",
+    (
+        ([("cats", "breed")], "Table not found: cats"),
+        ([("dogs", "colour")], "Table dogs has no column: colour"),
+    ),
+)
+def test_build_facet_summaries_errors(tmp_path, columns, error):
+    path = str(tmp_path / "data.db")
+    create_db(path)
+    inode = os.stat(path).st_ino
+    with pytest.raises(ValueError) as ex:
+        facets.build_facet_summaries(path, columns, limit=10)
+    assert str(ex.value) == error
+    # A file that is not shared is worked on in place, not copied
+    assert os.stat(path).st_ino == inode
+
+
+def test_metadata_facets():
+    metadata = {
+        "databases": {
+            "data": {
+                "tables": {
+                    "dogs": {"facets": ["breed", {"array": "tags"}, {"column": "age"}]},
+                    "cats": {"title": "Cats"},
+                }
+            },
+            "other": {"tables": {"dogs": {"facets": ["name"]}}},
+        }
+    }
+    assert facets.metadata_facets(metadata, "data") == [
+        ("dogs", "breed"),
+        ("dogs", "age"),
+    ]
+    assert facets.metadata_facets({}, "data") == []
@@ -0,0 +1,84 @@
+from datasette_publish_vercel import fts
+import os
+import pytest
+import sqlite3
+
+
+def create_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("create table [my docs] (id integer primary key, title, body)")
+    conn.executemany(
+        "insert into [my docs] (id, title, body) values (?, ?, ?)",
+        [(i * 2, "title {}".format(i), "body text {}".format(i)) for i in range(25)]
+        + [(1000, "Pelican", "A large water bird")],
+    )
+    conn.execute("create table pairs (a, b, primary key (a, b)) without rowid")
+    conn.commit()
+    conn.close()
+
+
+def test_build_fts(tmp_path, monkeypatch):
+    # Smaller batches than rows, to exercise the batching
+    monkeypatch.setattr(fts, "BATCH_SIZE", 4)
+    original = str(tmp_path / "original.db")
+    create_db(original)
+    # Staged databases can be hard links to the originals
+    staged = str(tmp_path / "staged.db")
+    os.link(original, staged)
+    result = fts.build_fts(staged, [("my docs", ["title", "body"])])
+    assert result["path"] == staged
+    [index] = result["indexes"]
+    assert index["fts_table"] == "my docs_fts"
+    assert index["rows"] == 26
+    conn = sqlite3.connect(staged)
+    assert conn.execute(
+        "select rowid from [my docs_fts] where [my docs_fts] match 'pelican'"
+    ).fetchall() == [(1000,)]
+    assert conn.execute(
+        "select count(*) from [my docs_fts] where [my docs_fts] match 'body'"
+    ).fetchone() == (25,)
+    # The original file was not modified
+    tables = [
+        row[0]
+        for row in sqlite3.connect(original).execute("select name from sqlite_master")
+    ]
+    assert "my docs_fts" not in tables
+    assert not os.path.exists(staged + ".unshare-tmp")
+    assert fts.format_fts_report(result).startswith(
+        "{}: indexed 26 rows of my docs (title, body) in my docs_fts in ".format(staged)
+    )
+
+
+@pytest.mark.parametrize(
+    "tables,error",
+    (
+        ([("missing", ["title"])], "Table not found: missing"),
+        ([("my docs", ["title", "nope"])], "Table my docs has no column: nope"),
+        ([("pairs", ["a"])], "Table pairs is a WITHOUT ROWID table"),
+    ),
+)
+def test_build_fts_errors(tmp_path, tables, error):
+    path = str(tmp_path / "data.db")
+    create_db(path)
+    with pytest.raises(ValueError) as ex:
+        fts.build_fts(path, tables)
+    assert str(ex.value) == error
+    assert not os.path.exists(path + ".fts-tmp")
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    (
+        ("db:table:title", ("db", "table", ["title"])),
+        ("db:table:title, body", ("db", "table", ["title", "body"])),
+        ("db:table", None),
+        ("db:table:", None),
+        ("db:table:,", None),
+    ),
+)
+def test_parse_fts(value, expected):
+    if expected is None:
+        with pytest.raises(ValueError):
+            fts.parse_fts(value)
+    else:
+        assert fts.parse_fts(value) == expected
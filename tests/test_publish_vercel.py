@@ -1,13 +1,64 @@
 from click.testing import CliRunner
 from datasette import cli
+from importlib.metadata import version
 from unittest import mock
+import asyncio
+import httpx
 import json
 import os
 import pathlib
 import pytest
 import re
+import runpy
+import sqlite3
 import subprocess
 import textwrap
+import time
+
+STATIC_CACHE_ROUTE = {
+    "src": "^/-/(static|static-plugins)/(.*)$",
+    "headers": {"cache-control": "public, max-age=31536000, immutable"},
+    "continue": True,
+}
+
+
+def generate_app(appdir, args, databases=("test.db",)):
+    runner = CliRunner()
+    with mock.patch("shutil.which", return_value=True):
+        with runner.isolated_filesystem():
+            for database in databases:
+                create_test_db(database)
+            result = runner.invoke(
+                cli.cli,
+                ["publish", "vercel"]
+                + list(databases)
+                + ["--project", "foo", "--generate-dir", str(appdir)]
+                + args,
+            )
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def load_generated_app(appdir, monkeypatch, entry_point="index.py"):
+    # Generated apps use paths relative to the application directory
+    monkeypatch.chdir(appdir)
+    monkeypatch.syspath_prepend(str(appdir))
+    return runpy.run_path(str(pathlib.Path(appdir) / entry_point))["app"]
+
+
+async def get(app, path, headers=None):
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://localhost"
+    ) as client:
+        return await client.get(path, headers=headers)
+
+
+def create_test_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("create table if not exists dogs (id integer primary key, name text)")
+    conn.execute("insert into dogs (name) values ('Cleo')")
+    conn.commit()
+    conn.close()
 
 
 @mock.patch("shutil.which")
@@ -15,7 +66,7 @@ def test_publish_vercel_requires_vercel_cli(mock_which):
     mock_which.return_value = False
     runner = CliRunner()
     with runner.isolated_filesystem():
-        open("test.db", "w").write("data")
+        create_test_db("test.db")
         result = runner.invoke(
             cli.cli, ["publish", "vercel", "test.db", "--project", "foo"]
         )
@@ -23,12 +74,28 @@ def test_publish_vercel_requires_vercel_cli(mock_which):
         assert "Publishing to Vercel requires vercel to be installed" in result.output
 
 
+@mock.patch("shutil.which")
+def test_publish_vercel_generate_without_vercel_cli(mock_which, tmp_path):
+    mock_which.return_value = False
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        args = ["publish", "vercel", "test.db", "--project", "foo"]
+        result = runner.invoke(
+            cli.cli, args + ["--generate-dir", str(tmp_path / "app")]
+        )
+        assert result.exit_code == 0, result.output
+        result = runner.invoke(cli.cli, args + ["--generate-vercel-json"])
+        assert result.exit_code == 0, result.output
+    assert (tmp_path / "app" / "index.py").exists()
+
+
 @mock.patch("shutil.which")
 def test_publish_vercel_requires_project(mock_which):
     mock_which.return_value = True
     runner = CliRunner()
     with runner.isolated_filesystem():
-        open("test.db", "w").write("data")
+        create_test_db("test.db")
         result = runner.invoke(cli.cli, ["publish", "vercel", "test.db"])
         assert result.exit_code == 2
         assert "Missing option '--project'" in result.output
@@ -40,7 +107,7 @@ def test_publish_vercel_invalid_project_name(mock_which, bad_name):
     mock_which.return_value = True
     runner = CliRunner()
     with runner.isolated_filesystem():
-        open("test.db", "w").write("data")
+        create_test_db("test.db")
         result = runner.invoke(
             cli.cli, ["publish", "vercel", "test.db", "--project", bad_name]
         )
@@ -59,7 +126,7 @@ def test_publish_vercel(mock_run, mock_which, alias):
     mock_run.return_value = mock.Mock(0)
     runner = CliRunner()
     with runner.isolated_filesystem():
-        open("test.db", "w").write("data")
+        create_test_db("test.db")
         result = runner.invoke(
             cli.cli,
             ["publish", alias, "test.db", "--project", "foo", "--secret", "S"],
@@ -88,7 +155,7 @@ def test_publish_vercel_public(mock_run, mock_which):
     mock_run.return_value = mock.Mock(0)
     runner = CliRunner()
     with runner.isolated_filesystem():
-        open("test.db", "w").write("data")
+        create_test_db("test.db")
         result = runner.invoke(
             cli.cli,
             [
@@ -127,7 +194,7 @@ def test_publish_vercel_token(mock_run, mock_which):
     mock_run.return_value = mock.Mock(0)
     runner = CliRunner()
     with runner.isolated_filesystem():
-        open("test.db", "w").write("data")
+        create_test_db("test.db")
         result = runner.invoke(
             cli.cli,
             [
@@ -165,6 +232,119 @@ def test_publish_vercel_token(mock_run, mock_which):
         )
 
 
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_vercel.run")
+def test_publish_vercel_state_file_skips_unchanged(mock_run, mock_which):
+    mock_which.return_value = True
+    mock_run.return_value = mock.Mock(0)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        args = [
+            "publish",
+            "vercel",
+            "test.db",
+            "--project",
+            "foo",
+            "--secret",
+            "S",
+            "--state-file",
+            "state.json",
+        ]
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0, result.output
+        assert mock_run.call_count == 1
+        state = json.load(open("state.json"))
+        assert list(state.keys()) == ["/foo"]
+        files = [item["file"] for item in state["/foo"]["manifest"]]
+        assert files == [
+            "index.py",
+            "inspect-data.json",
+            "requirements.txt",
+            "test.db",
+            "vercel.json",
+        ]
+        # Nothing changed, so this should skip the deploy
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0, result.output
+        assert "No changes since the last deploy of foo" in result.output
+        assert mock_run.call_count == 1
+        # --force deploys anyway
+        result = runner.invoke(cli.cli, args + ["--force"])
+        assert mock_run.call_count == 2
+        # And so does a change to the metadata
+        result = runner.invoke(cli.cli, args + ["--title", "New title"])
+        assert result.exit_code == 0, result.output
+        assert mock_run.call_count == 3
+        # Deploys to other projects are tracked separately
+        result = runner.invoke(cli.cli, args + ["--title", "New title", "--no-prod"])
+        assert mock_run.call_count == 4
+        assert set(json.load(open("state.json")).keys()) == {"/foo", "/foo:preview"}
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_vercel.run")
+def test_publish_vercel_multiple_projects(mock_run, mock_which):
+    mock_which.return_value = True
+    deployed = {}
+
+    def fake_run(cmd, **kwargs):
+        vercel_json = json.load(open(os.path.join(kwargs["cwd"], "vercel.json")))
+        deployed[vercel_json["name"]] = cmd
+        if vercel_json["name"] == "broken":
+            raise subprocess.CalledProcessError(1, cmd, stderr="Error: no access\n")
+        return mock.Mock(stdout="https://{}.vercel.app\n".format(vercel_json["name"]))
+
+    mock_run.side_effect = fake_run
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "vercel", "test.db", "--secret", "S", "--scope", "team"]
+            + ["--project", "one", "--project", "other-team/two"]
+            + ["--project", "broken", "--deploy-workers", "2"],
+        )
+    assert result.exit_code == 1
+    assert set(deployed) == {"one", "two", "broken"}
+    assert deployed["one"][-4:-2] == ["--scope", "team"]
+    assert deployed["two"][-4:-2] == ["--scope", "other-team"]
+    assert "Deploying to 3 projects, 2 at a time" in result.output
+    assert re.search(
+        r"team/one: deployed in [\d.]+s: https://one.vercel.app", result.output
+    )
+    assert "other-team/two: deployed in " in result.output
+    assert "team/broken: FAILED after " in result.output
+    assert "Error: no access" in result.output
+    assert "Deploys failed for: team/broken" in result.output
+
+
+@pytest.mark.parametrize(
+    "args,error",
+    (
+        (
+            ["--generate-dir", "out"],
+            "--generate-dir and --generate-vercel-json need a single --project",
+        ),
+        (
+            ["--generate-vercel-json"],
+            "--generate-dir and --generate-vercel-json need a single --project",
+        ),
+        (["--project", "one"], "Each --project can only be used once"),
+    ),
+)
+@mock.patch("shutil.which")
+def test_publish_vercel_multiple_projects_errors(mock_which, args, error):
+    mock_which.return_value = True
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.cli,
+        ["publish", "vercel", "--project", "one", "--project", "two"] + args,
+    )
+    assert result.exit_code == 1
+    assert result.output.strip() == "Error: {}".format(error)
+
+
 @pytest.fixture(scope="session")
 @mock.patch("shutil.which")
 @mock.patch("datasette_publish_vercel.run")
@@ -174,7 +354,7 @@ def generated_app_dir(mock_run, mock_which, tmp_path_factory):
     mock_run.return_value = mock.Mock(0)
     runner = CliRunner()
     with runner.isolated_filesystem():
-        open("test.db", "w").write("data")
+        create_test_db("test.db")
         static_dir = pathlib.Path(".") / "static"
         static_dir.mkdir()
         (static_dir / "my.css").write_text("body { color: red }")
@@ -215,8 +395,10 @@ def test_publish_vercel_generate(generated_app_dir):
         "requirements.txt",
         "static",
         "index.py",
+        "inspect-data.json",
         "vercel.json",
         "test.db",
+        ".datasette-vercel-manifest.json",
     } == filenames
     index_py = open(os.path.join(generated_app_dir, "index.py")).read()
     assert index_py.strip() == (
@@ -239,15 +421,17 @@ def test_publish_vercel_generate(generated_app_dir):
     except Exception:
         pass
 
+    inspect_data = json.load(open("inspect-data.json"))
+
     secret = os.environ.get("DATASETTE_SECRET")
 
     true, false = True, False
 
     ds = Datasette(
         [],
-        ["test.db"],
+        immutables=["test.db"],
         static_mounts=static_mounts,
-        metadata=metadata,
+        metadata=metadata, inspect_data=inspect_data,
         secret=secret,
         cors=True,
         settings={"default_page_size": 10, "sql_time_limit_ms": 2000, "allow_download": false},
@@ -260,6 +444,783 @@ def test_publish_vercel_generate(generated_app_dir):
     )
 
 
+def test_publish_vercel_inspect_data(generated_app_dir):
+    inspect_data = json.load(open(os.path.join(generated_app_dir, "inspect-data.json")))
+    assert list(inspect_data.keys()) == ["test"]
+    assert inspect_data["test"]["file"] == "test.db"
+    assert inspect_data["test"]["tables"] == {"dogs": {"count": 1}}
+    assert len(inspect_data["test"]["hash"]) == 64
+
+
+@mock.patch("shutil.which")
+def test_publish_vercel_no_immutable(mock_which, tmp_path_factory):
+    appdir = os.path.join(tmp_path_factory.mktemp("generated-app-mutable"), "app")
+    mock_which.return_value = True
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        result = runner.invoke(
+            cli.cli,
+            [
+                "publish",
+                "vercel",
+                "test.db",
+                "--project",
+                "foo",
+                "--no-immutable",
+                "--generate-dir",
+                appdir,
+            ],
+        )
+        assert result.exit_code == 0, result.output
+    assert not (pathlib.Path(appdir) / "inspect-data.json").exists()
+    index_py = (pathlib.Path(appdir) / "index.py").read_text()
+    assert '    ["test.db"],\n' in index_py
+    assert "inspect_data" not in index_py
+
+
+@mock.patch("shutil.which")
+def test_publish_vercel_optimize(mock_which, tmp_path_factory):
+    appdir = os.path.join(tmp_path_factory.mktemp("generated-app-optimize"), "app")
+    mock_which.return_value = True
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        conn = sqlite3.connect("test.db")
+        conn.execute("create index idx_dogs_name on dogs(name)")
+        conn.close()
+        original = pathlib.Path("test.db").read_bytes()
+        result = runner.invoke(
+            cli.cli,
+            [
+                "publish",
+                "vercel",
+                "test.db",
+                "--project",
+                "foo",
+                "--optimize",
+                "--page-size",
+                "8192",
+                "--generate-dir",
+                appdir,
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        assert "test.db: " in result.output
+        assert "page_size=8192" in result.output
+        # The original database should not have been modified
+        assert pathlib.Path("test.db").read_bytes() == original
+    conn = sqlite3.connect(os.path.join(appdir, "test.db"))
+    assert conn.execute("pragma page_size").fetchone()[0] == 8192
+    assert conn.execute("select tbl, idx from sqlite_stat1").fetchall() == [
+        ("dogs", "idx_dogs_name")
+    ]
+    # inspect-data.json should reflect the optimized file
+    inspect_data = json.load(open(os.path.join(appdir, "inspect-data.json")))
+    assert inspect_data["test"]["size"] == os.path.getsize(
+        os.path.join(appdir, "test.db")
+    )
+
+
+@pytest.mark.parametrize(
+    "args,error",
+    (
+        (["--page-size", "4096"], "Error: --page-size requires --optimize"),
+        (
+            ["--optimize", "--page-size", "1000"],
+            "Error: --page-size must be a power of two between 512 and 65536",
+        ),
+    ),
+)
+@mock.patch("shutil.which")
+def test_publish_vercel_page_size_errors(mock_which, args, error):
+    mock_which.return_value = True
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.cli,
+        ["publish", "vercel", "--project", "foo", "--generate-vercel-json"] + args,
+    )
+    assert result.exit_code == 1
+    assert result.output.strip() == error
+
+
+@mock.patch("shutil.which")
+def test_publish_vercel_split_functions(mock_which, tmp_path_factory, monkeypatch):
+    appdir = os.path.join(tmp_path_factory.mktemp("generated-app-split"), "app")
+    mock_which.return_value = True
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        create_test_db("other-db.db")
+        result = runner.invoke(
+            cli.cli,
+            [
+                "publish",
+                "vercel",
+                "test.db",
+                "other-db.db",
+                "--project",
+                "foo",
+                "--split-functions",
+                "--generate-dir",
+                appdir,
+            ],
+        )
+        assert result.exit_code == 0, result.output
+    appdir = pathlib.Path(appdir)
+    assert {"index.py", "index_test.py", "index_other_db.py"}.issubset(
+        os.listdir(appdir)
+    )
+    vercel_json = json.loads((appdir / "vercel.json").read_text())
+    assert vercel_json["builds"] == [
+        {
+            "src": "index.py",
+            "use": "@vercel/python@3.0.7",
+            "config": {"excludeFiles": "{test.db,other-db.db}"},
+        },
+        {
+            "src": "index_test.py",
+            "use": "@vercel/python@3.0.7",
+            "config": {"excludeFiles": "{other-db.db}"},
+        },
+        {
+            "src": "index_other_db.py",
+            "use": "@vercel/python@3.0.7",
+            "config": {"excludeFiles": "{test.db}"},
+        },
+    ]
+    assert vercel_json["routes"] == [
+        STATIC_CACHE_ROUTE,
+        {"src": "^/test([/.].*)?$", "dest": "index_test.py"},
+        {"src": "^/other\\-db([/.].*)?$", "dest": "index_other_db.py"},
+        {"src": "(.*)", "dest": "index.py"},
+    ]
+    assert 'immutables=["test.db"]' in (appdir / "index_test.py").read_text()
+    assert "immutables=[]" in (appdir / "index.py").read_text()
+    # The shared function lists every database, from pages rendered at
+    # publish time, and never the empty _memory database
+    app = load_generated_app(appdir, monkeypatch)
+
+    async def run():
+        index = await get(app, "/.json")
+        databases = await get(app, "/-/databases.json")
+        signed_in = await get(
+            app, "/-/databases.json", {"authorization": "Bearer dstok_x"}
+        )
+        return index, databases, signed_in
+
+    index, databases, signed_in = asyncio.run(run())
+    assert index.headers["x-datasette-prerendered"] == "1"
+    assert set(index.json().keys()) == {"test", "other-db"}
+    assert [db["name"] for db in databases.json()] == ["test", "other-db"]
+    assert signed_in.json() == []
+
+
+def test_publish_vercel_lazy(tmp_path, monkeypatch):
+    appdir = tmp_path / "app"
+    generate_app(appdir, ["--lazy"])
+    assert (appdir / "datasette_vercel_runtime.py").exists()
+    index_py = (appdir / "index.py").read_text()
+    assert index_py.startswith("from datasette_vercel_runtime import LazyApp")
+    assert "    ds = Datasette(\n" in index_py
+    assert index_py.endswith("app = LazyApp(build)")
+    app = load_generated_app(appdir, monkeypatch)
+    response = asyncio.run(get(app, "/-/health"))
+    assert response.json() == {"ok": True, "started": False}
+    response = asyncio.run(get(app, "/test/dogs.json?_shape=array"))
+    assert response.json() == [{"id": 1, "name": "Cleo"}]
+    assert "startup-construct" in response.headers["server-timing"]
+
+
+def test_publish_vercel_prerender(tmp_path, monkeypatch):
+    appdir = tmp_path / "app"
+    result = generate_app(appdir, ["--prerender", "--lazy"])
+    assert "Prerendered 6 pages in " in result.output
+    manifest = json.loads((appdir / "prerendered" / "manifest.json").read_text())
+    assert set(manifest.keys()) == {
+        "/",
+        "/.json",
+        "/test",
+        "/test.json",
+        "/test/dogs",
+        "/test/dogs.json",
+    }
+    assert manifest["/test/dogs"]["file"] == "test/dogs/index.html"
+    index_py = (appdir / "index.py").read_text()
+    assert index_py.startswith(
+        "from datasette_vercel_runtime import LazyApp, PrerenderedApp\n"
+    )
+    assert index_py.endswith("app = LazyApp(build)\napp = PrerenderedApp(app)")
+    app = load_generated_app(appdir, monkeypatch)
+    response = asyncio.run(get(app, "/test/dogs.json"))
+    assert response.headers["x-datasette-prerendered"] == "1"
+    assert response.headers["content-type"] == "application/json; charset=utf-8"
+    assert response.json()["rows"] == [[1, "Cleo"]]
+    # Datasette has not been constructed yet
+    assert asyncio.run(get(app, "/-/health")).json()["started"] is False
+    # Query strings fall through to Datasette
+    response = asyncio.run(get(app, "/test/dogs.json?_shape=array"))
+    assert "x-datasette-prerendered" not in response.headers
+    assert response.json() == [{"id": 1, "name": "Cleo"}]
+    # So does anything with an Authorization header
+    response = asyncio.run(
+        get(app, "/test/dogs.json", {"authorization": "Bearer dstok_x"})
+    )
+    assert "x-datasette-prerendered" not in response.headers
+    # URLs are relative to the deployment, and timings are not recorded
+    assert "link" not in dict(manifest["/test/dogs"]["headers"])
+    html = (appdir / "prerendered" / "test" / "dogs" / "index.html").read_text()
+    assert 'href="/test/dogs.json"' in html
+    assert "Queries took" not in html
+    for path in ("test.json", "test/dogs.json"):
+        page = (appdir / "prerendered" / path).read_text()
+        assert "localhost" not in page and "prerender.invalid" not in page
+        assert json.loads(page)["query_ms"] == 0
+    # Publishing the same inputs again produces identical files
+    otherdir = tmp_path / "other"
+    generate_app(otherdir, ["--prerender", "--lazy"])
+    for path in manifest.values():
+        assert (appdir / "prerendered" / path["file"]).read_bytes() == (
+            otherdir / "prerendered" / path["file"]
+        ).read_bytes()
+
+
+def test_publish_vercel_prerender_path(tmp_path):
+    appdir = tmp_path / "app"
+    result = generate_app(
+        appdir, ["--prerender-path", "/test/dogs", "--prerender-path", "/nope"]
+    )
+    assert "Could not prerender /nope: HTTP status 404" in result.output
+    assert "Prerendered 1 page in " in result.output
+    manifest = json.loads((appdir / "prerendered" / "manifest.json").read_text())
+    assert list(manifest.keys()) == ["/test/dogs"]
+
+
+def test_publish_vercel_instrument(tmp_path, monkeypatch):
+    appdir = tmp_path / "app"
+    generate_app(appdir, ["--instrument"])
+    index_py = (appdir / "index.py").read_text()
+    assert index_py.startswith("from datasette_vercel_runtime import InstrumentedApp\n")
+    assert index_py.endswith("app = ds.app()\napp = InstrumentedApp(app)")
+    app = load_generated_app(appdir, monkeypatch)
+    response = asyncio.run(get(app, "/test/dogs.json"))
+    assert "sql;dur=" in response.headers["server-timing"]
+
+
+def test_publish_vercel_schema_snapshot(tmp_path, monkeypatch):
+    appdir = tmp_path / "app"
+    result = generate_app(appdir, ["--schema-snapshot"])
+    assert "Snapshotted schemas of 1 database in " in result.output
+    assert "\nload_schema_snapshot(ds)\n" in (appdir / "index.py").read_text()
+    snapshot = json.loads((appdir / "schema-snapshot.json").read_text())
+    assert snapshot["databases"]["test"]["tables"]["rows"][0][:2] == ["test", "dogs"]
+    monkeypatch.chdir(appdir)
+    monkeypatch.syspath_prepend(str(appdir))
+    namespace = runpy.run_path(str(appdir / "index.py"))
+    assert namespace["ds"].internal_db_created
+
+    async def no_introspection(internal_db, db):
+        assert db.name == "_internal", "Should not introspect {}".format(db.name)
+
+    monkeypatch.setattr("datasette.app.populate_schema_tables", no_introspection)
+
+    async def run():
+        response = await get(namespace["app"], "/test/dogs.json?_shape=array")
+        assert response.json() == [{"id": 1, "name": "Cleo"}]
+        internal_db = namespace["ds"].databases["_internal"]
+        return (
+            await internal_db.execute(
+                "select name from columns where database_name = 'test'"
+            )
+        ).rows
+
+    assert [row[0] for row in asyncio.run(run())] == ["id", "name"]
+
+
+def test_publish_vercel_schema_snapshot_hash_mismatch(tmp_path, monkeypatch):
+    appdir = tmp_path / "app"
+    generate_app(appdir, ["--schema-snapshot"])
+    snapshot_path = appdir / "schema-snapshot.json"
+    snapshot = json.loads(snapshot_path.read_text())
+    snapshot["databases"]["test"]["hash"] = "outdated"
+    snapshot_path.write_text(json.dumps(snapshot))
+    monkeypatch.chdir(appdir)
+    monkeypatch.syspath_prepend(str(appdir))
+    namespace = runpy.run_path(str(appdir / "index.py"))
+    assert not namespace["ds"].internal_db_created
+    response = asyncio.run(get(namespace["app"], "/test/dogs.json?_shape=array"))
+    assert response.json() == [{"id": 1, "name": "Cleo"}]
+
+
+def test_publish_vercel_function_sizing(tmp_path):
+    appdir = tmp_path / "app"
+    generate_app(
+        appdir,
+        [
+            "--memory",
+            "2048",
+            "--max-duration",
+            "20",
+            "--region",
+            "iad1",
+            "--region",
+            "sfo1",
+            "--serverless-settings",
+            "--setting",
+            "sql_time_limit_ms",
+            "3000",
+        ],
+    )
+    vercel_json = json.loads((appdir / "vercel.json").read_text())
+    assert vercel_json["builds"] == [
+        {
+            "src": "index.py",
+            "use": "@vercel/python@3.0.7",
+            "config": {"functions": {"index.py": {"memory": 2048, "maxDuration": 20}}},
+        }
+    ]
+    assert vercel_json["regions"] == ["iad1", "sfo1"]
+    index_py = (appdir / "index.py").read_text()
+    # Explicit --setting wins over the derived sql_time_limit_ms of 5000
+    assert (
+        '    settings={"num_sql_threads": 1, "cache_size_kb": 262144, '
+        '"sql_time_limit_ms": 3000}\n'
+    ) in index_py
+
+
+def test_publish_vercel_query_cache(tmp_path, monkeypatch):
+    appdir = tmp_path / "app"
+    generate_app(appdir, ["--query-cache", "2", "--lazy"])
+    index_py = (appdir / "index.py").read_text()
+    assert "    install_query_cache(ds, max_bytes=2097152)\n    return ds" in index_py
+    app = load_generated_app(appdir, monkeypatch)
+
+    async def run():
+        for _ in range(2):
+            response = await get(app, "/test/dogs.json?_shape=array")
+            assert response.json() == [{"id": 1, "name": "Cleo"}]
+        # Never cached, so each request gets a new value
+        values = set()
+        for _ in range(3):
+            response = await get(
+                app, "/test.json?sql=select+random()+as+v&_shape=array"
+            )
+            values.add(response.json()[0]["v"])
+        assert len(values) == 3
+        return (await get(app, "/-/cache")).json()
+
+    stats = asyncio.run(run())
+    assert stats["max_bytes"] == 2097152
+    assert stats["entries"] > 0
+    assert stats["hits"] >= stats["entries"]
+    assert stats["skipped"] == 3
+
+
+@mock.patch("shutil.which")
+def test_publish_vercel_query_cache_no_immutable(mock_which):
+    mock_which.return_value = True
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.cli,
+        [
+            "publish",
+            "vercel",
+            "--project",
+            "foo",
+            "--query-cache",
+            "64",
+            "--no-immutable",
+        ],
+    )
+    assert result.exit_code == 1
+    assert (
+        result.output.strip() == "Error: Cannot use --query-cache with --no-immutable"
+    )
+
+
+def test_publish_vercel_generate_dir_sync(tmp_path):
+    appdir = tmp_path / "app"
+    generate_app(appdir, ["--title", "Old title"])
+    manifest = json.loads((appdir / ".datasette-vercel-manifest.json").read_text())
+    assert "metadata.json" in manifest["files"]
+    (appdir / "notes.txt").write_text("mine")
+    (appdir / ".vercel").mkdir()
+    (appdir / ".vercel" / "project.json").write_text("{}")
+    # Without a title there is no metadata.json, so it is deleted
+    result = generate_app(appdir, [])
+    assert (
+        "Synced {}: updated 0 files (0 bytes), 5 files unchanged, "
+        "deleted 1 file\n".format(appdir)
+    ) in result.output
+    assert not (appdir / "metadata.json").exists()
+    assert (appdir / "notes.txt").read_text() == "mine"
+    assert (appdir / ".vercel" / "project.json").exists()
+
+
+@mock.patch("shutil.which")
+def test_publish_vercel_generate_dir_refuses_other_directories(mock_which, tmp_path):
+    mock_which.return_value = True
+    appdir = tmp_path / "project"
+    (appdir / "src").mkdir(parents=True)
+    (appdir / "src" / "code.py").write_text("print(1)")
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        args = ["publish", "vercel", "test.db", "--project", "foo"]
+        args += ["--generate-dir", str(appdir)]
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 1
+        assert (
+            "Error: {} is not empty and was not created by --generate-dir - "
+            "use --force to write to it anyway".format(appdir)
+        ) in result.output
+        assert not (appdir / "index.py").exists()
+        result = runner.invoke(cli.cli, args + ["--force"])
+        assert result.exit_code == 0, result.output
+    assert (appdir / "index.py").exists()
+    assert (appdir / "src" / "code.py").read_text() == "print(1)"
+
+
+@mock.patch("shutil.which")
+def test_publish_vercel_generate_dir_removed_on_failure(mock_which, tmp_path):
+    mock_which.return_value = True
+    appdir = tmp_path / "app"
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        args = ["publish", "vercel", "test.db", "--project", "foo"]
+        args += ["--generate-dir", str(appdir)]
+        result = runner.invoke(cli.cli, args + ["--fts", "test:nope:name"])
+        assert result.exit_code == 1
+        assert not appdir.exists()
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0, result.output
+    assert (appdir / "test.db").exists()
+
+
+def test_publish_vercel_fts(tmp_path, monkeypatch):
+    appdir = tmp_path / "app"
+    result = generate_app(appdir, ["--fts", "test:dogs:name"])
+    assert "test.db: indexed 1 rows of dogs (name) in dogs_fts in " in result.output
+    metadata = json.loads((appdir / "metadata.json").read_text())
+    assert metadata["databases"]["test"]["tables"]["dogs"] == {"fts_table": "dogs_fts"}
+    app = load_generated_app(appdir, monkeypatch)
+    response = asyncio.run(get(app, "/test/dogs.json?_search=cleo&_shape=array"))
+    assert response.json() == [{"id": 1, "name": "Cleo"}]
+
+
+def test_publish_vercel_facet_summaries(tmp_path, monkeypatch):
+    metadata_path = tmp_path / "metadata.json"
+    metadata_path.write_text(
+        json.dumps({"databases": {"test": {"tables": {"dogs": {"facets": ["name"]}}}}})
+    )
+    appdir = tmp_path / "app"
+    result = generate_app(
+        appdir,
+        ["-m", str(metadata_path), "--facet-summaries"]
+        + ["--facet-index", "test:dogs:id"],
+    )
+    assert "test.db: summarised 2 facets (2 values), created 1 index in " in (
+        result.output
+    )
+    index_py = (appdir / "index.py").read_text()
+    assert "\ninstall_facet_summaries(ds, databases=['test'], limit=1001)\n" in (
+        index_py
+    )
+    metadata = json.loads((appdir / "metadata.json").read_text())
+    assert metadata["databases"]["test"]["tables"]["_facet_summaries"] == {
+        "hidden": True
+    }
+    # Change a stored count, to show which facets are answered from summaries
+    conn = sqlite3.connect(str(appdir / "test.db"))
+    conn.execute("update _facet_summaries set count = 99 where column_name = 'name'")
+    conn.commit()
+    conn.close()
+    app = load_generated_app(appdir, monkeypatch)
+
+    async def run():
+        counts = []
+        for path in (
+            "/test/dogs.json?_facet=name",
+            "/test/dogs.json?_facet=name&id=1",
+        ):
+            response = await get(app, path)
+            [result] = response.json()["facet_results"]["name"]["results"]
+            counts.append(result["count"])
+        return counts
+
+    assert asyncio.run(run()) == [99, 1]
+
+
+def test_publish_vercel_connection_tuning(tmp_path, monkeypatch):
+    appdir = tmp_path / "app"
+    generate_app(
+        appdir,
+        ["--mmap-size", "16", "--cache-size", "4", "--prewarm", "test:dogs"],
+    )
+    index_py = (appdir / "index.py").read_text()
+    assert '    settings={"cache_size_kb": 4096}\n' in index_py
+    assert "\nset_connection_pragmas(ds, mmap_size=16777216)\n" in index_py
+    assert "\nstart_warmup(ds)\n" in index_py
+    plan = json.loads((appdir / "warmup.json").read_text())
+    assert list(plan["test.db"]["objects"]) == ["dogs"]
+    monkeypatch.chdir(appdir)
+    monkeypatch.syspath_prepend(str(appdir))
+    namespace = runpy.run_path(str(appdir / "index.py"))
+    warmup = namespace["ds"].warmup
+    deadline = time.time() + 5
+    while warmup.status != "done" and time.time() < deadline:
+        time.sleep(0.01)
+
+    async def run():
+        db = namespace["ds"].get_database("test")
+        mmap_size = (await db.execute("pragma mmap_size")).first()[0]
+        return mmap_size, (await get(namespace["app"], "/-/warmup")).json()
+
+    mmap_size, stats = asyncio.run(run())
+    assert mmap_size == 16777216
+    assert stats["status"] == "done"
+    assert stats["objects"] == stats["objects_done"] == 1
+    assert stats["bytes_read"] == stats["bytes_total"] > 0
+    assert stats["duration_ms"] >= 0
+
+
+@mock.patch("shutil.which")
+def test_publish_vercel_fts_errors(mock_which, tmp_path):
+    mock_which.return_value = True
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        for fts, error in (
+            ("test:dogs", "--fts must be database:table:column1,column2, got"),
+            ("other:dogs:name", "--fts database other is not being published"),
+            ("test:dogs:age", "Could not build --fts index in test.db: Table dogs"),
+        ):
+            result = runner.invoke(
+                cli.cli,
+                ["publish", "vercel", "test.db", "--project", "foo"]
+                + ["--generate-dir", str(tmp_path / "app"), "--fts", fts],
+            )
+            assert result.exit_code == 1
+            assert "Error: {}".format(error) in result.output
+
+
+@pytest.mark.parametrize(
+    "prewarm,error",
+    (
+        ("other", "--prewarm database other is not being published"),
+        ("test:cats", "--prewarm test.db: Table not found: cats"),
+    ),
+)
+@mock.patch("shutil.which")
+def test_publish_vercel_prewarm_errors(mock_which, tmp_path, prewarm, error):
+    mock_which.return_value = True
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "vercel", "test.db", "--project", "foo"]
+            + ["--generate-dir", str(tmp_path / "app"), "--prewarm", prewarm],
+        )
+    assert result.exit_code == 1
+    assert "Error: {}".format(error) in result.output
+
+
+def test_publish_vercel_etag(tmp_path, monkeypatch):
+    appdir = tmp_path / "app"
+    generate_app(appdir, ["--etag", "--lazy"])
+    index_py = (appdir / "index.py").read_text()
+    etag_line = index_py.split("\n")[-1]
+    assert re.match(r"^app = ETagApp\(app, content_hash='[0-9a-f]{64}'\)$", etag_line)
+    app = load_generated_app(appdir, monkeypatch)
+    response = asyncio.run(get(app, "/test/dogs.json"))
+    etag = response.headers["etag"]
+    assert re.match(r'^"[0-9a-f]{32}"$', etag)
+    # A fresh instance answers a conditional request without building Datasette
+    app = load_generated_app(appdir, monkeypatch)
+    response = asyncio.run(get(app, "/test/dogs", {"if-none-match": etag}))
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+    assert app.app.ds is None
+    # Different settings mean a different content hash
+    otherdir = tmp_path / "other"
+    generate_app(otherdir, ["--etag", "--setting", "default_page_size", "10"])
+    assert (otherdir / "index.py").read_text().split("\n")[-1] != etag_line
+
+
+def test_publish_vercel_compress(tmp_path, monkeypatch):
+    appdir = tmp_path / "app"
+    generate_app(
+        appdir,
+        ["--compress", "--compress-min-size", "10", "--etag", "--instrument"],
+    )
+    index_py = (appdir / "index.py").read_text()
+    lines = index_py.split("\n")
+    assert lines[-3].startswith("app = ETagApp(app, ")
+    assert lines[-2] == "app = CompressedApp(app, minimum_size=10)"
+    assert lines[-1] == "app = InstrumentedApp(app)"
+    app = load_generated_app(appdir, monkeypatch)
+    response = asyncio.run(get(app, "/test/dogs.json", {"accept-encoding": "gzip"}))
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json()["rows"] == [[1, "Cleo"]]
+
+
+def test_publish_vercel_cdn_downloads(tmp_path):
+    appdir = tmp_path / "app"
+    generate_app(appdir, ["--cdn-downloads"])
+    vercel_json = json.loads((appdir / "vercel.json").read_text())
+    inspect_data = json.loads((appdir / "inspect-data.json").read_text())
+    filename = "test-{}.db".format(inspect_data["test"]["hash"][:16])
+    assert (appdir / "downloads" / filename).read_bytes() == (
+        appdir / "test.db"
+    ).read_bytes()
+    assert vercel_json["builds"] == [
+        {
+            "src": "index.py",
+            "use": "@vercel/python@3.0.7",
+            "config": {"excludeFiles": "{downloads/**}"},
+        },
+        {"src": "downloads/*", "use": "@vercel/static"},
+    ]
+    assert vercel_json["routes"][1] == {
+        "src": r"^/test\.db$",
+        "status": 302,
+        "headers": {"Location": "/downloads/" + filename},
+    }
+    assert vercel_json["routes"][2]["dest"] == "/downloads/" + filename
+    assert vercel_json["routes"][2]["headers"]["content-disposition"] == (
+        'attachment; filename="test.db"'
+    )
+
+
+@mock.patch("shutil.which")
+def test_publish_vercel_cdn_downloads_skips_restricted(mock_which):
+    mock_which.return_value = True
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        create_test_db("private.db")
+        pathlib.Path("metadata.json").write_text(
+            json.dumps({"databases": {"private": {"allow": {"id": "root"}}}})
+        )
+        result = runner.invoke(
+            cli.cli,
+            [
+                "publish",
+                "vercel",
+                "test.db",
+                "private.db",
+                "-m",
+                "metadata.json",
+                "--project",
+                "foo",
+                "--cdn-downloads",
+                "--generate-vercel-json",
+            ],
+        )
+    assert result.exit_code == 0, result.output
+    assert "Not serving private.db from the CDN" in result.output
+    vercel_json = json.loads(result.output[result.output.index("{") :])
+    locations = [
+        route["headers"]["Location"]
+        for route in vercel_json["routes"]
+        if route.get("status") == 302
+    ]
+    assert len(locations) == 1
+    assert locations[0].startswith("/downloads/test-")
+
+
+@pytest.mark.parametrize(
+    "args",
+    (
+        ["--optimize"],
+        ["--fts", "test:dogs:name"],
+        ["--facet-summaries"],
+        ["--facet-index", "test:dogs:name"],
+    ),
+)
+@mock.patch("shutil.which")
+def test_publish_vercel_cdn_downloads_modified_databases(mock_which, args):
+    mock_which.return_value = True
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "vercel", "test.db", "--project", "foo", "--cdn-downloads"]
+            + ["--generate-vercel-json"]
+            + args,
+        )
+    assert result.exit_code == 1
+    assert result.output.strip() == (
+        "Error: --generate-vercel-json cannot predict --cdn-downloads filenames "
+        "for --optimize, --fts, --facet-summaries or --facet-index databases"
+    )
+
+
+def test_publish_vercel_bulk_export(tmp_path):
+    appdir = tmp_path / "app"
+    result = generate_app(appdir, ["--bulk-export", "test:dogs"])
+    assert "Exported test/dogs: 1 rows" in result.output
+    index = json.loads((appdir / "exports" / "index.json").read_text())
+    assert index["test"]["dogs"]["csv"]["url"] == "/exports/test/dogs.csv.gz"
+    assert (appdir / "exports" / "test" / "dogs.ndjson.gz").exists()
+    vercel_json = json.loads((appdir / "vercel.json").read_text())
+    assert vercel_json["builds"][0]["config"] == {"excludeFiles": "{exports/**}"}
+    assert vercel_json["builds"][1] == {"src": "exports/**", "use": "@vercel/static"}
+    assert vercel_json["routes"][-2]["dest"] == "/exports/$1"
+
+
+@pytest.mark.parametrize(
+    "args,error",
+    (
+        (["--bulk-export", "test"], "--bulk-export must be database:table"),
+        (["--bulk-export", "test:cats"], "--bulk-export table not found: test:cats"),
+    ),
+)
+@mock.patch("shutil.which")
+def test_publish_vercel_bulk_export_errors(mock_which, tmp_path, args, error):
+    mock_which.return_value = True
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "vercel", "test.db", "--project", "foo"]
+            + ["--generate-dir", str(tmp_path / "app")]
+            + args,
+        )
+    assert result.exit_code == 1
+    assert error in result.output
+
+
+@pytest.mark.parametrize("size_limit,exit_code", (("250", 0), ("1", 1)))
+@mock.patch("shutil.which")
+def test_publish_vercel_analyze_json(mock_which, size_limit, exit_code):
+    mock_which.return_value = False
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        create_test_db("test.db")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "vercel", "test.db", "--project", "foo", "--analyze-json"]
+            + ["--size-limit", size_limit],
+        )
+        # Nothing is left behind
+        assert os.listdir(".") == ["test.db"]
+    assert result.exit_code == exit_code, result.output
+    # Output may include the messages written to stderr
+    output = result.output
+    report = json.loads(output[output.index("{") : output.rindex("}") + 1])
+    assert report["categories"]["databases"] > 0
+    assert "index.py" in report["functions"]
+    assert report["limit"] == int(size_limit) * 1024 * 1024
+    if exit_code:
+        assert "Over the 1 MB size limit: index.py" in output
+
+
 def test_publish_vercel_static(generated_app_dir):
     assert (
         "body { color: red }"
@@ -276,6 +1237,16 @@ def test_publish_vercel_requirements(generated_app_dir):
     assert {"datasette", "pysqlite3-binary"} == requirements
 
 
+def test_publish_vercel_pin_requirements(tmp_path):
+    appdir = tmp_path / "app"
+    result = generate_app(appdir, ["--pin-requirements", "--install", "nope-nope"])
+    assert "Could not pin nope-nope to a locally installed version" in result.output
+    requirements = (appdir / "requirements.txt").read_text().split("\n")
+    assert requirements[:2] == ["pysqlite3-binary", "nope-nope"]
+    assert "datasette=={}".format(version("datasette")) in requirements
+    assert all("==" in line for line in requirements[2:])
+
+
 def test_help_in_readme(request):
     # Ensure the --help output embedded in the README is up-to-date
     readme_path = pathlib.Path(__file__).parent.parent / "README.md"
@@ -318,10 +1289,61 @@ def test_generate_vercel_json(mock_run, mock_which):
         "name": "foo",
         "version": 2,
         "builds": [{"src": "index.py", "use": "@vercel/python@3.0.7"}],
-        "routes": [{"src": "(.*)", "dest": "index.py"}],
+        "routes": [STATIC_CACHE_ROUTE, {"src": "(.*)", "dest": "index.py"}],
     }
 
 
+@mock.patch("shutil.which")
+def test_generate_vercel_json_cdn_ttl(mock_which):
+    mock_which.return_value = True
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.cli,
+        [
+            "publish",
+            "vercel",
+            "--project",
+            "foo",
+            "--static",
+            "assets:{}".format(pathlib.Path(__file__).parent),
+            "--cdn-ttl",
+            "600",
+            "--cdn-swr",
+            "3600",
+            "--generate-vercel-json",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output)["routes"] == [
+        STATIC_CACHE_ROUTE,
+        {
+            "src": "^/assets/(.*)$",
+            "headers": {"cache-control": "public, max-age=3600, s-maxage=31536000"},
+            "continue": True,
+        },
+        {
+            "src": "^/(?!-/).*$",
+            "methods": ["GET", "HEAD"],
+            "missing": [
+                {"type": "cookie", "key": "ds_actor"},
+                {"type": "header", "key": "authorization"},
+            ],
+            "headers": {
+                "cache-control": "public, max-age=0, s-maxage=600, stale-while-revalidate=3600"
+            },
+            "continue": True,
+        },
+        {"src": "(.*)", "dest": "index.py"},
+    ]
+    # --cdn-swr on its own is an error
+    result = runner.invoke(
+        cli.cli,
+        ["publish", "vercel", "--project", "foo", "--cdn-swr", "60"],
+    )
+    assert result.exit_code == 1
+    assert "Error: --cdn-swr requires --cdn-ttl" in result.output
+
+
 def test_vercel_json_errors(tmpdir):
     bad_json = tmpdir / "bad.json"
     bad_json.write_text("{", "utf-8")
@@ -362,7 +1384,7 @@ def test_custom_vercel_json(mock_run, mock_which, tmp_path_factory, tmpdir):
     mock_run.return_value = mock.Mock(0)
     runner = CliRunner()
     with runner.isolated_filesystem():
-        open("test.db", "w").write("data")
+        create_test_db("test.db")
         result = runner.invoke(
             cli.cli,
             [
@@ -0,0 +1,44 @@
+from datasette_publish_vercel.requirements import (
+    pinned_requirements,
+    requirement_name,
+)
+from importlib.metadata import version
+import pytest
+
+
+@pytest.mark.parametrize(
+    "requirement,expected",
+    (
+        ("datasette", "datasette"),
+        ("click>=7.1 ; python_version > '3.6'", "click"),
+        ("https://github.com/simonw/datasette/archive/main.zip", "datasette"),
+        ("--extra-index-url https://example.com/", None),
+    ),
+)
+def test_requirement_name(requirement, expected):
+    assert requirement_name(requirement) == expected
+
+
+def test_pinned_requirements():
+    pinned, unresolved = pinned_requirements(
+        ["datasette", "not-a-real-package", "pluggy>=999"]
+    )
+    assert "datasette=={}".format(version("datasette")) in pinned
+    # Dependencies are pinned too
+    assert "jinja2=={}".format(version("jinja2")) in pinned
+    names = [p.split("==")[0] for p in pinned]
+    assert names == sorted(names)
+    assert "pip" not in names
+    assert "setuptools" not in names
+    # The installed pluggy does not satisfy the requirement
+    assert "pluggy" not in names
+    assert unresolved == ["not-a-real-package", "pluggy>=999"]
+
+
+def test_pinned_requirements_url():
+    url = "https://github.com/simonw/datasette/archive/main.zip"
+    pinned, unresolved = pinned_requirements([url])
+    assert unresolved == [url]
+    names = [p.split("==")[0] for p in pinned]
+    assert "datasette" not in names
+    assert "jinja2" in names
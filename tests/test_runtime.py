@@ -0,0 +1,285 @@
+from datasette.app import Datasette
+from datasette.database import Results
+from datasette.tracer import capture_traces, get_task_id, tracers
+from datasette_publish_vercel.runtime import (
+    CompressedApp,
+    ETagApp,
+    InstrumentedApp,
+    LazyApp,
+    QueryCache,
+    is_deterministic_sql,
+    registered_non_deterministic_functions,
+)
+import asyncio
+import gzip
+import httpx
+import json
+import sqlite3
+
+
+def client_for(app):
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://localhost"
+    )
+
+
+def test_lazy_app():
+    asyncio.run(_test_lazy_app())
+
+
+async def _test_lazy_app():
+    calls = []
+
+    def build():
+        calls.append(1)
+        return Datasette(memory=True)
+
+    app = LazyApp(build)
+    async with client_for(app) as client:
+        response = await client.get("/-/health")
+        assert response.json() == {"ok": True, "started": False}
+        assert calls == []
+        # Concurrent first requests only build once
+        responses = await asyncio.gather(
+            client.get("/-/versions.json"), client.get("/-/versions.json")
+        )
+        assert calls == [1]
+        assert [r.status_code for r in responses] == [200, 200]
+        timing_headers = [r.headers.get("server-timing") for r in responses]
+        assert len([h for h in timing_headers if h]) == 1
+        header = [h for h in timing_headers if h][0]
+        assert header.startswith("startup-construct;dur=")
+        assert "startup-startup;dur=" in header
+        assert set(app.timings.keys()) == {"construct", "startup", "app"}
+        response = await client.get("/-/health")
+        assert response.json() == {"ok": True, "started": True}
+        response = await client.get("/-/versions.json")
+        assert "server-timing" not in response.headers
+
+
+def test_instrumented_app(capsys):
+    ds = Datasette(memory=True)
+    app = InstrumentedApp(ds.app())
+
+    async def run():
+        async with client_for(app) as client:
+            first = await client.get("/_memory.json?sql=select+1")
+            second = await client.get("/_memory.json?sql=select+1")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.status_code == 200
+    timing = first.headers["server-timing"]
+    assert timing.startswith("total;dur=")
+    assert ", sql;dur=" in timing
+    assert timing.endswith(', cold;desc="cold start"')
+    assert "cold" not in second.headers["server-timing"]
+    log_lines = [
+        json.loads(line) for line in capsys.readouterr().out.strip().split("\n")
+    ]
+    assert len(log_lines) == 2
+    assert log_lines[0]["event"] == "datasette-request"
+    assert log_lines[0]["path"] == "/_memory.json"
+    assert log_lines[0]["status"] == 200
+    assert log_lines[0]["sql_queries"] >= 1
+    assert log_lines[0]["cold_start"] is True
+    assert log_lines[1]["cold_start"] is False
+
+
+def test_instrumented_app_with_datasette_trace(capsys):
+    ds = Datasette(memory=True, settings={"trace_debug": True})
+    app = InstrumentedApp(ds.app())
+
+    async def run():
+        async with client_for(app) as client:
+            traced = await client.get("/_memory.json?sql=select+1&_trace=1")
+            # An outer tracer still sees the SQL, and is left in place
+            outer = []
+            with capture_traces(outer):
+                plain = await client.get("/_memory.json?sql=select+1")
+                assert tracers[get_task_id()] is outer
+        return traced, plain, outer
+
+    traced, plain, outer = asyncio.run(run())
+    assert traced.status_code == 200
+    assert traced.json()["_trace"]["num_traces"] >= 1
+    assert ", sql;dur=" not in traced.headers["server-timing"]
+    assert ", sql;dur=" in plain.headers["server-timing"]
+    assert any(trace["type"] == "sql" for trace in outer)
+    log_lines = [
+        json.loads(line) for line in capsys.readouterr().out.strip().split("\n")
+    ]
+    assert log_lines[0]["sql_ms"] is None
+
+
+def test_query_cache_lru_eviction():
+    cache = QueryCache(max_bytes=1000)
+    results = Results([("x" * 100,)], False, [("value",)])
+    size = QueryCache.estimate_size(results)
+    assert size == 64 + 64 + 148
+    cache.set("a", results)
+    cache.set("b", results)
+    cache.set("c", results)
+    assert cache.get("a") is results
+    # Evicts b, the least recently used, rather than a
+    cache.set("d", results)
+    assert cache.get("b") is None
+    assert cache.get("a") is results
+    assert cache.stats() == {
+        "entries": 3,
+        "bytes": size * 3,
+        "max_bytes": 1000,
+        "hits": 2,
+        "misses": 1,
+        "evictions": 1,
+        "skipped": 0,
+    }
+    # Results larger than the whole cache are not stored
+    cache.set("big", Results([("x" * 2000,)], False, [("value",)]))
+    assert cache.get("big") is None
+
+
+def test_is_deterministic_sql():
+    assert is_deterministic_sql("select count(*) from [dogs] where date = ?")
+    assert is_deterministic_sql("select * from dogs order by random_id")
+    assert not is_deterministic_sql("select * from dogs order by RANDOM ()")
+    assert not is_deterministic_sql("select datetime('now')")
+    assert not is_deterministic_sql("select current_timestamp")
+    assert not is_deterministic_sql("select lookup(name) from dogs", {"lookup"})
+    conn = sqlite3.connect(":memory:")
+    conn.create_function("lookup", 1, lambda value: value)
+    conn.create_function("upper_name", 1, str.upper, deterministic=True)
+    registered = registered_non_deterministic_functions(conn)
+    assert "lookup" in registered
+    assert "upper_name" not in registered
+    assert "count" not in registered
+
+
+def test_etag_app():
+    ds = Datasette(memory=True)
+    app = ETagApp(ds.app(), content_hash="abc")
+
+    async def run():
+        responses = {}
+        async with client_for(app) as client:
+            first = responses["first"] = await client.get("/.json")
+            etag = first.headers["etag"]
+            responses["matching"] = await client.get(
+                "/.json", headers={"if-none-match": 'W/"x", ' + etag}
+            )
+            responses["stale"] = await client.get(
+                "/.json", headers={"if-none-match": '"stale"'}
+            )
+            responses["signed_in"] = await client.get(
+                "/.json",
+                headers={"if-none-match": etag, "cookie": "ds_actor=x"},
+            )
+            responses["token"] = await client.get(
+                "/.json",
+                headers={"if-none-match": etag, "authorization": "Bearer dstok_x"},
+            )
+            responses["missing"] = await client.get("/nope")
+            responses["wildcard"] = await client.get(
+                "/nope", headers={"if-none-match": "*"}
+            )
+            # /-/ pages describe the running instance, static assets do not
+            responses["dynamic"] = await client.get(
+                "/-/versions.json", headers={"if-none-match": etag}
+            )
+            responses["static"] = await client.get("/-/static/app.css")
+        return responses
+
+    responses = asyncio.run(run())
+    etag = responses["first"].headers["etag"]
+    assert responses["first"].status_code == 200
+    assert responses["matching"].status_code == 304
+    assert responses["stale"].status_code == 200
+    assert responses["stale"].headers["etag"] == etag
+    for key in ("signed_in", "token"):
+        assert responses[key].status_code == 200
+        assert "etag" not in responses[key].headers
+    for key in ("missing", "wildcard"):
+        assert responses[key].status_code == 404
+        assert "etag" not in responses[key].headers
+    assert responses["dynamic"].status_code == 200
+    assert "etag" not in responses["dynamic"].headers
+    assert responses["static"].status_code == 200
+    assert responses["static"].headers["etag"] == etag
+
+
+def test_compressed_app():
+    async def app(scope, receive, send):
+        content_type = b"image/png" if scope["path"] == "/png" else b"text/csv"
+        # /small is a single chunk, smaller than minimum_size
+        chunks = 1 if scope["path"] == "/small" else 3
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [[b"content-type", content_type], [b"etag", b'"abc"']],
+            }
+        )
+        for i in range(chunks):
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": b"a,b\n" * 200,
+                    "more_body": i < chunks - 1,
+                }
+            )
+
+    async def run(path, accept_encoding="gzip"):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request"}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "headers": [[b"accept-encoding", accept_encoding.encode()]],
+        }
+        await CompressedApp(app, minimum_size=1000)(scope, receive, send)
+        return messages
+
+    messages = asyncio.run(run("/"))
+    headers = dict(messages[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert headers[b"vary"] == b"Accept-Encoding"
+    assert headers[b"etag"] == b'W/"abc"'
+    # Each chunk is compressed and sent as it arrives
+    assert [m.get("more_body") for m in messages[1:]] == [True, True, False]
+    body = b"".join(m["body"] for m in messages[1:])
+    assert gzip.decompress(body) == b"a,b\n" * 600
+    assert len(body) < 100
+    # Not compressed: small final chunk, wrong content type, not accepted
+    for path, accept_encoding in (
+        ("/small", "gzip"),
+        ("/png", "gzip"),
+        ("/", "deflate, gzip;q=0"),
+    ):
+        messages = asyncio.run(run(path, accept_encoding))
+        assert b"content-encoding" not in dict(messages[0]["headers"])
+
+
+def test_compressed_app_with_etag():
+    ds = Datasette(memory=True)
+    app = CompressedApp(ETagApp(ds.app(), content_hash="abc"), minimum_size=10)
+
+    async def run():
+        async with client_for(app) as client:
+            first = await client.get("/.json")
+            second = await client.get(
+                "/.json", headers={"if-none-match": first.headers["etag"]}
+            )
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.headers["content-encoding"] in ("gzip", "br")
+    assert first.headers["etag"].startswith('W/"')
+    assert "_memory" in first.json()
+    assert second.status_code == 304
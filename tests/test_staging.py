@@ -0,0 +1,124 @@
+from datasette_publish_vercel.staging import (
+    Stager,
+    format_sync_report,
+    generated_files,
+    sync_directory,
+    unshare_file,
+)
+from unittest import mock
+import os
+
+
+def test_stage_file_hardlink(tmp_path):
+    src = tmp_path / "big.db"
+    src.write_bytes(b"data")
+    stager = Stager()
+    assert stager.stage_file(src, tmp_path / "staged.db") == "hardlink"
+    assert os.stat(tmp_path / "staged.db").st_ino == os.stat(src).st_ino
+    assert stager.summary() == "Staged 1 file (hardlink: 1)"
+
+
+@mock.patch("os.link", side_effect=OSError("Invalid cross-device link"))
+@mock.patch(
+    "datasette_publish_vercel.staging._reflink", side_effect=OSError("Not supported")
+)
+def test_stage_file_fallbacks(mock_reflink, mock_link, tmp_path):
+    src = tmp_path / "big.db"
+    src.write_bytes(b"data")
+    # Symlinks are only used if allowed, e.g. for --generate-dir
+    stager = Stager(allow_symlinks=True)
+    assert stager.stage_file(src, tmp_path / "linked.db") == "symlink"
+    assert os.readlink(tmp_path / "linked.db") == str(src)
+    stager = Stager()
+    assert stager.stage_file(src, tmp_path / "copied.db") == "copy"
+    assert not (tmp_path / "copied.db").is_symlink()
+    assert (tmp_path / "copied.db").read_bytes() == b"data"
+
+
+def test_stage_directory(tmp_path):
+    (tmp_path / "static" / "css").mkdir(parents=True)
+    (tmp_path / "static" / "css" / "my.css").write_text("body { color: red }")
+    (tmp_path / "static" / "app.js").write_text("alert(1)")
+    stager = Stager()
+    stager.stage_directory(tmp_path / "static", tmp_path / "staged")
+    assert (tmp_path / "staged" / "css" / "my.css").read_text() == "body { color: red }"
+    assert (tmp_path / "staged" / "app.js").exists()
+    assert stager.strategies == {"hardlink": 2}
+
+
+def test_sync_directory(tmp_path):
+    src = tmp_path / "src"
+    (src / "templates").mkdir(parents=True)
+    (src / "index.py").write_text("app = 1")
+    (src / "metadata.json").write_text("{}")
+    (src / "data.db").write_bytes(b"data")
+    (src / "templates" / "index.html").write_text("<h1>Hi</h1>")
+    dst = tmp_path / "dst"
+    (dst / "old").mkdir(parents=True)
+    (dst / "old" / "stale.txt").write_text("stale")
+    (dst / "notes.txt").write_text("mine")
+    (dst / ".vercel").mkdir()
+    (dst / ".vercel" / "project.json").write_text("{}")
+    (dst / "metadata.json").write_text("{}")
+    # Only files generated last time are deleted
+    result = sync_directory(
+        str(src), str(dst), previous=["old/stale.txt", "metadata.json", "gone.txt"]
+    )
+    assert sorted(result["updated"]) == ["data.db", "index.py", "templates/index.html"]
+    assert result["unchanged"] == 1
+    assert result["deleted"] == [os.path.join("old", "stale.txt")]
+    assert not (dst / "old").exists()
+    assert (dst / "notes.txt").read_text() == "mine"
+    assert (dst / ".vercel" / "project.json").exists()
+    assert (dst / "templates" / "index.html").read_text() == "<h1>Hi</h1>"
+    # Nothing changed, but index.py is a new file with a different mtime
+    (src / "index.py").unlink()
+    (src / "index.py").write_text("app = 1")
+    os.utime(src / "index.py", ns=(0, 0))
+    result = sync_directory(str(src), str(dst))
+    assert result["updated"] == []
+    assert result["unchanged"] == 4
+    # Its mtime was updated, so the next sync will not need to hash it
+    assert os.stat(dst / "index.py").st_mtime_ns == 0
+    assert format_sync_report(result) == (
+        "Synced {}: updated 0 files (0 bytes), 4 files unchanged, "
+        "deleted 0 files".format(dst)
+    )
+    # A changed file is replaced, rather than written to - so a file linked
+    # to it, like the user's original database, is not modified
+    os.link(dst / "data.db", tmp_path / "original.db")
+    (src / "data.db").unlink()
+    (src / "data.db").write_bytes(b"new data")
+    result = sync_directory(str(src), str(dst))
+    assert result["updated"] == ["data.db"]
+    assert result["updated_bytes"] == 8
+    assert (dst / "data.db").read_bytes() == b"new data"
+    assert (tmp_path / "original.db").read_bytes() == b"data"
+
+
+def test_generated_files(tmp_path):
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "index.html").write_text("")
+    (tmp_path / "index.py").write_text("")
+    (tmp_path / ".datasette-vercel-manifest.json").write_text("{}")
+    assert generated_files(str(tmp_path)) == ["index.py", "templates/index.html"]
+
+
+def test_unshare_file(tmp_path):
+    original = tmp_path / "original.db"
+    original.write_bytes(b"data")
+    private = tmp_path / "private.db"
+    private.write_bytes(b"data")
+    assert not unshare_file(str(private))
+    hardlink = tmp_path / "hardlink.db"
+    os.link(original, hardlink)
+    symlink = tmp_path / "symlink.db"
+    os.symlink(original, symlink)
+    for path in (hardlink, symlink):
+        assert unshare_file(str(path))
+        assert not path.is_symlink()
+        assert not os.path.samefile(path, original)
+        path.write_bytes(b"changed")
+        assert path.read_bytes() == b"changed"
+    assert original.read_bytes() == b"data"
+    assert os.stat(original).st_nlink == 1